@@ -0,0 +1,383 @@
+#!/usr/bin/python2.7
+# -*- coding: utf-8 -*-
+
+"""output of co-evolution match triplets (rlocds_id_1, rlocds_id_2, coev_score) to series of shard files
+
+Shards are either tabulated text files '<rad>.<k>' ('%d\t%d\t%f' lines, the historical format),
+or binary files '<rad>.<k>' of fixed-width little-endian (uint32, uint32, float32) records,
+optionally gzip-compressed ('<rad>.<k>.gz'); uncompressed binary shards can be memory-mapped with read_match_shard().
+Writing can be done in a background thread (see AsyncMatchWriter class).
+A writer can keep a progress journal of the query lineages whose matches are all in completed shards (see read_journal()),
+so that an interrupted computation can be resumed.
+Run as a script to convert binary shards to the tabulated format or to load them into the coevolution_scores table of a database.
+"""
+
+import os, sys, glob, getopt
+import gzip
+import threading, Queue, time
+import numpy as np
+
+match_dtype = np.dtype([('rlocds_id_1', '<u4'), ('rlocds_id_2', '<u4'), ('coev_score', '<f4')])
+# default prefixes of shard file names, as written by compare_collapsedALE_scenarios.py
+tabshardprefix = 'matching_events.tab'
+binshardprefix = 'matching_events.bin'
+journalprefix = 'progress_journal'
+
+def read_journal(nfjournal, withids=True):
+	"""return the index of the next shard to write and the list of ids of completed query lineages recorded in a progress journal
+	
+	the journal is made of a header file with the single line 'next_shard<TAB>k', 
+	and of one segment file '<nfjournal>.ids.<j>' per completed shard j < k, listing one query lineage id per line; 
+	segments of shards not yet recorded as completed in the header are ignored.
+	"""
+	with open(nfjournal, 'r') as fjournal:
+		nextshard = int(fjournal.readline().rstrip('\n').split('\t')[1])
+	lids = []
+	if withids:
+		for j in xrange(nextshard):
+			nfsegment = '%s.ids.%d'%(nfjournal, j)
+			if not os.path.exists(nfsegment): continue
+			with open(nfsegment, 'r') as fsegment:
+				lids += [int(line) for line in fsegment]
+	return nextshard, lids
+
+def write_journal(nfjournal, nextshard, lids):
+	"""record the ids of the query lineages completed with shard nextshard-1 in a new journal segment, 
+	then update the journal header atomically, by renaming a complete temporary file
+	"""
+	with open('%s.ids.%d'%(nfjournal, nextshard-1), 'w') as fsegment:
+		fsegment.write(''.join('%d\n'%lid for lid in lids))
+		fsegment.flush()
+		os.fsync(fsegment.fileno())
+	nftmp = nfjournal+'.tmp'
+	with open(nftmp, 'w') as ftmp:
+		ftmp.write('next_shard\t%d\n'%nextshard)
+		ftmp.flush()
+		os.fsync(ftmp.fileno())
+	os.rename(nftmp, nfjournal)
+
+def read_journal_ids(dirjournals):
+	"""return the set of ids of completed query lineages recorded in all the progress journals of a folder"""
+	doneids = set()
+	for nfjournal in glob.glob(os.path.join(dirjournals, journalprefix+'*')):
+		if nfjournal.endswith('.tmp') or ('.ids.' in os.path.basename(nfjournal)): continue
+		doneids.update(read_journal(nfjournal)[1])
+	return doneids
+
+def discard_uncommitted_shards(dirout, shardprefix):
+	"""delete the shards of a folder that are not recorded as completed in the progress journal of their series
+	
+	the series of shards '<shardprefix>.<k>' is recorded in journal '<journalprefix>', 
+	and that of a parallel worker '<shardprefix>.<w>.<k>' in '<journalprefix>.<w>'.
+	"""
+	lnfdiscard = []
+	for nfshard in glob.glob(os.path.join(dirout, shardprefix+'.*')):
+		suffixes = os.path.basename(nfshard)[len(shardprefix)+1:].split('.')
+		if suffixes[-1]=='gz': suffixes = suffixes[:-1]
+		if not (suffixes and all(x.isdigit() for x in suffixes)): continue
+		nfjournal = os.path.join(dirout, '.'.join([journalprefix]+suffixes[:-1]))
+		nextshard = read_journal(nfjournal, withids=False)[0] if os.path.exists(nfjournal) else 0
+		if int(suffixes[-1]) >= nextshard:
+			os.remove(nfshard)
+			lnfdiscard.append(nfshard)
+	return lnfdiscard
+
+class MatchShardWriter(object):
+	"""buffered writer of match triplets to a series of shard files '<nfoutrad>.<k>', opening the next file when one reaches 'maxsize' bytes (before compression)
+	
+	Shard files are only opened when there are matches to write into them.
+	
+	With 'nfjournal', the ids of query lineages declared with done() are recorded in this progress journal
+	once the shard containing their matches is completed, i.e. when the next shard is opened or the writer is closed;
+	only the ids of the completed shard are appended to the journal each time (see write_journal()). With 'resume', the writer 
+	reloads the index of the next shard from an existing journal and continues the series (uncompleted shards should first be removed with discard_uncommitted_shards()).
+	"""
+	def __init__(self, nfoutrad, binary=False, compress=False, maxsize=1024**3, bufsize=100000, kfout=0, nfjournal=None, resume=False):
+		self.nfoutrad = nfoutrad
+		self.binary = binary
+		self.compress = compress
+		self.maxsize = maxsize
+		self.bufsize = bufsize
+		self.kfout = kfout
+		self.buffer = []
+		self.nmatch = 0
+		# size of the formatted output, before compression
+		self.nbytes = 0
+		self.lnfshards = []
+		self.fout = None
+		self.nfjournal = nfjournal
+		# query lineages with matches in the current shard, and in the buffer
+		self.shardids = []
+		self.bufferids = []
+		if resume and nfjournal and os.path.exists(nfjournal):
+			self.kfout = read_journal(nfjournal, withids=False)[0]
+
+	def _open(self):
+		nfout = '%s.%d'%(self.nfoutrad, self.kfout)
+		if self.compress:
+			nfout += '.gz'
+			self.fout = gzip.open(nfout, 'wb')
+		else:
+			self.fout = open(nfout, 'wb')
+		self.lnfshards.append(nfout)
+
+	def _commit(self):
+		"""record the query lineages of the (just completed) current shard in the journal"""
+		if not self.nfjournal: return
+		# nothing was written nor completed since the last commit, e.g. when resuming a finished computation
+		if self.fout is None and not self.shardids: return
+		write_journal(self.nfjournal, self.kfout+1, self.shardids)
+		self.shardids = []
+
+	def write(self, lm):
+		"""add a list of (rlocds_id_1, rlocds_id_2, coev_score) triplets"""
+		self.buffer += lm
+		self.nmatch += len(lm)
+		# with a journal, only flush when the buffer holds the matches of completed queries
+		if len(self.buffer) >= self.bufsize and not self.nfjournal: self.flush()
+
+	def done(self, queryids):
+		"""declare that all the matches of these query lineages have been written"""
+		if not self.nfjournal: return
+		self.bufferids += list(queryids)
+		if len(self.buffer) >= self.bufsize: self.flush()
+
+	def flush(self):
+		if self.buffer and self.fout and self.fout.tell() >= self.maxsize:
+			self.fout.close()
+			self._commit()
+			self.fout = None
+			self.kfout += 1
+		# shards are only opened when there are matches to write
+		if self.buffer:
+			if not self.fout: self._open()
+			if self.binary:
+				data = np.array(self.buffer, dtype=match_dtype).tostring()
+			else:
+				data = ''.join('%d\t%d\t%f\n'%tgpcf for tgpcf in self.buffer)
+			self.fout.write(data)
+			self.nbytes += len(data)
+			self.buffer = []
+		self.shardids += self.bufferids
+		self.bufferids = []
+
+	def close(self):
+		self.flush()
+		if self.fout: self.fout.close()
+		self._commit()
+
+class AsyncMatchWriter(object):
+	"""writer of match triplets with the same interface as MatchShardWriter (built with the same keyword arguments), 
+	that formats, compresses and writes them to disk in a background thread
+	
+	matches and completed query ids are passed to the thread in batches of about 'batchsize' matches through a queue 
+	of at most 'maxqueue' batches; when it is full, write() and done() block, holding back the producer 
+	(e.g. the draining of the results of a pool of workers) until the thread catches up.
+	With 'verbose', the throughput (matches/s, bytes/s before compression) is reported every 'reportinterval' seconds and when closing.
+	"""
+	def __init__(self, nfoutrad, batchsize=100000, maxqueue=16, verbose=False, reportinterval=60, **kw):
+		self.writer = MatchShardWriter(nfoutrad, **kw)
+		self.batchsize = batchsize
+		self.verbose = verbose
+		self.reportinterval = reportinterval
+		self.queue = Queue.Queue(maxsize=maxqueue)
+		self.pending = []
+		self.pendingids = []
+		self.error = None
+		self.starttime = self.lastreport = time.time()
+		self.thread = threading.Thread(target=self._run)
+		self.thread.daemon = True
+		self.thread.start()
+	
+	def _run(self):
+		while True:
+			batch = self.queue.get()
+			if batch is None: break
+			# after an error, keep consuming the queue so the producer is not blocked, it will raise the error
+			if self.error: continue
+			try:
+				lm, queryids = batch
+				self.writer.write(lm)
+				if queryids: self.writer.done(queryids)
+				if self.verbose and (time.time() - self.lastreport) >= self.reportinterval:
+					self.report()
+					self.lastreport = time.time()
+			except Exception:
+				self.error = sys.exc_info()
+		if not self.error:
+			try:
+				self.writer.close()
+			except Exception:
+				self.error = sys.exc_info()
+	
+	def _check(self):
+		if self.error: raise self.error[0], self.error[1], self.error[2]
+	
+	def _enqueue(self):
+		self._check()
+		self.queue.put((self.pending, self.pendingids))
+		self.pending = []
+		self.pendingids = []
+	
+	@property
+	def nmatch(self):
+		return self.writer.nmatch
+	
+	@property
+	def lnfshards(self):
+		return self.writer.lnfshards
+	
+	def report(self):
+		elapsed = max(time.time() - self.starttime, 1e-6)
+		print "written %d matches (%.0f matches/s), %d bytes (%.0f bytes/s)"%(self.writer.nmatch, self.writer.nmatch/elapsed, self.writer.nbytes, self.writer.nbytes/elapsed)
+		sys.stdout.flush()
+	
+	def write(self, lm):
+		"""add a list of (rlocds_id_1, rlocds_id_2, coev_score) triplets"""
+		self.pending += lm
+		# with a journal, batches must only hold the matches of completed queries
+		if len(self.pending) >= self.batchsize and not self.writer.nfjournal: self._enqueue()
+	
+	def done(self, queryids):
+		"""declare that all the matches of these query lineages have been written"""
+		self.pendingids += list(queryids)
+		if len(self.pending) >= self.batchsize: self._enqueue()
+	
+	def close(self):
+		"""write the remaining matches and wait for the thread to complete"""
+		self._enqueue()
+		self.queue.put(None)
+		self.thread.join()
+		self._check()
+		if self.verbose: self.report()
+
+def read_match_shard(nfshard, binary=None):
+	"""return the match triplets of a shard file as a record array of dtype 'match_dtype'
+
+	uncompressed binary shards are memory-mapped; the format is guessed from the file name unless 'binary' is specified.
+	"""
+	if binary is None: binary = (binshardprefix in os.path.basename(nfshard))
+	if not binary:
+		with (gzip.open(nfshard, 'rb') if nfshard.endswith('.gz') else open(nfshard, 'r')) as fshard:
+			lines = fshard.read().splitlines()
+		if not lines: return np.zeros(0, dtype=match_dtype)
+		return np.loadtxt(lines, dtype=match_dtype, delimiter='\t', ndmin=1)
+	elif nfshard.endswith('.gz'):
+		with gzip.open(nfshard, 'rb') as fshard:
+			return np.frombuffer(fshard.read(), dtype=match_dtype)
+	elif os.path.getsize(nfshard)==0:
+		return np.zeros(0, dtype=match_dtype)
+	else:
+		return np.memmap(nfshard, dtype=match_dtype, mode='r')
+
+def iter_match_shards(dirshards, prefix=binshardprefix):
+	"""yield the path of the shard files in a folder, in the order of their indexes"""
+	def shardindexes(nf):
+		return tuple(int(x) for x in os.path.basename(nf)[len(prefix):].split('.') if x.isdigit())
+	for nfshard in sorted(glob.glob(os.path.join(dirshards, prefix+'.*')), key=shardindexes):
+		yield nfshard
+
+def match_records2tuples(amatches):
+	"""convert a record array of matches into a list of (int, int, float) tuples"""
+	return zip(amatches['rlocds_id_1'].tolist(), amatches['rlocds_id_2'].tolist(), amatches['coev_score'].astype(np.float64).tolist())
+
+class MatchShardStream(object):
+	"""read-only file-like object streaming the matches of (binary) shards as tabulated lines (rlocds_id_1, rlocds_id_2, coev_score, reconciliation_id),
+	e.g. to feed a postgres COPY without writing intermediary text files
+	"""
+	def __init__(self, lnfshards, reconciliation_id, batchsize=100000, verbose=False):
+		self.chunks = self._iterchunks(lnfshards, reconciliation_id, batchsize, verbose)
+		self.buffer = ''
+	
+	def _iterchunks(self, lnfshards, reconciliation_id, batchsize, verbose):
+		for nfshard in lnfshards:
+			if verbose: print nfshard
+			amatches = read_match_shard(nfshard)
+			for k in xrange(0, len(amatches), batchsize):
+				yield ''.join('%d\t%d\t%f\t%d\n'%(tgpcf+(reconciliation_id,)) for tgpcf in match_records2tuples(amatches[k:k+batchsize]))
+	
+	def read(self, size=-1):
+		while (size < 0) or (len(self.buffer) < size):
+			chunk = next(self.chunks, None)
+			if chunk is None: break
+			self.buffer += chunk
+		if size < 0: size = len(self.buffer)
+		data, self.buffer = self.buffer[:size], self.buffer[size:]
+		return data
+	
+	def readline(self):
+		while '\n' not in self.buffer:
+			chunk = next(self.chunks, None)
+			if chunk is None: break
+			self.buffer += chunk
+		i = self.buffer.find('\n') + 1
+		if not i: i = len(self.buffer)
+		data, self.buffer = self.buffer[:i], self.buffer[i:]
+		return data
+
+def shards_to_tab(lnfshards, nfoutrad, maxsize=1024**3):
+	"""convert (binary) shards into the tabulated text format"""
+	writer = MatchShardWriter(nfoutrad, maxsize=maxsize)
+	for nfshard in lnfshards:
+		amatches = read_match_shard(nfshard)
+		for k in xrange(0, len(amatches), writer.bufsize):
+			writer.write(match_records2tuples(amatches[k:k+writer.bufsize]))
+	writer.close()
+	return writer.lnfshards
+
+def shards_to_db(lnfshards, dbname, dbengine='sqlite', reconciliation_id=None, batchsize=100000, verbose=False):
+	"""load (binary) shards into the coevolution_scores table, replacing any previous records for the same reconciliation_id
+	
+	on postgres, matches are streamed through COPY; on sqlite, they are inserted by batches.
+	"""
+	from ptg_utils import get_dbconnection
+	dbcon, dbcur, dbtype, valtoken = get_dbconnection(dbname, dbengine)
+	table = 'phylogeny.coevolution_scores' if dbtype=='postgres' else 'coevolution_scores'
+	dbcur.execute("DELETE FROM %s WHERE reconciliation_id=%s;"%(table, valtoken), (reconciliation_id,))
+	if dbtype=='postgres':
+		fstream = MatchShardStream(lnfshards, reconciliation_id, batchsize=batchsize, verbose=verbose)
+		dbcur.copy_from(file=fstream, table=table, sep='\t', size=65536, columns=('rlocds_id_1', 'rlocds_id_2', 'coev_score', 'reconciliation_id'))
+		dbcon.commit()
+	else:
+		insreq = "INSERT INTO %s (rlocds_id_1, rlocds_id_2, coev_score, reconciliation_id) VALUES (%s);"%(table, ','.join([valtoken]*4))
+		for nfshard in lnfshards:
+			if verbose: print nfshard
+			amatches = read_match_shard(nfshard)
+			for k in xrange(0, len(amatches), batchsize):
+				dbcur.executemany(insreq, [tgpcf+(reconciliation_id,) for tgpcf in match_records2tuples(amatches[k:k+batchsize])])
+			dbcon.commit()
+	# distinct from the rlocds_id_pair_idx index on (rlocds_id_1, rlocds_id_2) of pantagruel_postgres_load_coevolution_scores.py,
+	# as scores from several reconciliation collections can be loaded here
+	dbcur.execute("CREATE UNIQUE INDEX IF NOT EXISTS rlocds_id_pair_reccol_idx ON %s (rlocds_id_1, rlocds_id_2, reconciliation_id);"%table)
+	dbcur.execute("CREATE INDEX IF NOT EXISTS coevscore_idx ON %s (coev_score);"%table)
+	dbcur.execute("CREATE INDEX IF NOT EXISTS reccolid_idx ON %s (reconciliation_id);"%table)
+	dbcon.commit()
+	dbcon.close()
+
+def main():
+	opts, args = getopt.getopt(sys.argv[1:], 'hv', ['dir_shards=', 'to_tab_dir=', 'to_sqlite_db=', 'to_postgresql_db=', 'reconciliation_id=', 'help', 'verbose'])
+	dopt = dict(opts)
+	if ('-h' in dopt) or ('--help' in dopt) or ('--dir_shards' not in dopt):
+		print usage()
+		sys.exit(0)
+	verbose = ('-v' in dopt) or ('--verbose' in dopt)
+	lnfshards = list(iter_match_shards(dopt['--dir_shards']))
+	if not lnfshards: raise ValueError, "no file matching '%s.*' in folder '%s'"%(binshardprefix, dopt['--dir_shards'])
+	if '--to_tab_dir' in dopt:
+		lnftab = shards_to_tab(lnfshards, os.path.join(dopt['--to_tab_dir'], tabshardprefix))
+		if verbose: print "converted %d binary shards into %d tabulated files"%(len(lnfshards), len(lnftab))
+	dbname = dopt.get('--to_sqlite_db', dopt.get('--to_postgresql_db'))
+	if dbname:
+		dbengine = 'sqlite' if ('--to_sqlite_db' in dopt) else 'postgres'
+		shards_to_db(lnfshards, dbname, dbengine, reconciliation_id=int(dopt.get('--reconciliation_id', 1)), verbose=verbose)
+
+def usage():
+	s = "Usage: python %s --dir_shards folder [--to_tab_dir dest] [--to_{sqlite|postgresql}_db dbname [--reconciliation_id N]]\n"%sys.argv[0]
+	s += "\t\t--dir_shards\tfolder containing the binary files '%s.*' written by compare_collapsedALE_scenarios.py --matches_format=bin\n"%binshardprefix
+	s += "\t\t--to_tab_dir\tconvert the binary files into tabulated files '%s.*' in this folder\n"%tabshardprefix
+	s += "\t\t--to_{sqlite|postgresql}_db\tload the matches into the coevolution_scores table of the database\n"
+	s += "\t\t--reconciliation_id\tid of the reconciliation collection the scores derive from (default: 1)\n"
+	return s
+
+if __name__=='__main__':
+	main()
@@ -0,0 +1,203 @@
+#!/usr/bin/python2.7
+# -*- coding: utf-8 -*-
+
+"""computation of co-evolution scores between gene lineages as products of a sparse lineage x event frequency matrix
+
+The co-evolution score of a pair of lineages (i, j) is the sum over their shared events of the product of
+their event frequencies, scaled by the square of the number of reconciliations in the sample,
+i.e. the (i, j) cell of M.M^T / nsample^2, where M is the lineage x event matrix of event frequencies.
+Lineages (matrix rows) are sorted by increasing lineage id (rlocds_id), so that the rule of only reporting
+pairs where the partner lineage id is greater than or equal to the query lineage id translates into j >= i.
+"""
+
+import os
+import numpy as np
+
+# arrays defining a matrix in CSR format, saved as separate .npy files to be memory-mapped
+csrarrays = ('data', 'indices', 'indptr')
+
+def lineage_event_matrix(lineageids, eventids, freqs):
+	"""build a sparse lineage x event matrix (in CSR format) from parallel arrays of (lineage id, event id, freq) values
+
+	return the matrix, the array of lineage ids corresponding to its rows (sorted) and that of event ids corresponding to its columns.
+	Frequencies of duplicate (lineage, event) entries are summed.
+	"""
+	# optional dependency, only required for this engine
+	from scipy import sparse
+	rowlineageids, rows = np.unique(lineageids, return_inverse=True)
+	coleventids, cols = np.unique(eventids, return_inverse=True)
+	M = sparse.coo_matrix((np.asarray(freqs, dtype=np.int64), (rows, cols)), shape=(len(rowlineageids), len(coleventids))).tocsr()
+	M.sum_duplicates()
+	return M, rowlineageids, coleventids
+
+def save_matrix(dirmat, M, famcodes, rowlineageids, candidates=None):
+	"""save the arrays of CSR matrix M, of its transpose and of the row annotations as .npy files in folder 'dirmat'
+
+	these can then be memory-mapped by any number of processes with load_matrix(), 
+	which share the pages of the files instead of each holding a copy of the matrix.
+	The (Mc, McT) pair of matrices restricted to candidate-defining events (see candidate_matrix()) can be saved along.
+	"""
+	lmat = [('M', M), ('MT', M.T.tocsr())]
+	if candidates:
+		lmat += [('Mc', candidates[0]), ('McT', candidates[1])]
+		np.save(os.path.join(dirmat, 'cshape.npy'), np.array(candidates[0].shape, dtype=np.int64))
+	for name, X in lmat:
+		for arr in csrarrays:
+			np.save(os.path.join(dirmat, '%s.%s.npy'%(name, arr)), getattr(X, arr))
+	np.save(os.path.join(dirmat, 'shape.npy'), np.array(M.shape, dtype=np.int64))
+	np.save(os.path.join(dirmat, 'famcodes.npy'), famcodes)
+	np.save(os.path.join(dirmat, 'rowlineageids.npy'), rowlineageids)
+
+def load_matrix(dirmat, mmap_mode='r'):
+	"""memory-map the matrix saved by save_matrix() in folder 'dirmat'
+	
+	return the matrix, its transpose, the family codes and the lineage ids of its rows, 
+	and the (Mc, McT) pair of candidate-defining matrices if saved (None otherwise).
+	"""
+	from scipy import sparse
+	def load(name):
+		return np.load(os.path.join(dirmat, '%s.npy'%name), mmap_mode=mmap_mode)
+	def loadcsr(name, shape):
+		return sparse.csr_matrix(tuple(load('%s.%s'%(name, arr)) for arr in csrarrays), shape=shape, copy=False)
+	shape = tuple(int(d) for d in load('shape'))
+	M = loadcsr('M', shape)
+	MT = loadcsr('MT', shape[::-1])
+	if os.path.exists(os.path.join(dirmat, 'cshape.npy')):
+		cshape = tuple(int(d) for d in load('cshape'))
+		candidates = (loadcsr('Mc', cshape), loadcsr('McT', cshape[::-1]))
+	else:
+		candidates = None
+	return M, MT, load('famcodes'), load('rowlineageids'), candidates
+
+def family_codes(rowlineageids, dlineagefam):
+	"""return an array of integer codes of the gene family of each matrix row"""
+	dfamcode = {}
+	return np.array([dfamcode.setdefault(dlineagefam[lineageid], len(dfamcode)) for lineageid in rowlineageids], dtype=np.int64)
+
+def scope_mask(famcodes, q, p, matchScope):
+	"""boolean mask of the (q, p) row pairs that are in the scope of the search"""
+	if matchScope=='between_fams':
+		return famcodes[q] != famcodes[p]
+	elif matchScope=='within_fams':
+		return famcodes[q] == famcodes[p]
+	elif matchScope=='all':
+		return np.ones(len(q), dtype=bool)
+	else:
+		raise ValueError, "incorrect value '%s' for variable 'matchScope'"%repr(matchScope)
+
+def coevol_block(M, MT, i0, i1, famcodes, nsamplesq, minevjointfreq, matchScope, candidates=None):
+	"""compute the co-evolution scores of query rows i0 to i1-1 against all rows
+
+	'MT' is the transpose of M, in CSR format (pre-computed once).
+	Return three arrays (query row, partner row, score), sorted by query row and then partner row,
+	only with pairs that share at least one event, where partner >= query, in the scope and with score >= minevjointfreq.
+	If 'candidates' is provided as a tuple (Mc, McT) of a matrix restricted to a subset of the events and its transpose
+	(see candidate_matrix()), only pairs sharing at least one of these events are considered, and then scored exactly over all their events.
+	"""
+	if candidates:
+		Mc, McT = candidates
+		S = Mc[i0:i1].dot(McT).tocoo()
+	else:
+		S = M[i0:i1].dot(MT).tocoo()
+	q = S.row.astype(np.int64) + i0
+	p = S.col.astype(np.int64)
+	keep = (p >= q) & scope_mask(famcodes, q, p, matchScope)
+	q = q[keep]
+	p = p[keep]
+	if candidates:
+		# exact re-score of the candidate pairs over all their shared events
+		jointfreqs = pair_jointfreqs(M, q, p)
+	else:
+		jointfreqs = S.data[keep]
+	# exact integer sum of products, only then scaled
+	scores = jointfreqs.astype(np.float64) / nsamplesq
+	keep = scores >= minevjointfreq
+	q = q[keep]
+	p = p[keep]
+	scores = scores[keep]
+	order = np.lexsort((p, q))
+	return q[order], p[order], scores[order]
+
+def pair_jointfreqs(M, q, p, chunksize=100000):
+	"""return the sums of the products of event frequencies (unscaled co-evolution scores) of the pairs of rows (q[k], p[k]) of matrix M"""
+	jointfreqs = np.zeros(len(q), dtype=np.int64)
+	for k0 in xrange(0, len(q), chunksize):
+		k1 = k0 + chunksize
+		jointfreqs[k0:k1] = np.asarray(M[q[k0:k1]].multiply(M[p[k0:k1]]).sum(axis=1)).ravel()
+	return jointfreqs
+
+def candidate_matrix(M, maxdegree):
+	"""restrict matrix M to its informative events, i.e. those shared by at most 'maxdegree' lineages
+	
+	these define the candidate pairs of lineages (see coevol_block()); very common events (like deep speciations 
+	or the origination at the root) connect almost all lineages and would make the number of pairs to score explode.
+	Return the restricted matrix, its transpose (both CSR) and the boolean mask of capped events (columns of M).
+	"""
+	capped = M.getnnz(axis=0) > maxdegree
+	Mc = M[:,np.flatnonzero(~capped)].tocsr()
+	return Mc, Mc.T.tocsr(), capped
+
+def capped_event_report(M, capped, nsamplesq):
+	"""bounds on the lineage pairs left out of the candidates because they only share capped events
+	
+	return the number of capped (lineage, event) entries, an upper bound of the number of skipped pairs (including self-matches
+	of lineages only having capped events)
+	and, for each lineage (matrix row), an upper bound of the score of its skipped pairs, i.e. the sum over its capped events 
+	of the product of its frequency by the maximum frequency of the event among all lineages.
+	"""
+	Mu = M[:,np.flatnonzero(capped)].tocsr()
+	degrees = Mu.getnnz(axis=0).astype(np.int64)
+	nrows = M.shape[0]
+	nonlyskipped = int(((M.getnnz(axis=1) > 0) & (M[:,np.flatnonzero(~capped)].getnnz(axis=1) == 0)).sum())
+	maxskipped = min(int((degrees*(degrees-1)//2).sum()), nrows*(nrows-1)//2) + nonlyskipped
+	maxfreqs = np.asarray(Mu.max(axis=0).todense()).ravel().astype(np.float64) if Mu.shape[1] else np.zeros(0)
+	scorebounds = Mu.dot(maxfreqs) / nsamplesq if Mu.shape[1] else np.zeros(nrows)
+	return Mu.nnz, maxskipped, scorebounds
+
+def iter_coevol_blocks(M, famcodes, nsamplesq, minevjointfreq, matchScope, blocksize=128, MT=None, rowrange=None, candidates=None):
+	"""yield the results of coevol_block() for successive blocks of 'blocksize' query rows (within 'rowrange', by default all rows)"""
+	if MT is None: MT = M.T.tocsr()
+	r0, r1 = rowrange if rowrange else (0, M.shape[0])
+	for i0 in xrange(r0, r1, blocksize):
+		yield coevol_block(M, MT, i0, min(i0+blocksize, r1), famcodes, nsamplesq, minevjointfreq, matchScope, candidates=candidates)
+
+def _topk_group_mask(groups, partners, scores, k):
+	"""boolean mask of the entries ranking among the k greatest (score, partner) tuples of their group"""
+	mask = np.zeros(len(groups), dtype=bool)
+	if len(groups)==0: return mask
+	order = np.lexsort((-partners, -scores, groups))
+	g = groups[order]
+	starts = np.concatenate(([0], np.flatnonzero(np.diff(g)) + 1))
+	ranks = np.arange(len(g)) - np.repeat(starts, np.diff(np.concatenate((starts, [len(g)]))))
+	mask[order[ranks < k]] = True
+	return mask
+
+def topk_block_mask(q, p, scores, k):
+	"""boolean mask of the pairs of a block that may be among the k best partners of either of their two lineages
+	
+	pairs not retained cannot make it to the top k of either lineage, as there are already k better pairs for both within the block
+	(ranking pairs by score, then by partner id, as in the bounded heaps of the top-k search); self-matches are always retained.
+	"""
+	selfm = (p == q)
+	nonself = np.flatnonzero(~selfm)
+	qn, pn, sn = q[nonself], p[nonself], scores[nonself]
+	mask = selfm.copy()
+	mask[nonself] = _topk_group_mask(qn, pn, sn, k) | _topk_group_mask(pn, qn, sn, k)
+	return mask
+
+def iter_worker_blocks(nrows, blocksize, workerid, nworkers):
+	"""yield the (i0, i1) row ranges of the blocks of 'blocksize' rows assigned to worker 'workerid' out of 'nworkers'
+
+	blocks are dealt in turn to workers, so that each worker gets a share of all parts of the matrix
+	(rows of lineages from the same family are contiguous, and some families are much more connected than others).
+	"""
+	for i0 in xrange(workerid*blocksize, nrows, nworkers*blocksize):
+		yield i0, min(i0+blocksize, nrows)
+
+def iter_query_matches(q, p, scores, rowlineageids):
+	"""split the sorted result arrays of coevol_block() by query row, yielding lists of (query lineage id, partner lineage id, score) tuples"""
+	if len(q)==0: return
+	bounds = np.flatnonzero(np.diff(q)) + 1
+	for k0, k1 in zip(np.concatenate(([0], bounds)), np.concatenate((bounds, [len(q)]))):
+		qid = int(rowlineageids[q[k0]])
+		yield [(qid, int(pid), float(sc)) for pid, sc in zip(rowlineageids[p[k0:k1]], scores[k0:k1])]
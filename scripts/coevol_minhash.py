@@ -0,0 +1,112 @@
+#!/usr/bin/python2.7
+# -*- coding: utf-8 -*-
+
+"""approximate search of co-evolved gene lineages by weighted MinHash sketches and locality-sensitive hashing (LSH)
+
+The weighted event set of a lineage is encoded as a set of tokens: an event of frequency f gives the tokens (event, 1) ... (event, l),
+where l is f quantized into 'nlevels' levels of the number of sampled reconciliations, so that the Jaccard similarity of token sets
+approximates the weighted Jaccard similarity of the event frequency profiles.
+The MinHash sketches of lineages are cut into bands; lineages with identical sketches in any band collide,
+and only colliding pairs are scored exactly (with the same formula as coevol_score, over the lineage x event matrix of coevol_matrix module).
+"""
+
+import numpy as np
+import coevol_matrix
+
+def _mix64(x):
+	"""splitmix64 finaliser, a bijective mixing of uint64 arrays (overflows wrap around)"""
+	x = (x ^ (x >> np.uint64(30))) * np.uint64(0xbf58476d1ce4e5b9)
+	x = (x ^ (x >> np.uint64(27))) * np.uint64(0x94d049bb133111eb)
+	return x ^ (x >> np.uint64(31))
+
+def minhash_signatures(M, nsample, nhashes=128, nlevels=10, seed=0):
+	"""compute the weighted MinHash sketches of the rows of the lineage x event matrix M (CSR)
+
+	return a (number of rows x nhashes) uint64 array; rows without any event get the maximum value in all positions.
+	"""
+	nrows = M.shape[0]
+	rowlen = np.diff(M.indptr)
+	rows = np.repeat(np.arange(nrows), rowlen)
+	# quantized frequency levels, at least 1 for any observed event
+	levels = np.maximum(np.ceil(M.data * float(nlevels) / nsample).astype(np.int64), 1)
+	tokentry = np.repeat(np.arange(len(levels)), levels)
+	tokentrystart = np.concatenate(([0], np.cumsum(levels)[:-1]))
+	toklevel = np.arange(len(tokentry)) - tokentrystart[tokentry]
+	tokens = (M.indices[tokentry].astype(np.uint64) * np.uint64(levels.max() if len(levels) else 1)) + toklevel.astype(np.uint64)
+	tokrows = rows[tokentry]
+	nonempty = np.flatnonzero(rowlen > 0)
+	rowstarts = np.searchsorted(tokrows, nonempty)
+	sigs = np.empty((nrows, nhashes), dtype=np.uint64)
+	sigs.fill(np.iinfo(np.uint64).max)
+	seeds = _mix64(np.arange(1, nhashes+1, dtype=np.uint64) + np.uint64(seed))
+	for i in xrange(nhashes):
+		if len(tokens): sigs[nonempty, i] = np.minimum.reduceat(_mix64(tokens ^ seeds[i]), rowstarts)
+	return sigs
+
+def lsh_candidate_pairs(sigs, nbands, famcodes, matchScope, maxbucketsize=1000):
+	"""return the (q, p) arrays of row pairs with identical sketches in at least one band, with q <= p and in the scope of the search,
+	and the number of buckets of more than 'maxbucketsize' rows, which are not expanded into pairs
+	
+	'nbands' must divide the number of hashes in sketches. Self-pairs of rows with events are always included.
+	"""
+	nrows, nhashes = sigs.shape
+	if not (0 < nbands <= nhashes) or (nhashes % nbands):
+		raise ValueError, "the number of LSH bands (%d) must be a divisor of the number of hashes in sketches (%d)"%(nbands, nhashes)
+	bandsize = nhashes // nbands
+	nonempty = np.flatnonzero(sigs[:,0] != np.iinfo(np.uint64).max)
+	lpaircodes = [nonempty * nrows + nonempty]
+	noversized = 0
+	for b in xrange(nbands):
+		# hash the band of the sketch into a single bucket key
+		key = np.zeros(len(nonempty), dtype=np.uint64) + np.uint64(b)
+		for i in xrange(b*bandsize, (b+1)*bandsize):
+			key = _mix64(key ^ sigs[nonempty, i])
+		order = np.argsort(key, kind='mergesort')
+		skey = key[order]
+		bounds = np.flatnonzero(np.diff(skey)) + 1
+		for k0, k1 in zip(np.concatenate(([0], bounds)), np.concatenate((bounds, [len(skey)]))):
+			if k1 - k0 < 2: continue
+			if k1 - k0 > maxbucketsize:
+				# e.g. lineages only sharing very common events; expanding would approach the all-vs-all comparison
+				noversized += 1
+				continue
+			members = np.sort(nonempty[order[k0:k1]])
+			iu, ju = np.triu_indices(k1 - k0, 1)
+			lpaircodes.append(members[iu] * nrows + members[ju])
+	# pairs colliding in several bands are only kept once
+	paircodes = np.unique(np.concatenate(lpaircodes))
+	q = paircodes // nrows
+	p = paircodes % nrows
+	keep = coevol_matrix.scope_mask(famcodes, q, p, matchScope)
+	return q[keep], p[keep], noversized
+
+def lsh_coevol(M, sigs, nbands, famcodes, nsamplesq, minevjointfreq, matchScope, maxbucketsize=1000):
+	"""score exactly the colliding pairs of lineages; return (query row, partner row, score) arrays sorted like those of coevol_matrix.coevol_block(),
+	and the number of oversized buckets that were skipped (see lsh_candidate_pairs())
+	"""
+	q, p, noversized = lsh_candidate_pairs(sigs, nbands, famcodes, matchScope, maxbucketsize=maxbucketsize)
+	jointfreqs = coevol_matrix.pair_jointfreqs(M, q, p)
+	scores = jointfreqs.astype(np.float64) / nsamplesq
+	# colliding pairs may not share any event
+	keep = (jointfreqs > 0) & (scores >= minevjointfreq)
+	return q[keep], p[keep], scores[keep], noversized
+
+def lsh_recall(M, samplerows, q, p, famcodes, nsamplesq, minevjointfreq, matchScope, topfrac=0.1):
+	"""evaluate the recall of approximate matches (q, p) against the exact matches involving the lineages (rows) in 'samplerows'
+
+	return the number of exact matches, the fraction of them found, and this fraction among the 'topfrac' best-scoring exact matches.
+	"""
+	MT = M.T.tocsr()
+	nrows = M.shape[0]
+	S = M[samplerows].dot(MT).tocoo()
+	eq = np.asarray(samplerows)[S.row]
+	ep = S.col.astype(np.int64)
+	escores = S.data.astype(np.float64) / nsamplesq
+	keep = (escores >= minevjointfreq) & coevol_matrix.scope_mask(famcodes, eq, ep, matchScope)
+	# canonical orientation of pairs, with duplicates when both lineages are in the sample
+	ecodes, first = np.unique(np.minimum(eq, ep)[keep] * nrows + np.maximum(eq, ep)[keep], return_index=True)
+	escores = escores[keep][first]
+	if len(ecodes)==0: return (0, 1.0, 1.0)
+	found = np.in1d(ecodes, q * nrows + p)
+	top = escores >= np.percentile(escores, 100.0*(1.0-topfrac))
+	return (len(ecodes), found.mean(), found[top].mean())
@@ -1,62 +1,80 @@
 #!/usr/bin/python2.7
 # -*- coding: utf-8 -*-
 
-cdef double coevol_score(lineage_matches, unsigned long nsamplesq):
-	cdef int f0, f1
-	cdef unsigned long jf = 0
-	cdef double jointfreq
-	for tmatch in lineage_matches:
-		f0 = tmatch[1]
-		f1 = tmatch[2]
-		jf += f0*f1
-	jointfreq = jf
-	return jointfreq/nsamplesq
+import numpy as np
 
-#~ cdef chop_array(currlineage_matches, keepfields, chunksize=1000):
-#~ 	cdef int tmatch_ff[2]
-#~ 	cdef list lmatch_ffs = []
-#~ 	for currlineage_match in currlineage_matches:
-#~ 		# make an array of C-type int array
-#~ 		tmatch_ff = currlineage_match[2:]
-#~ 		lmatch_ffs.append(tmatch_ff)
-#~ 	return lmatch_ffs
+cpdef coevol_partner_scores(long long[::1] partnerids, long long[::1] f0, long long[::1] f1, long long nsamplesq, double minevjointfreq, bint last=True):
+	"""compute the co-evolution scores of the partner lineages of a query from contiguous arrays of their shared event frequencies
 
-cpdef coevol_lineages(dbcur, lineage_id, int nsamplesq, double minevjointfreq, fetchsize=10000):
+	takes as input:
+	- partnerids, f0, f1, int64 arrays of partner lineage ids (sorted, i.e. grouped by partner) and of the frequencies
+	  of the shared event in the query and partner lineages
+	- nsamplesq, the square of the number of sampled reconciliation, to scale the product of event frequencies into a probability of the co-event
+	- minevjointfreq, the minimum observed co-evolution score ( = sum of co-event probabilities) to report a lineage pair
+	- last, whether these are the last rows for this query; if not, the segment of the last partner may be incomplete and is not scored
+	returns the arrays of partner ids and scores passing the threshold, and the number of rows used (i.e. the start of the unscored segment).
+	"""
+	cdef:
+		Py_ssize_t n = partnerids.shape[0], i, k0 = 0, nout = 0
+		long long jf = 0
+		double coev
+		long long[::1] outids
+		double[::1] outscores
+	aoutids = np.empty(n, dtype=np.int64)
+	aoutscores = np.empty(n, dtype=np.float64)
+	outids = aoutids
+	outscores = aoutscores
+	for i in range(n):
+		if partnerids[i] != partnerids[k0]:
+			# end of the current partner's segment
+			coev = (<double>jf)/nsamplesq
+			if coev >= minevjointfreq:
+				outids[nout] = partnerids[k0]
+				outscores[nout] = coev
+				nout += 1
+			k0 = i
+			jf = 0
+		jf += f0[i]*f1[i]
+	if n and last:
+		coev = (<double>jf)/nsamplesq
+		if coev >= minevjointfreq:
+			outids[nout] = partnerids[k0]
+			outscores[nout] = coev
+			nout += 1
+		k0 = n
+	return aoutids[:nout], aoutscores[:nout], k0
+
+def fetch_coevol_partner_scores(dbcur, long long nsamplesq, double minevjointfreq, fetchsize=100000):
+	"""fetch the rows of a query in large batches into arrays and score them with coevol_partner_scores()
+
+	dbcur is a db cursor returning tuples from a querry with all integer values (rclocds_id, freq0, freq1), ordered by rclocds_id;
+	the rows of the last partner of a batch are carried over to the next batch.
+	returns the arrays of partner ids and scores.
+	"""
+	lids, lscores = [], []
+	carry = np.zeros((3, 0), dtype=np.int64)
+	rows = dbcur.fetchmany(fetchsize)
+	while rows:
+		# one contiguous array per column
+		a = np.array(rows, dtype=np.int64).T.copy()
+		if carry.shape[1]: a = np.concatenate((carry, a), axis=1)
+		rows = dbcur.fetchmany(fetchsize)
+		ids, scores, k = coevol_partner_scores(a[0], a[1], a[2], nsamplesq, minevjointfreq, last=(not rows))
+		lids.append(ids)
+		lscores.append(scores)
+		carry = a[:,k:].copy()
+	if not lids: return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.float64)
+	return np.concatenate(lids), np.concatenate(lscores)
+
+def coevol_lineages(dbcur, lineage_id, long long nsamplesq, double minevjointfreq, fetchsize=100000):
 	"""generates a list of tuples containing pairs of lineage ids and the corresponding co-evolution score
-	
+
 	takes as input:
-	- dbcur, a db cursor returning tuples from a querry with all integer values (rclocds_id, event_id, freq0, freq1), ordered by rclocds_id
+	- dbcur, a db cursor returning tuples from a querry with all integer values (rclocds_id, freq0, freq1), ordered by rclocds_id
 	- lineage_id, the query lineage id
 	- nsamplesq, the square of the number of sampled reconciliation, to scale the product of event frequencies into a probability of the co-event
 	- minevjointfreq, the minimum observed co-evolution score ( = sum of co-event probabilities) to report a lineage pair
 	- fetchsize, (optional) the number of rows fetched at once from the database
 	"""
-	if dbcur.rowcount == 0: return []
-	cdef:
-		unsigned long match_lineage_id, currlineage_id
-		list  match_lineages, currlineage_matches = [], coevollineages = []
-		double coev
-	match_lineages = dbcur.fetchmany(fetchsize)
-	currlineage_id = match_lineages[0][0]
-	while match_lineages:
-		# seek boundaries of the lineage slices
-		for k, tmatch_line_ff in enumerate(match_lineages):
-			match_lineage_id = tmatch_line_ff[0]
-			if match_lineage_id != currlineage_id:
-				# finish parsing current lineage
-				currlineage_matches += match_lineages[:k]
-				# compute the lineages' co-evolution score
-				coev = coevol_score(currlineage_matches, nsamplesq)
-				if coev >= minevjointfreq: coevollineages.append( (lineage_id, currlineage_id, coev) )
-				# next lineage
-				currlineage_id = match_lineage_id
-				currlineage_matches = []
-				match_lineages = match_lineages[k:]
-				break
-		else:
-			currlineage_matches += match_lineages
-			match_lineages = dbcur.fetchmany(fetchsize)
-	else:
-		coev = coevol_score(currlineage_matches, nsamplesq)
-		if coev >= minevjointfreq: coevollineages.append( (lineage_id, currlineage_id, coev) )
-	return coevollineages
+	ids, scores = fetch_coevol_partner_scores(dbcur, nsamplesq, minevjointfreq, fetchsize=fetchsize)
+	return [(lineage_id, pid, coev) for pid, coev in zip(ids.tolist(), scores.tolist())]
@@ -1,11 +1,12 @@
 #!/usr/bin/python2.7
 # -*- coding: utf-8 -*-
 
-import os, sys, glob, getopt
+import os, sys, re, glob, getopt, tempfile, shutil
 import multiprocessing as mp
 import cPickle as pickle
 import shelve
 import itertools
+import heapq
 import gc
 import numpy as np
 from ptg_utils import *
@@ -14,6 +15,9 @@ import pyximport
 pyximport.install()
 #~ pyximport.install(pyimport=True) # cythonize all the python modules avalaible
 from coevol_score import coevol_lineages
+import coevol_matrix
+import coevol_minhash
+import coevol_io
 
 def _select_lineage_event_clause_factory(evtypes, lineagetable):
 	rlocdsIJ = "INNER JOIN %s USING (replacement_label_or_cds_code)"%lineagetable
@@ -22,7 +26,7 @@ def _select_lineage_event_clause_factory(evtypes, lineagetable):
 		if len(evtypes)>1: evtyperestrictWC = "AND event_type IN %s"%repr(tuple(e for e in evtypes))
 		else: evtyperestrictWC = "AND event_type='%s'"%evtypes
 	else:
-		evtyperestrictWC = evtyperestrict = ""
+		evtyperestrictWC = evtyperestrictIJ = ""
 	return (rlocdsIJ, evtyperestrictIJ, evtyperestrictWC)
 
 def _select_lineage_event_query_factory(aBYb, evtypes, valtoken, lineagetable, \
@@ -42,7 +46,132 @@ def _select_lineage_event_query_factory(aBYb, evtypes, valtoken, lineagetable, \
 				rlocdsIJ, evtyperestrictIJ, bIJ,
 				w, evtyperestrictWC, bWC, addWhereClause, ob)
 	preq = "SELECT %s %s FROM gene_lineage_events %s %s %s %s %s %s %s %s ;"%tqfields
-	return preq.replace('WHERE AND ', 'WHERE ')
+	return re.sub('WHERE +AND ', 'WHERE ', preq)
+
+def _select_lineage_event_table_query(evtypes, lineagetable, addWhereClause=''):
+	"""query of the (rlocds_id, event_id, freq) rows of all lineages at once"""
+	rlocdsIJ, evtyperestrictIJ, evtyperestrictWC = _select_lineage_event_clause_factory(evtypes, lineagetable)
+	w = 'WHERE' if (evtyperestrictWC or addWhereClause) else ''
+	preq = "SELECT rlocds_id, event_id, freq FROM gene_lineage_events %s %s %s %s %s ;"%(rlocdsIJ, evtyperestrictIJ, w, evtyperestrictWC, addWhereClause)
+	return re.sub('WHERE +AND ', 'WHERE ', preq)
+
+def _fetch_lineage_event_arrays(dbcur, preq, fetchsize=1000000):
+	"""return the (rlocds_id, event_id, freq) rows of a query as three integer arrays, fetched in large batches"""
+	dbcur.execute(preq)
+	lchunks = []
+	rows = dbcur.fetchmany(fetchsize)
+	while rows:
+		lchunks.append(np.array(rows, dtype=np.int64))
+		rows = dbcur.fetchmany(fetchsize)
+	a = np.concatenate(lchunks) if lchunks else np.zeros((0, 3), dtype=np.int64)
+	return a[:,0], a[:,1], a[:,2]
+
+class TopKPartners(object):
+	"""bounded heaps of the k best-scoring partners of every lineage
+	
+	each pair is to be offered once, as a (query id, partner id, score) triplet, and competes in the heaps of both lineages,
+	ranked by score, then by partner id; self-matches do not compete and are kept aside.
+	The retained pairs are the union of the top-k partners of all lineages, hence the result does not depend 
+	on which lineage of a pair was the query; memory use is O(number of lineages x k).
+	"""
+	def __init__(self, k):
+		self.k = k
+		self.dheaps = {}
+		self.dself = {}
+	
+	def _push(self, lineage_id, score, partner_id):
+		heap = self.dheaps.setdefault(lineage_id, [])
+		if len(heap) < self.k:
+			heapq.heappush(heap, (score, partner_id))
+		elif (score, partner_id) > heap[0]:
+			heapq.heapreplace(heap, (score, partner_id))
+	
+	def add(self, lm):
+		"""offer a list of (query id, partner id, score) triplets"""
+		for q, p, score in lm:
+			if p==q:
+				self.dself[q] = score
+			else:
+				self._push(q, score, p)
+				self._push(p, score, q)
+	
+	def update(self, other):
+		"""merge the heaps of another instance, fed with a disjoint set of pairs"""
+		self.dself.update(other.dself)
+		for lineage_id, heap in other.dheaps.iteritems():
+			for score, partner_id in heap:
+				self._push(lineage_id, score, partner_id)
+	
+	def itermatches(self):
+		"""yield lists of the retained (query id, partner id, score) triplets, with query id <= partner id, grouped by increasing query id"""
+		dpairs = dict(((lineage_id, lineage_id), score) for lineage_id, score in self.dself.iteritems())
+		for lineage_id, heap in self.dheaps.iteritems():
+			for score, partner_id in heap:
+				dpairs[(min(lineage_id, partner_id), max(lineage_id, partner_id))] = score
+		lm = []
+		for q, p in sorted(dpairs):
+			if lm and lm[-1][0]!=q:
+				yield lm
+				lm = []
+			lm.append( (q, p, dpairs[(q, p)]) )
+		if lm: yield lm
+
+def _iter_matrix_block_matches(M, MT, famcodes, rowlineageids, nsamplesq, minevjointfreq, matchScope, blocks, candidates=None, topk=None, donerows=None):
+	"""for each (i0, i1) block of query rows, yield the list of lists of match triplets by query lineage, and the array of ids of the query lineages
+	
+	query rows flagged in 'donerows' (a boolean array) are skipped; with 'topk', only pairs that may be in the top-k partners are yielded.
+	"""
+	for i0, i1 in blocks:
+		if donerows is not None and donerows[i0:i1].all(): continue
+		q, p, scores = coevol_matrix.coevol_block(M, MT, i0, i1, famcodes, nsamplesq, minevjointfreq, matchScope, candidates=candidates)
+		queryids = rowlineageids[i0:i1]
+		if donerows is not None:
+			keep = ~donerows[q]
+			q, p, scores = q[keep], p[keep], scores[keep]
+			queryids = queryids[~donerows[i0:i1]]
+		if topk:
+			keep = coevol_matrix.topk_block_mask(q, p, scores, topk)
+			q, p, scores = q[keep], p[keep], scores[keep]
+		yield list(coevol_matrix.iter_query_matches(q, p, scores, rowlineageids)), queryids
+
+def _coevol_matrix_worker(args):
+	"""compute the co-evolution scores of one worker's share of row blocks of the memory-mapped lineage x event matrix
+	
+	matches are written to the worker's own series of output shards '<nfoutrad>.<workerid>.<k>' (in the format set by 'binary' and 'compress',
+	see coevol_io module; not if 'nfoutrad' is None), or with 'topk', offered to the worker's own TopKPartners heaps;
+	with 'keepmatches', the (full-precision) match triplets are also returned as a list;
+	with 'journaldir', completed query lineages are recorded in the worker's own progress journal in this folder,
+	and with 'resume', the query lineages recorded as completed in the matrix folder are skipped.
+	return the worker id, the number of matches, the list of shard files, the top-k heaps (None if not 'topk') 
+	and the list of matches (None if not 'keepmatches').
+	"""
+	workerid, nworkers, dirmat, nfoutrad, binary, compress, nsamplesq, minevjointfreq, matchScope, blocksize, topk, keepmatches, journaldir, resume, verbose = args
+	M, MT, famcodes, rowlineageids, candidates = coevol_matrix.load_matrix(dirmat)
+	donerows = np.load(os.path.join(dirmat, 'donerows.npy'), mmap_mode='r') if resume else None
+	lmatches = [] if (keepmatches and not topk) else None
+	writer = None
+	if topk:
+		topkpartners = TopKPartners(topk)
+	else:
+		topkpartners = None
+	if nfoutrad and not topk:
+		nfjournal = os.path.join(journaldir, '%s.%d'%(coevol_io.journalprefix, workerid)) if journaldir else None
+		writer = coevol_io.MatchShardWriter('%s.%d'%(nfoutrad, workerid), binary=binary, compress=compress, nfjournal=nfjournal, resume=resume)
+	nmatch = 0
+	blocks = coevol_matrix.iter_worker_blocks(M.shape[0], blocksize, workerid, nworkers)
+	for llm, queryids in _iter_matrix_block_matches(M, MT, famcodes, rowlineageids, nsamplesq, minevjointfreq, matchScope, blocks, candidates, topk, donerows):
+		for lm in llm:
+			if topk: topkpartners.add(lm)
+			if writer: writer.write(lm)
+			if lmatches is not None: lmatches += lm
+			nmatch += len(lm)
+		if writer: writer.done(queryids.tolist())
+		if verbose: print "worker %d: scored %d query lineages, %d matches so far"%(workerid, len(queryids), nmatch) ; sys.stdout.flush()
+	if writer:
+		writer.close()
+		return (workerid, nmatch, writer.lnfshards, None, lmatches)
+	else:
+		return (workerid, nmatch, [], topkpartners, lmatches)
 
 def _query_create_temp_events_lineage(gene, preq, dbcur, temptablename):
 	creq = "CREATE TEMP TABLE %s AS "%temptablename + preq
@@ -60,78 +189,105 @@ def _query_events_lineage(gene, preq, dbcur, with_create_temp=None):
 def _query_events_lineage_sorted(gene, preq, dbcur, sortfield=0, with_create_temp=None):
 	return sorted(_query_events_lineage(gene, preq, dbcur, with_create_temp), key=lambda x: x[sortfield])
 
-def _query_matching_lineage_event_profiles(args, timing=False, verbose=False):
+# pragmas for the read-mostly access of SQLite databases by the query workers
+sqlitereadpragmas = ["PRAGMA temp_store=MEMORY;", "PRAGMA cache_size=-100000;", "PRAGMA mmap_size=1073741824;", "PRAGMA synchronous=OFF;"]
+# table of the events of the current query lineage, one per worker connection, emptied for each query
+queryeventtable = 'query_lineage_events'
+
+coevolQueryContext = {}
+
+def initCoevolQueryContext(context):
+	"""open the worker's connection to the database and prepare the texts of the queries, to be reused for all query lineages of this process
 	
-	if timing: time = __import__('time')
-	querylineageidfam, dbname, dbengine, nsample, evtypes, baseWC, diffamWC, minevjointfreq, lineagetable = args
-	querylineage_id, queryfam = querylineageidfam
-	if verbose: print 'querylineage_id:', querylineage_id, queryfam
-	dbcon, dbcul, dbtype, valtoken = get_dbconnection(dbname, dbengine)
+	'context' is a dict with keys: dbname, dbengine, evtypes, baseWC, matchScope, nsamplesq, minevjointfreq, lineagetable;
+	used as initializer of worker pools.
+	"""
+	closeCoevolQueryContext()
+	dbcon, dbcur, dbtype, valtoken = get_dbconnection(context['dbname'], context['dbengine'])
+	# no transaction to keep open, as only the worker's temporary table is modified
+	if dbtype=='sqlite':
+		dbcon.isolation_level = None
+		for pragma in sqlitereadpragmas: dbcur.execute(pragma)
+	else:
+		dbcon.autocommit = True
+	evtypes, lineagetable, baseWC = context['evtypes'], context['lineagetable'], context['baseWC']
+	dbcur.execute("CREATE TEMP TABLE %s (event_id INTEGER, f0 INTEGER);"%queryeventtable)
+	dbcur.execute("CREATE INDEX %s_event_id ON %s (event_id);"%(queryeventtable, queryeventtable))
 	# first get the vector of (event_id, freq) tuples in focal lineage
-	preq_evbyli = _select_lineage_event_query_factory(('event_id', 'rlocds_id'), \
-	                                                  evtypes, valtoken, lineagetable, \
-	                                                  addselcols=('freq as f0',), \
-	                                                  addWhereClause=baseWC)
-	if verbose: print preq_evbyli, (querylineage_id,)
-	tempeventtable = 'events_of_rlocds_id%d'%querylineage_id
-	#~ lineage_eventfreqs = _query_events_lineage_sorted(querylineage_id, preq_evbyli, dbcul, with_create_temp=tempeventtable)
-	_query_create_temp_events_lineage(querylineage_id, preq_evbyli, dbcul, tempeventtable)
-	#~ dlineage_eventfreqs = dict(lineage_eventfreqs)
-	#~ lineage_events = tuple(ef[0] for ef in lineage_eventfreqs)
-	#~ if not lineage_events: return []
-	#~ if verbose: print lineage_events
-	if dbcul.rowcount == 0:
-		# no events associated withthis lineage, return empty array
-		# -- this sort of pointless query should be avoided by
-		# not listing for query lineages without selectable events
-		# i.e. pre-filter input to this function call
-		return []
-	
+	reqfill = "INSERT INTO %s (event_id, f0) "%queryeventtable + \
+	          _select_lineage_event_query_factory(('event_id', 'rlocds_id'), evtypes, valtoken, lineagetable, \
+	                                              addselcols=('freq',), addWhereClause=baseWC)
 	# then build a list of gene lineages to compare, based on common occurence of at least N event (here only 1 common event required)
 	# and filtering by {same|different|all} gene families
-	famWC = diffamWC%queryfam if '%' in diffamWC else diffamWC
+	famWC = {'between_fams':" AND gene_family_id != %s"%valtoken, 'within_fams':" AND gene_family_id = %s"%valtoken, 'all':""}[context['matchScope']]
 	# and the id of compared lineage to be > reference lineage, to avoid duplicate comparisons
 	# or equal (for same-family scope mode), i.e. self-comparison, to evaluate the the maximum association score for this lineage
-	lineageorderWC=" AND rlocds_id >= %d"%querylineage_id
-	preq_libyev = _select_lineage_event_query_factory(('rlocds_id', 'event_id'), \
-	                                                  evtypes, valtoken, lineagetable, \
-	                                                  addselcols=('f0', 'freq as f1',), \
-	                                                  joinTable=tempeventtable, \
+	lineageorderWC = " AND rlocds_id >= %s"%valtoken
+	reqpartners = _select_lineage_event_query_factory(('rlocds_id', 'event_id'), evtypes, valtoken, lineagetable, \
+	                                                  addselcols=('f0', 'freq as f1',), joinTable=queryeventtable, \
 	                                                  addWhereClause=famWC+baseWC+lineageorderWC, orderBy='rlocds_id')
+	coevolQueryContext.update(context)
+	coevolQueryContext.update(dbcon=dbcon, dbcur=dbcur, famparam=bool(famWC), \
+	                          reqclear="DELETE FROM %s ;"%queryeventtable, reqfill=reqfill, reqpartners=reqpartners)
+
+def closeCoevolQueryContext():
+	if coevolQueryContext.get('dbcon'): coevolQueryContext['dbcon'].close()
+	coevolQueryContext.clear()
+
+def _query_matching_lineage_event_profiles(querylineageidfam, verbose=False):
+	"""return the query lineage id and the list of (query lineage id, partner lineage id, score) triplets of its matches
 	
-	if verbose: print preq_libyev
-	dbcul.execute(preq_libyev) 
-	nsamplesq = nsample**2
-	coevollineages = coevol_lineages(dbcul, querylineage_id, nsamplesq, minevjointfreq)
-	
-	dbcul.execute("drop table %s ;"%tempeventtable)
-	dbcon.close()
+	uses the connection and queries of the process-wide context set by initCoevolQueryContext().
+	"""
+	querylineage_id, queryfam = querylineageidfam
+	if verbose: print 'querylineage_id:', querylineage_id, queryfam
+	dbcur = coevolQueryContext['dbcur']
+	dbcur.execute(coevolQueryContext['reqclear'])
+	dbcur.execute(coevolQueryContext['reqfill'], (querylineage_id,))
+	if dbcur.rowcount == 0:
+		# no events associated withthis lineage, return empty array
+		return (querylineage_id, [])
+	params = ((queryfam,) if coevolQueryContext['famparam'] else ()) + (querylineage_id,)
+	dbcur.execute(coevolQueryContext['reqpartners'], params)
+	coevollineages = coevol_lineages(dbcur, querylineage_id, coevolQueryContext['nsamplesq'], coevolQueryContext['minevjointfreq'])
 	if verbose: print coevollineages
-	return coevollineages
+	return (querylineage_id, coevollineages)
 
 def dbquery_matching_lineage_event_profiles(dbname, dbengine='postgres', \
                                             genefamlist=None, exclRecSpeBranches=[], matchScope='between_fams', \
                                             nsample=1.0, evtypes=None, mineventfreq=0.0, maxeventfreq=1.0, minevjointfreq=0.0, \
                                             matchesOutDirRad=None, nfpickleMatchesOut=None, returnList=False, \
-                                            nbthreads=1, verbose=False, **kw):
+                                            engine='sql', blocksize=128, nbthreads=1, verbose=False, **kw):
+	"""compute co-evolution scores between gene lineages, i.e. the (scaled) sum of the products of the frequencies of their shared events
+	
+	with engine='sql' (default), partner lineages and their shared events are queried from the database lineage by lineage;
+	with engine='matrix', the filtered table of lineage event frequencies is loaded at once in a sparse lineage x event matrix 
+	and scores are computed as products of blocks of 'blocksize' rows of this matrix with its transpose (see coevol_matrix module).
+	Both yield the same (query lineage id, partner lineage id, score) triplets.
+	With engine='matrix' and nbthreads > 1, the matrix is saved once to files in folder 'mmapDir' (by default a temporary folder
+	in the output folder; e.g. /dev/shm to keep it in shared memory), which are memory-mapped by the workers;
+	each worker scores its own share of row blocks and writes its matches to its own series of output shards.
+	With 'topk', only the pairs among the 'topk' best-scoring partners of either of their lineages are reported 
+	(see TopKPartners class), once all scores have been computed.
+	With engine='matrix' and 'maxeventdegree', candidate pairs of lineages are only generated through the events shared 
+	by at most 'maxeventdegree' lineages (or this fraction of all lineages, if < 1), and then scored exactly over all their events;
+	the number of pairs skipped for only sharing more common events, and an upper bound of their score, are reported.
+	With engine='minhash', the search is approximate: only the pairs of lineages with colliding weighted MinHash sketches 
+	(of 'minhashsize' hashes over event frequencies quantized in 'minhashlevels' levels, cut into 'lshbands' bands) 
+	are scored, exactly (see coevol_minhash module); the recall of exact matches is estimated on 'recallsample' random lineages.
+	When writing matches to 'matchesOutDirRad' with the 'sql' or 'matrix' engines (and without 'topk'), completed query lineages 
+	are recorded in progress journals along with each completed output shard (see coevol_io.MatchShardWriter);
+	with 'resume', shards that were not completed are discarded, query lineages recorded as completed are skipped
+	and the series of output shards is continued.
+	In the main process, matches are formatted and written by a background thread fed through a bounded queue (see coevol_io.AsyncMatchWriter).
+	"""
 	
-	def output_match_line(lm, lmatches, fout, nfoutrad, kfout, foutMaxSize=1024**3):
-		# check if output file max size has been reached
-		if fout: 
-			foutsize = fout.tell()
-			if foutsize >= foutMaxSize:
-				fout.close()
-				kfout +=1
-				fout = open(nfoutrad+'.%d'%kfout, 'w')
+	def output_match_line(lm, lmatches, writer):
 		if (nfpickleMatchesOut or returnList): lmatches += lm
-		if matchesOutDirRad or verbose:
-			for tgpcf in lm:
-				matchline = '%d\t%d\t%f\n'%tgpcf
-				if fout: fout.write(matchline)
-			if verbose:
-				print len(lm), 'matches'
-				sys.stdout.flush()
-		return (fout, kfout)
+		if writer: writer.write(lm)
+		if verbose:
+			print len(lm), 'matches'
+			sys.stdout.flush()
 	
 	timing = kw.get('timing')
 	if timing: time = __import__('time')							
@@ -164,18 +320,12 @@ def dbquery_matching_lineage_event_profiles(dbname, dbengine='postgres', \
 	minevfWC = " AND gene_lineage_events.freq >= %d"%int(mineventfreq*nsample) if mineventfreq>0 else ''
 	maxevfWC = " AND gene_lineage_events.freq  < %d"%int(maxeventfreq*nsample) if maxeventfreq<1 else ''
 	baseWC = minevfWC+maxevfWC
-	if matchScope=='between_fams':
-		diffamWC = " AND gene_family_id != '%s'" # %fam to plugged in in child function call
-	elif matchScope=='within_fams':
-		diffamWC = " AND gene_family_id = '%s'" # %fam to plugged in in child function call
-	elif matchScope=='all':
-		diffamWC = ""
-	else:
+	if matchScope not in ['between_fams', 'within_fams', 'all']:
 		raise ValueError, "incorrect value '%s' for variable 'matchScope'"%repr(matchScope)
-	def make_arg_tup(lineage_id):
-		#~ return (lineage_id, dbname, dbengine, nsample, evtypes, matchScope, mineventfreq, maxeventfreq, minevjointfreq, lineagetable)
-		return (lineage_id, dbname, dbengine, nsample, evtypes, baseWC, diffamWC, minevjointfreq, lineagetable)
-		
+	# arguments shared by the by-lineage queries of the 'sql' engine
+	querycontext = dict(dbname=dbname, dbengine=dbengine, evtypes=evtypes, baseWC=baseWC, matchScope=matchScope, \
+	                    nsamplesq=nsamplesq, minevjointfreq=minevjointfreq, lineagetable=lineagetable)
+	
 	# get set of gene lineages
 	qlibyev = "SELECT rlocds_id, gene_family_id FROM %s;"%lineagetable
 	if verbose: print qlibyev
@@ -183,34 +333,147 @@ def dbquery_matching_lineage_event_profiles(dbname, dbengine='postgres', \
 	ltlineageidfams = dbcur.fetchall()
 				
 	
+	# output shard format
+	binary = kw.get('binaryOut', False)
+	compress = kw.get('compressOut', False)
+	shardprefix = coevol_io.binshardprefix if binary else coevol_io.tabshardprefix
 	if matchesOutDirRad:
-		nfoutrad = os.path.join(matchesOutDirRad, 'matching_events.tab')
-		kfout = 0
-		fout = open(nfoutrad+'.%d'%kfout, 'w')
+		nfoutrad = os.path.join(matchesOutDirRad, shardprefix)
 	else:
-		kfout = nfoutrad = fout = None
+		nfoutrad = None
+	parallelmatrix = (engine=='matrix' and nbthreads>1)
+	topk = kw.get('topk')
+	resume = kw.get('resume')
+	# progress journals are only meaningful when matches are written as they are computed
+	journal = bool(matchesOutDirRad) and not topk and engine!='minhash'
+	if resume and not journal:
+		raise ValueError, "resuming ('resume') requires to write matches to 'matchesOutDirRad', with engine='sql' or 'matrix' and without 'topk'"
+	doneids = set()
+	if resume:
+		lnfdiscard = coevol_io.discard_uncommitted_shards(matchesOutDirRad, shardprefix)
+		doneids = coevol_io.read_journal_ids(matchesOutDirRad)
+		print "resuming: %d query lineages already completed; discarded %d uncompleted output files"%(len(doneids), len(lnfdiscard))
+	elif journal:
+		# start afresh
+		for nfjournal in glob.glob(os.path.join(matchesOutDirRad, coevol_io.journalprefix+'*')): os.remove(nfjournal)
+	if matchesOutDirRad and not parallelmatrix:
+		nfjournal = os.path.join(matchesOutDirRad, coevol_io.journalprefix) if journal else None
+		# formatting and writing of matches overlap with their computation
+		writer = coevol_io.AsyncMatchWriter(nfoutrad, verbose=verbose, binary=binary, compress=compress, nfjournal=nfjournal, resume=resume)
+	else:
+		writer = None
 	lmatches = []
-	if nbthreads==1:
+	maxeventdegree = kw.get('maxeventdegree')
+	if maxeventdegree and engine!='matrix':
+		raise ValueError, "capping the degree of events for candidate pair generation ('maxeventdegree') requires engine='matrix'"
+	topkpartners = TopKPartners(topk) if topk else None
+	if topk:
+		# matches are only output at the end, from the top-k heaps
+		def collect_match_line(lm, lmatches, writer):
+			topkpartners.add(lm)
+	else:
+		collect_match_line = output_match_line
+	if engine in ('matrix', 'minhash'):
+		# load the whole filtered lineage x event frequency table at once into a sparse matrix
+		preq = _select_lineage_event_table_query(evtypes, lineagetable, addWhereClause=baseWC)
+		if verbose: print preq
+		lineageids, eventids, freqs = _fetch_lineage_event_arrays(dbcur, preq)
+		M, rowlineageids, coleventids = coevol_matrix.lineage_event_matrix(lineageids, eventids, freqs)
+		del lineageids, eventids, freqs
+		famcodes = coevol_matrix.family_codes(rowlineageids, dict(ltlineageidfams))
+		if verbose: print "loaded matrix of %d lineages x %d events (%d non-zero frequencies)"%(M.shape+(M.nnz,))
+		# same scaling as in coevol_score.coevol_lineages()
+		nsamplesq = int(nsample**2)
+		if maxeventdegree:
+			# inverted event -> lineages index: only generate candidate pairs through informative events
+			if maxeventdegree < 1: maxeventdegree = int(maxeventdegree*M.shape[0])
+			Mc, McT, capped = coevol_matrix.candidate_matrix(M, maxeventdegree)
+			candidates = (Mc, McT)
+			ncappedentries, maxskipped, scorebounds = coevol_matrix.capped_event_report(M, capped, nsamplesq)
+			print "capped %d events shared by more than %d lineages (%d lineage event frequencies out of %d are not used to find candidate pairs)"%(capped.sum(), maxeventdegree, ncappedentries, M.nnz)
+			print "skipped at most %d lineage pairs only sharing capped events, with a co-evolution score of at most %f"%(maxskipped, scorebounds.max() if len(scorebounds) else 0.0)
+			print "%d lineages may have skipped pairs with score >= min_joint_freq=%f"%(((scorebounds > 0) & (scorebounds >= minevjointfreq)).sum(), minevjointfreq)
+		else:
+			candidates = None
+		donerows = np.in1d(rowlineageids, list(doneids)) if resume else None
+		if engine=='minhash':
+			sigs = coevol_minhash.minhash_signatures(M, nsample, nhashes=kw.get('minhashsize', 128), nlevels=kw.get('minhashlevels', 10))
+			q, p, scores, noversized = coevol_minhash.lsh_coevol(M, sigs, kw.get('lshbands', 32), famcodes, nsamplesq, minevjointfreq, matchScope, \
+			                                                     maxbucketsize=kw.get('lshmaxbucket', 1000))
+			if noversized: print "Warning: %d LSH buckets of more than %d lineages were not searched for pairs"%(noversized, kw.get('lshmaxbucket', 1000))
+			if verbose: print "found %d matches among colliding pairs of lineages"%len(q)
+			recallsample = kw.get('recallsample')
+			if recallsample:
+				samplerows = np.random.RandomState(0).choice(M.shape[0], min(recallsample, M.shape[0]), replace=False)
+				nexact, recall, recalltop = coevol_minhash.lsh_recall(M, samplerows, q, p, famcodes, nsamplesq, minevjointfreq, matchScope)
+				print "recall of the %d exact matches of %d sampled lineages: %f; among the 10%% best-scoring: %f"%(nexact, len(samplerows), recall, recalltop)
+			if topk:
+				keep = coevol_matrix.topk_block_mask(q, p, scores, topk)
+				q, p, scores = q[keep], p[keep], scores[keep]
+			for lm in coevol_matrix.iter_query_matches(q, p, scores, rowlineageids):
+				collect_match_line(lm, lmatches, writer)
+		elif parallelmatrix:
+			# save the matrix to files to be memory-mapped by the workers, and free it from this process before forking them
+			dirmat = tempfile.mkdtemp(prefix='lineage_event_matrix.', dir=(kw.get('mmapDir') or matchesOutDirRad))
+			coevol_matrix.save_matrix(dirmat, M, famcodes, rowlineageids, candidates=candidates)
+			if resume: np.save(os.path.join(dirmat, 'donerows.npy'), donerows)
+			del M, famcodes, rowlineageids, candidates, donerows
+			gc.collect()
+			# matches to be returned are sent back by the workers at full precision, rather than read back from the (binary, float32) shards
+			keepmatches = bool(nfpickleMatchesOut or returnList)
+			iterargs = ((workerid, nbthreads, dirmat, nfoutrad, binary, compress, nsamplesq, minevjointfreq, matchScope, blocksize, topk, keepmatches, \
+			             (matchesOutDirRad if journal else None), resume, max(verbose-1, 0)) for workerid in range(nbthreads))
+			pool = mp.Pool(processes=nbthreads)
+			# do not leave the matrix files behind if a worker fails
+			try:
+				for workerid, nmatch, lnfshards, workertopk, workermatches in pool.imap_unordered(_coevol_matrix_worker, iterargs):
+					if verbose: print "worker %d completed: %d matches written to %d shards"%(workerid, nmatch, len(lnfshards))
+					if topk: topkpartners.update(workertopk)
+					elif workermatches: lmatches += workermatches
+				pool.close()
+				pool.join()
+			finally:
+				pool.terminate()
+				shutil.rmtree(dirmat)
+		else:
+			blocks = coevol_matrix.iter_worker_blocks(M.shape[0], blocksize, 0, 1)
+			for llm, queryids in _iter_matrix_block_matches(M, M.T.tocsr(), famcodes, rowlineageids, nsamplesq, minevjointfreq, matchScope, blocks, candidates, topk, donerows):
+				for lm in llm:
+					collect_match_line(lm, lmatches, writer)
+				if writer: writer.done(queryids.tolist())
+	elif nbthreads==1:
+		initCoevolQueryContext(querycontext)
 		for i, tlineageidfam in enumerate(ltlineageidfams):
-			lm = _query_matching_lineage_event_profiles(make_arg_tup(tlineageidfam), verbose=max(verbose-1, 0))
-			fout, kfout = output_match_line(lm, lmatches, fout, nfoutrad, kfout)
+			if tlineageidfam[0] in doneids: continue
+			querylineage_id, lm = _query_matching_lineage_event_profiles(tlineageidfam, verbose=max(verbose-1, 0))
+			collect_match_line(lm, lmatches, writer)
+			if writer: writer.done([querylineage_id])
 			if verbose: sys.stdout.write("\r%d\t"%i)
+		closeCoevolQueryContext()
 	else:
-		pool = mp.Pool(processes=nbthreads)
-		iterargs = (make_arg_tup(tlineageidfam) for tlineageidfam in ltlineageidfams)
-		iterlm = pool.imap_unordered(_query_matching_lineage_event_profiles, iterargs, chunksize=1)
+		# each worker keeps its own connection and temporary table for all its query lineages
+		pool = mp.Pool(processes=nbthreads, initializer=initCoevolQueryContext, initargs=(querycontext,))
+		iterargs = (tlineageidfam for tlineageidfam in ltlineageidfams if tlineageidfam[0] not in doneids)
+		iterlm = pool.imap_unordered(_query_matching_lineage_event_profiles, iterargs, chunksize=8)
 		# an iterator is returned by imap_unordered(); one needs to actually iterate over it to have the pool of parrallel workers to compute
-		for lm in iterlm:
-			fout, kfout = output_match_line(lm, lmatches, fout, nfoutrad, kfout)
+		for querylineage_id, lm in iterlm:
+			collect_match_line(lm, lmatches, writer)
+			if writer: writer.done([querylineage_id])
 	
+	if topk:
+		if parallelmatrix and matchesOutDirRad:
+			writer = coevol_io.AsyncMatchWriter(nfoutrad, verbose=verbose, binary=binary, compress=compress)
+		for lm in topkpartners.itermatches():
+			output_match_line(lm, lmatches, writer)
+
 	if nfpickleMatchesOut:
 		with open(nfpickleMatchesOut, 'wb') as fpickleOut:
 			pickle.dump(lmatches, fpickleOut, protocol=pickle.HIGHEST_PROTOCOL)
 			# can be a more efficient option for disk space than a simple table,
 			# but the required writing time and the accumulated memory space might make it redibitory
 		print "saved 'lmatches' to file '%s'"%nfpickleMatchesOut
-	if matchesOutDirRad:
-		fout.close()
+	if writer:
+		writer.close()
 	dbcon.close()
 	if returnList:
 		return lmatches
@@ -226,7 +489,9 @@ def main():
 	                                                'exclude_species_tree_branches=', 'event_type=', 'min_freq=', 'max_freq=', 'min_joint_freq=', 'match_scope=', \
 	                                                'genefams=', 'dir_constraints=', 'dir_replaced=', \
 	                                                'events_from_pickle=', 'events_from_shelve=', 'events_from_postgresql_db=', 'events_from_sqlite_db=', \
-	                                                'matches_to_shelve=', 'dir_table_out=', \
+	                                                'matches_to_shelve=', 'dir_table_out=', 'engine=', 'block_size=', 'mmap_dir=', 'top_k=', 'max_event_degree=', \
+	                                                'minhash_size=', 'minhash_levels=', 'lsh_bands=', 'lsh_max_bucket=', 'recall_sample=', \
+	                                                'matches_format=', 'compress_out', 'resume', \
 	                                                'threads=', 'help', 'verbose=']) #, 'reuse=', 'max.recursion.limit=', 'logfile='
 	dopt = dict(opts)
 	
@@ -262,7 +527,7 @@ def main():
 	# other params
 	
 	# normalization factor (and max per lineage) of observed event frequencies
-	nrecsample = dopt.get('--nrec_per_sample', 1000.0)
+	nrecsample = float(dopt.get('--nrec_per_sample', 1000.0))
 	# facultative input files
 	nfgenefamlist = dopt.get('--genefams')
 	dircons = dopt.get('--dir_constraints')
@@ -278,6 +543,23 @@ def main():
 	nbthreads = int(dopt.get('--threads', dopt.get('-T', -1)))
 	if nbthreads < 1: nbthreads = mp.cpu_count()
 	verbose = int(dopt.get('--verbose', dopt.get('-v', 0)))
+	engine = dopt.get('--engine', 'sql')
+	if engine not in ['sql', 'matrix', 'minhash']:
+		raise ValueError, "valid values for --engine argument are: 'sql', 'matrix', 'minhash'"
+	blocksize = int(dopt.get('--block_size', 128))
+	mmapDir = dopt.get('--mmap_dir')
+	topk = int(dopt.get('--top_k', 0))
+	maxeventdegree = float(dopt.get('--max_event_degree', 0))
+	minhashsize = int(dopt.get('--minhash_size', 128))
+	minhashlevels = int(dopt.get('--minhash_levels', 10))
+	lshbands = int(dopt.get('--lsh_bands', 32))
+	lshmaxbucket = int(dopt.get('--lsh_max_bucket', 1000))
+	recallsample = int(dopt.get('--recall_sample', 0))
+	matchesFormat = dopt.get('--matches_format', 'tab')
+	if matchesFormat not in ['tab', 'bin']:
+		raise ValueError, "valid values for --matches_format argument are: 'tab', 'bin'"
+	compressOut = ('--compress_out' in dopt)
+	resume = ('--resume' in dopt)
 	
 	if dirTableOut:
 		ltd = ['gene_lineage_assocations']
@@ -300,6 +582,9 @@ def main():
                          evtypes=recordEvTypes, exclRecSpeBranches=exclRecSpeBranches, matchScope=matchScope, \
                          mineventfreq=minFreqReport, maxeventfreq=maxFreqReport, minevjointfreq=minJointFreqReport, \
                          nfpickleMatchesOut=nfpickleMatchesOut, nfshelveMatchesOut=nfshelveMatchesOut, matchesOutDirRad=matchesOutDirRad, \
+                         engine=engine, blocksize=blocksize, mmapDir=mmapDir, topk=topk, maxeventdegree=maxeventdegree, \
+                         minhashsize=minhashsize, minhashlevels=minhashlevels, lshbands=lshbands, lshmaxbucket=lshmaxbucket, recallsample=recallsample, \
+                         binaryOut=(matchesFormat=='bin'), compressOut=compressOut, resume=resume, \
                          nbthreads=nbthreads, verbose=verbose)
 
 def usage():
@@ -315,6 +600,35 @@ def usage():
 	s += "\t\t\t\t- within or between gene families only, or both. Between families is the default behaviour;\n"
 	s += "\t\t\t\t- within_families can be chosen to allow to cluster closely related lineages with significantly shared ancestry within families\n"
 	s += "\t\t\t\t  and to restrict accordingly the search for matches between families\n."
+	s += "\t\t--engine={'sql'|'matrix'|'minhash'} how co-evolution scores are computed:\n"
+	s += "\t\t\t\t- 'sql' (default): partner lineages are queried from the database lineage by lineage;\n"
+	s += "\t\t\t\t- 'matrix': events of all lineages are loaded at once in a sparse matrix (requires scipy)\n"
+	s += "\t\t\t\t  and scores are obtained by blocked sparse matrix products; yields the same results.\n"
+	s += "\t\t\t\t- 'minhash': approximate search, only scoring the pairs of lineages with similar weighted MinHash sketches\n"
+	s += "\t\t\t\t  of their event frequency profiles, found by locality-sensitive hashing (LSH); for fast exploratory runs.\n"
+	s += "\t\t--block_size\tnumber of query lineages (matrix rows) scored at once with the 'matrix' engine (default: 128).\n"
+	s += "\t\t--mmap_dir\tfolder where the matrix is saved to be memory-mapped by the parallel workers of the 'matrix' engine\n"
+	s += "\t\t\t\t(default: the output folder); a shared-memory file system like /dev/shm avoids disk reads.\n"
+	s += "\t\t\t\tWith --threads > 1, each worker writes its matches to its own files 'matching_events.tab.<worker>.<k>'.\n"
+	s += "\t\t--top_k\tonly report pairs of lineages where either is among the k best-scoring partners of the other\n"
+	s += "\t\t\t\t(among pairs passing --min_joint_freq); each pair is reported once, with the lower lineage id first.\n"
+	s += "\t\t--max_event_degree\t(with 'matrix' engine) only search for pairs of lineages sharing at least one event that is shared\n"
+	s += "\t\t\t\tby at most this number of lineages (or this fraction of all lineages if < 1); pairs found are scored over all their events.\n"
+	s += "\t\t\t\tThe number of skipped pairs and the maximum score they could have reached are reported.\n"
+	s += "\t\t--minhash_size\t(with 'minhash' engine) number of hash functions in lineage sketches (default: 128).\n"
+	s += "\t\t--minhash_levels\t(with 'minhash' engine) number of levels in which event frequencies are quantized (default: 10).\n"
+	s += "\t\t--lsh_bands\t(with 'minhash' engine) number of bands sketches are cut into; more bands find more pairs of lower similarity;\n"
+	s += "\t\t\t\tmust be a divisor of --minhash_size (default: 32).\n"
+	s += "\t\t--lsh_max_bucket\t(with 'minhash' engine) maximum number of lineages in a bucket of identical sketch bands for its pairs to be scored;\n"
+	s += "\t\t\t\tlarger buckets are skipped and reported (default: 1000).\n"
+	s += "\t\t--matches_format={'tab'|'bin'} format of the output files of matches: tabulated text files 'matching_events.tab.<k>' (default)\n"
+	s += "\t\t\t\tor binary files 'matching_events.bin.<k>' of fixed-width (uint32, uint32, float32) records, that can be memory-mapped\n"
+	s += "\t\t\t\tand converted to the tabulated format or loaded into the database with coevol_io.py.\n"
+	s += "\t\t--compress_out\tgzip-compress the output files of matches.\n"
+	s += "\t\t--resume\tresume an interrupted computation writing to the same --dir_table_out: query lineages recorded as completed\n"
+	s += "\t\t\t\tin the progress journals of the output folder are skipped and the series of output files is continued\n"
+	s += "\t\t\t\t(not compatible with --top_k or --engine=minhash).\n"
+	s += "\t\t--recall_sample\t(with 'minhash' engine) number of random lineages for which exact matches are computed to report the recall (default: 0).\n"
 	return s
 
 ################## Main execution
@@ -1,7 +1,17 @@
 #!/usr/bin/python2.7
 import sys, getopt
 import multiprocessing as mp
-from ptg_utils import get_dbconnection, mean, quantile
+import numpy as np
+from ptg_utils import get_dbconnection, mean, quantile, group_best_hits, group_means, group_quantiles
+
+qbreaks = [0, 0.25, 0.5, 0.75, 1]
+
+def OGpairStats(tfamog1, tfamog2, llt, llbh):
+	"""output row for a pair of (fam, OG) groups: number of lineage co-evolution scores, number of lineages with a best hit, mean and quantiles of best-hit scores
+	
+	'llbh' is the list (or array) of best-hit scores.
+	"""
+	return tfamog1+tfamog2+(llt, len(llbh), mean(llbh))+(quantile(llbh, qbreaks) or (None,)*len(qbreaks))
 
 def retrieveIG2OGscores(args):
 	qogogsc, ltfamog, i, dbname, dbengine, withinfam, verbose = args
@@ -19,7 +29,7 @@ def retrieveIG2OGscores(args):
 			else:
 				continue
 		## fetch the coevolution scores between two fam_OG groups
-		dbcuf.execute(qogogsc, (tfamog1+tfamog2)*2)
+		dbcuf.execute(q, (tfamog1+tfamog2)*2)
 		ltscores = dbcuf.fetchall()
 		llt = len(ltscores)
 		if llt==0:
@@ -58,29 +68,110 @@ def retrieveIG2OGscores(args):
 		
 		# implementation 2: keep each lineage's best hit
 		# unbiased but do not ensure bidirectionality; however bidirectional hits are given double weight
-		dlbh = {}
+		ascores = np.array(ltscores, dtype=np.float64)
+		lineages = np.concatenate((ascores[:,0], ascores[:,1]))
+		best = group_best_hits(np.zeros(len(lineages), dtype=np.int64), lineages, np.concatenate((ascores[:,2], ascores[:,2])))[1]
 		#~ dtlbh = {}
-		for tscore in ltscores:
-			coev = float(tscore[2])
-			for k in (0,1):
-				rlocdsid = tscore[k]
-				prevscore = dlbh.get(rlocdsid, 0.0)
-				if coev > prevscore:
-					dlbh[rlocdsid] = coev
-					#~ dtlbh[rlocdsid] = tscore
 		# could exploit the information of who is best linked with whom
 		#~ listlbh = dtlbh.values()
 		#~ if verbose: print "listlbh:", listlbh
 		#~ llbh = [float(t[2]) for t in listlbh]
-		# but for the moment only collect scores
-		llbh = dlbh.values()
+		# but for the moment only collect scores (positive, as with a null initial best score)
+		llbh = best[best > 0.0]
 		if verbose: print "llbh:", llbh
 		# collect statistics
-		ltretval.append(tfamog1+tfamog2+(llt, len(llbh), mean(llbh))+quantile(llbh, [0, 0.25, 0.5, 0.75, 1]))
+		ltretval.append(OGpairStats(tfamog1, tfamog2, llt, llbh))
 	dbco.close()
 	return ltretval
 
-def main(orthocolid, reccolid, nfout, dbname, dbengine='postgres', withinfam=False, restrictfamogq='', nffamogqlist=None, nbthreads=1, verbose=False):
+def _OGpairStats(c1, c2, l1, l2, scores, isquery):
+	"""yield the statistics of OG pairs from arrays of scores sorted by OG pair, as tuples 
+	(OG code 1, OG code 2, number of scores, number of lineages with a best hit, mean and quantiles of best-hit scores)
+	
+	the best hit of a lineage is its highest score with any lineage of the other OG (implementation 2 of retrieveIG2OGscores());
+	statistics of all OG pairs are computed at once. Only pairs where the first OG is a query are reported.
+	"""
+	if len(c1)==0: return
+	bounds = np.flatnonzero((np.diff(c1)!=0) | (np.diff(c2)!=0)) + 1
+	starts = np.concatenate(([0], bounds))
+	ngroups = len(starts)
+	counts = np.diff(np.concatenate((starts, [len(c1)])))
+	# group index of each score, for both its lineages
+	grp = np.repeat(np.arange(ngroups), counts)
+	bestgrp, best = group_best_hits(np.concatenate((grp, grp)), np.concatenate((l1, l2)), np.concatenate((scores, scores)))
+	# same as the 0.0 initial best score of the lineage-wise search
+	keep = best > 0.0
+	bestgrp, best = bestgrp[keep], best[keep]
+	nbest = np.bincount(bestgrp, minlength=ngroups)
+	means = group_means(bestgrp, best, ngroups)
+	quantiles = group_quantiles(bestgrp, best, qbreaks, ngroups)
+	for k in np.flatnonzero(isquery[c1[starts]]).tolist():
+		yield (int(c1[starts[k]]), int(c2[starts[k]]), int(counts[k]), int(nbest[k]), (float(means[k]) if nbest[k] else None)) + \
+		      (quantiles[k] or (None,)*len(qbreaks))
+
+def scanIG2OGscores(dbcon, dbtype, ltfamog, ltfamogqi, reccolWC, withinfam, fout, fetchsize=1000000, verbose=False):
+	"""condense the co-evolution network by pairs of (fam, OG) groups in a single scan of the coevolution_scores table
+	
+	scores are joined to the OG codes (index in 'ltfamog') of both lineages and sorted by pair of OG codes by the database, 
+	then read in batches; the rows of the last OG pair of a batch are carried over to the next batch.
+	Write the same rows as retrieveIG2OGscores() to file 'fout' and return their number.
+	"""
+	dbcur = dbcon.cursor()
+	dfamogcode = dict((tfamog, i) for i, tfamog in enumerate(ltfamog))
+	dfamcode = {}
+	dbcur.execute("select rlocds_id, gene_family_id, og_id from rlocsd2og;")
+	ltrlocdsogcode = [(rlocdsid, dfamogcode[(fam, og)], dfamcode.setdefault(fam, len(dfamcode))) \
+	                  for rlocdsid, fam, og in dbcur.fetchall() if (fam, og) in dfamogcode]
+	dbcur.execute("create temporary table rlocds2ogcode (rlocds_id INTEGER, og_code INTEGER, fam_code INTEGER);")
+	valtoken = '%s' if dbtype=='postgres' else '?'
+	dbcur.executemany("insert into rlocds2ogcode values (%s, %s, %s);"%((valtoken,)*3), ltrlocdsogcode)
+	dbcur.execute("create index rlocds2ogcode_rlocds_id on rlocds2ogcode (rlocds_id);")
+	least, greatest = ('least', 'greatest') if dbtype=='postgres' else ('min', 'max')
+	# lineages in the same OG or, unless 'withinfam', in the same family are not compared
+	famWC = "og1.og_code != og2.og_code" if withinfam else "og1.fam_code != og2.fam_code"
+	qscan = """
+	select %s(og1.og_code, og2.og_code) as ogc1, %s(og1.og_code, og2.og_code) as ogc2, rlocds_id_1, rlocds_id_2, coev_score 
+	from coevolution_scores 
+	inner join rlocds2ogcode as og1 on rlocds_id_1=og1.rlocds_id 
+	inner join rlocds2ogcode as og2 on rlocds_id_2=og2.rlocds_id 
+	where %s %s
+	order by ogc1, ogc2 ;
+	"""%(least, greatest, famWC, reccolWC)
+	if verbose: print qscan
+	# stream the results from the server rather than loading them all in the client
+	scancur = dbcon.cursor('coevolution_scores_scan') if dbtype=='postgres' else dbcon.cursor()
+	scancur.execute(qscan)
+	isquery = np.zeros(len(ltfamog), dtype=bool)
+	isquery[list(ltfamogqi)] = True
+	nout = 0
+	carry = None
+	rows = scancur.fetchmany(fetchsize)
+	while rows:
+		a = np.array(rows, dtype=np.float64)
+		if carry is not None: a = np.concatenate((carry, a))
+		rows = scancur.fetchmany(fetchsize)
+		if rows:
+			# the last OG pair may continue in the next batch
+			k = np.flatnonzero((a[:,0]!=a[-1,0]) | (a[:,1]!=a[-1,1]))
+			k = k[-1]+1 if len(k) else 0
+			carry = a[k:]
+			a = a[:k]
+		codes = a[:,:4].astype(np.int64)
+		for tstats in _OGpairStats(codes[:,0], codes[:,1], codes[:,2], codes[:,3], a[:,4], isquery):
+			t = ltfamog[tstats[0]]+ltfamog[tstats[1]]+tstats[2:]
+			fout.write('\t'.join([str(f) for f in t])+'\n')
+			nout += 1
+		if verbose: print "%d OG pairs written"%nout
+	scancur.close()
+	dbcur.execute("drop table rlocds2ogcode;")
+	return nout
+
+def main(orthocolid, reccolid, nfout, dbname, dbengine='postgres', withinfam=False, restrictfamogq='', nffamogqlist=None, nbthreads=1, engine='scan', verbose=False):
+	"""condense the co-evolution network of gene lineages into a network of orthologous groups (OGs)
+	
+	with engine='scan' (default), the scores are read in a single pass sorted by OG pair (see scanIG2OGscores());
+	with engine='pairs', the scores are queried separately for each pair of OGs, in 'nbthreads' parallel processes (see retrieveIG2OGscores()).
+	"""
 	
 	# open DB connection
 	dbcon, dbcur, dbtype, valtoken = get_dbconnection(dbname, dbengine)
@@ -112,31 +203,41 @@ def main(orthocolid, reccolid, nfout, dbname, dbengine='postgres', withinfam=Fal
 	else:
 		# query set same as subject set
 		ltfamogqi = range(len(ltfamog)-1)
-	# close connection
-	dbcon.close()
 
 	if reccolid==0:
 		# skip check multiplicity of reconciliation collection
-		wrc = ";"
+		wrc = ""
 	else:
 		# check multiplicity of reconciliation collection
-		dbcur.execute("select distinct reconciliation_id from phylogeny.coevolution_scores;")
+		dbcur.execute("select distinct reconciliation_id from coevolution_scores;")
 		lreccol = dbcur.fetchall()
 		if len(lreccol)==1:
 			# will not avoid further overhead of query constraint on reconciliation_id
-			wrc = ";"
+			wrc = ""
 		else:
 			# will filter queries based on reconciliation collection
-			wrc = "and reconciliation_id=%d ;"%reccolid
+			wrc = " and reconciliation_id=%d"%reccolid
+
+	if engine=='scan':
+		with open(nfout, 'w') as fout:
+			nout = scanIG2OGscores(dbcon, dbtype, ltfamog, ltfamogqi, wrc, withinfam, fout, verbose=verbose)
+		dbcon.close()
+		if verbose: print "wrote %d OG pairs to '%s'"%(nout, nfout)
+		return
+	elif engine!='pairs':
+		raise ValueError, "incorrect value '%s' for variable 'engine'"%repr(engine)
+	# close connection
+	dbcon.close()
 
+	least, greatest = ('least', 'greatest') if dbtype=='postgres' else ('min', 'max')
 	qogogsc = """
-	select least(rlocds_id_1, rlocds_id_2), greatest(rlocds_id_1, rlocds_id_2), coev_score 
+	select """+least+"""(rlocds_id_1, rlocds_id_2), """+greatest+"""(rlocds_id_1, rlocds_id_2), coev_score 
 	from coevolution_scores 
 	inner join rlocsd2og as og1 on rlocds_id_1=og1.rlocds_id 
 	inner join rlocsd2og as og2 on rlocds_id_2=og2.rlocds_id 
 	where (og1.gene_family_id=%s and og1.og_id=%s and og2.gene_family_id=%s and og2.og_id=%s) 
 	or (og2.gene_family_id=%s and og2.og_id=%s and og1.gene_family_id=%s and og1.og_id=%s) 
-	"""+wrc
+	"""+wrc+" ;"
 
 	# run the queries in parallel
 	pool = mp.Pool(processes=nbthreads)
@@ -154,6 +255,8 @@ def main(orthocolid, reccolid, nfout, dbname, dbengine='postgres', withinfam=Fal
 def usage():
 	s = "Usage: [HELP MESSAGE INCOMPLETE]\n"
 	s += "python %s {--postgresql_db dbname | --sqlite_db dbfile} --out tablefiledest [OTHER OPTIONS]\n"%sys.argv[0]
+	s += "\t\t--engine\t{scan|pairs} read all co-evolution scores at once, sorted by OG pair (default: scan),\n"
+	s += "\t\t\t\tor query them separately for each OG pair, in parallel over --threads processes\n"
 	return s
 
 if __name__=='__main__':
@@ -161,7 +264,7 @@ if __name__=='__main__':
 	opts, args = getopt.getopt(sys.argv[1:], 'T:hv', ['ortho_col_id=', 'reconciliation_id=', 'out=', \
 	                                                'postgresql_db=', 'sqlite_db=', 'whitinfam', \
 	                                                'restrict_famog_query=', 'input_famog_query_list=', \
-	                                                'threads=', 'help', 'verbose'])
+	                                                'threads=', 'engine=', 'help', 'verbose'])
 	dopt = dict(opts)
 	
 	if ('-h' in dopt) or ('--help' in dopt):
@@ -174,7 +277,6 @@ if __name__=='__main__':
 		dbengine = 'postgres'
 	elif '--sqlite_db' in dopt:
 		dbengine = 'sqlite'
-		raise NotImplementedError, "condensation of coevolution network from gene-lineage to orthologous groups not implement with SQLite database - and unlikely to be so given the huge size of tables to be loaded in memory"
 	else:
 		raise ValueError, "must provide database name (postgreSQL) / file location (SQLite) through '--sqlite_db' or '--postgresql_db' options"
 
@@ -185,7 +287,8 @@ if __name__=='__main__':
 	nffamogqlist = dopt.get('--input_famog_query_list')
 	nbthreads = int(dopt.get('--threads', dopt.get('-T', -1)))
 	if nbthreads < 1: nbthreads = mp.cpu_count()
+	engine = dopt.get('--engine', 'scan')
 	verbose = (('-v' in dopt) or ('--verbose' in dopt))
 	if verbose: print "dopt:", dopt
 	
-	main(orthocolid, reccolid, nfout, dbname, dbengine, withinfam, restrictfamogq, nffamogqlist, nbthreads, verbose)
+	main(orthocolid, reccolid, nfout, dbname, dbengine, withinfam, restrictfamogq, nffamogqlist, nbthreads, engine, verbose)
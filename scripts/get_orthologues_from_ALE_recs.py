@@ -3,7 +3,7 @@
 import os, glob, sys, getopt
 import tree2
 import ptg_utils as ptg
-from parseALErec import parseALERecFile, getOrthologues, getOriSpeciesFromEventLab
+from parseALErec import parseALERecFile, iterALERecGeneTrees, getOrthologues, getOriSpeciesFromEventLab
 import igraph
 from itertools import combinations
 import multiprocessing as mp
@@ -68,6 +68,56 @@ def indexCleanTreeLabels(genetree, dlabs, dnexustrans={}, drevnexustrans={}, lta
 			node.edit_label('')
 	return (genetree, dnexustrans, drevnexustrans, ltaxnexus)
 
+def coMembershipMatrix(logs, llabs):
+	"""count the co-membership of genes in the same orthologous group (OG) over a sample of OG classifications
+	
+	'logs' is the list of classifications (lists of OGs, i.e. lists of gene labels), 'llabs' the list of gene labels.
+	return a sparse (scipy.sparse CSR) upper-triangular matrix of counts with genes indexed as in 'llabs', where cell (i, j), i < j, 
+	counts the OGs containing both genes i and j and the diagonal cell (i, i) counts the OGs where gene i is alone,
+	i.e. the weights of the edges of the graph of connectivity of genes in OGs.
+	"""
+	# optional dependencies, only required for combining OGs
+	import numpy as np
+	from scipy import sparse
+	dlabindex = dict((lab, i) for i, lab in enumerate(llabs))
+	# incidence matrix of genes (rows) in the OGs of all classifications (columns)
+	rows = []
+	ogsizes = []
+	for ogs in logs:
+		for og in ogs:
+			rows += [dlabindex[lab] for lab in og]
+			ogsizes.append(len(og))
+	ogsizes = np.array(ogsizes, dtype=np.int64)
+	cols = np.repeat(np.arange(len(ogsizes)), ogsizes)
+	A = sparse.csr_matrix((np.ones(len(cols), dtype=np.int32), (np.array(rows, dtype=np.int64), cols)), shape=(len(llabs), len(ogsizes)))
+	# pairs of genes in the same OGs (products of the incidence matrix), without the diagonal...
+	comemb = sparse.triu(A.dot(A.T), k=1, format='csr')
+	# ... which is replaced by the counts of single-gene OGs
+	singletons = A[:,np.flatnonzero(ogsizes==1)].sum(axis=1).A.ravel()
+	comemb = comemb + sparse.diags(singletons, 0, format='csr')
+	comemb.eliminate_zeros()
+	return comemb
+
+def graphFromCoMembership(comemb, llabs, minfreq=None):
+	"""build the weighted graph of connectivity of genes from a matrix of co-membership counts (see coMembershipMatrix())
+	
+	if 'minfreq' is specified, only edges with weight > minfreq are included.
+	"""
+	C = comemb.tocoo()
+	if minfreq is not None:
+		keep = C.data > minfreq
+		edges = zip(C.row[keep].tolist(), C.col[keep].tolist())
+		freqs = C.data[keep].tolist()
+	else:
+		edges = zip(C.row.tolist(), C.col.tolist())
+		freqs = C.data.tolist()
+	graph = igraph.Graph()
+	graph.add_vertices(len(llabs))
+	graph.vs['name'] = llabs
+	graph.add_edges(edges)
+	graph.es['weight'] = freqs
+	return graph
+
 def getVertexClustering(g, communitymethod, w='weight', **kw):
 	"""generic call to igraph.Graph community finding functions to return homogeneous output format"""
 	commfunname = communitymethod if hasattr(igraph.Graph, communitymethod) else "community_"+communitymethod
@@ -84,108 +134,176 @@ def getVertexClustering(g, communitymethod, w='weight', **kw):
 	assert isinstance(comms, igraph.clustering.VertexClustering)
 	return comms
 
-def enforceUnicity(graph, clustering, graphcommfun, maxdrop=-1, w='weight', nround=0, **kw):
+def _unicityConflicts(graph, clustering):
+	"""return the lists of indices of the vertices (genes) from the same species in the same cluster (one list per species per cluster)"""
+	dspememb = {}
+	for i, (v, memb) in enumerate(zip(graph.vs, clustering.membership)):
+		dspememb.setdefault((getOriSpeciesFromEventLab(v['name']), memb), []).append(i)
+	return [lvids for lvids in dspememb.itervalues() if len(lvids) > 1]
+
+def _reclusterVertices(graph, clustering, vids, graphcommfun, **kw):
+	"""re-compute the clustering of vertices 'vids' only, on their induced sub-graph; other vertices keep their clusters
+	
+	return a new clustering of the graph, with clusters numbered contiguously.
+	"""
+	subclustering = graphcommfun(graph.induced_subgraph(vids), **kw)
+	# new clusters get codes that cannot collide with those of the unaffected clusters
+	offset = max(clustering.membership) + 1
+	membership = list(clustering.membership)
+	for vid, submemb in zip(vids, subclustering.membership):
+		membership[vid] = offset + submemb
+	dcode = {}
+	membership = [dcode.setdefault(memb, len(dcode)) for memb in membership]
+	return igraph.VertexClustering(graph, membership)
+
+def enforceUnicity(graph, clustering, graphcommfun, maxdrop=-1, w='weight', **kw):
 	"""resolve non-orthologous relationships between same-species genes 
 	
 	THese forbidden relationships may arise in connected graph components due to 'peer-to-peer' connectivity in the graph.
 	
-	this function explores the paths between vertices (genes) from the same species and 
-	iteratively drop the weakest edges until the confict is resolved.
-	if maxdrop > 0, only 'maxdrop' edges are removed before re-evaluating the clustering. 
-	if maxdrop <=0, all paths connecting the same-species genes are cut at their weakest 
-	                point (useful when community finding ignores the weights, eg. if based 
-	                on connected components).
+	in each round, the minimum (weighted) cut separating each pair of vertices (genes) from the same species 
+	in the same cluster is computed, and the union of these cuts is dropped from the graph;
+	then only the connected components that contained the dropped edges are re-clustered, until no confict remains.
+	if maxdrop > 0, only the 'maxdrop' weakest edges of the cuts are removed before re-evaluating the clustering. 
+	if maxdrop <=0, all cuts are removed at once, which resolves all conflicts in one round when clusters are 
+	                the connected components (eg. when community finding ignores the weights).
+	"""
+	verbose = kw.get('verbose')
+	nround = 0
+	while True:
+		# first find conflicting (i.e. multi-copy) members in clusters
+		forbidrels = _unicityConflicts(graph, clustering)
+		if not forbidrels:
+			if verbose and nround>0: print "Conflict resolved at round %d; network has now %d edges."%(nround, len(graph.es))
+			return (graph, clustering)
+		elif verbose:
+			print "forbidden same-species genes in orthologous communities:", forbidrels
+		# identify the edges to drop to separate vertices in forbidden relationships
+		capacity = graph.es[w]
+		todropeis = set([])
+		for forbidrel in forbidrels:
+			# enumerate vertex pairs in this group (usually only one pair)
+			for a, b in combinations(forbidrel, 2):
+				todropeis.update(graph.mincut(source=a, target=b, capacity=capacity).cut)
+		if not todropeis:
+			# conflicting vertices are already disconnected, nothing more can be done by pruning the graph
+			if verbose: print "Conflict could not be resolved at round %d by pruning the network"%nround
+			return (graph, clustering)
+		todropeis = sorted(todropeis, key=lambda ei: capacity[ei])
+		if maxdrop > 0:
+			todropeis = todropeis[:maxdrop]
+		if verbose: print "will prune those %d weak edges:"%len(todropeis), [graph.es[ei] for ei in todropeis]
+		# connected components affected by the pruning
+		compmembs = graph.components().membership
+		affectedcomps = set(compmembs[graph.es[ei].source] for ei in todropeis)
+		graph.delete_edges(todropeis)
+		# regenerate clustering of the affected components given the pruned graph
+		affectedvids = [vid for vid, comp in enumerate(compmembs) if comp in affectedcomps]
+		clustering = _reclusterVertices(graph, clustering, affectedvids, graphcommfun, **kw)
+		nround += 1
+
+def orthoFromRecGeneTree(recgenetree, methods, refspetree=None, summary=False, **kw):
+	"""infer the orthologous groups (OGs) of one sampled reconciled gene tree with each of the methods
+	
+	return the dict of OGs per method, the dict of leaf labels and a tuple of summary fields 
+	(numbers of OGs per method and overlaps between methods, the latter only computed if 'summary' is True).
 	"""
 	verbose = kw.get('verbose')
-	# first find conflicting (i.e. multi-copy) members in clusters
-	lspe = [getOriSpeciesFromEventLab(v['name']) for v in graph.vs]
-	lspememb = zip(lspe, clustering.membership)
-	dcountspememb = {spememb:lspememb.count(spememb) for spememb in set(lspememb)}
-	spemembhicount = [spememb for spememb, n in dcountspememb.iteritems() if n > 1]
-	if not spemembhicount:
-		if verbose and nround>0: print "Conflict resolved at round %; network has now %d edges."%(nround, len(graph.es))
-		return (graph, clustering)
-	elif verbose:
-		print "forbidden same-species genes in orthologous communities:", spemembhicount
-	forbidrels = []
-	for spememb in spemembhicount:
-		# store the indices of the vertices that should not be connected in a community (one set per species per community)
-		forbidrels.append([i for i, sm in enumerate(lspememb) if sm==spememb])
-	# identify the (weakest) edges to drop to separate vertices in forbidden relationships
-	todropes = set([])
-	for forbidrel in forbidrels:
-		# enumaerate vertex pairs in this group (usually only one pair)
-		for a in forbidrel[:-1]:
-			for b in forbidrel[1:]:
-				if a==b: continue
-				# identify all the edge paths to cut to separate vertices in forbidden relationships
-				lshpaes = [graph.get_eids(path=shpavs) for shpavs in graph.get_all_shortest_paths(graph.vs[a], to=graph.vs[b])]
-				for shpaes in lshpaes:
-					# identify the weakest edges to drop to separate this vertex pair
-					wes = [graph.es[ei][w] for ei in shpaes]
-					weake = graph.es[shpaes[wes.index(min(wes))]]
-					todropes.add(weake)
-	todropes = sorted(todropes, key=lambda x: x[w])
-	if maxdrop > 0:
-		todropes = todropes[:maxdrop]
-	if verbose: print "will prune those %d weak edges:"%len(todropes), todropes
-	graph.delete_edges([e.index for e in todropes])
-	# regenerate clustering given the pruned graph
-	clustering = graphcommfun(graph, **kw)
-	# re-evaluate the graph and clustering in this condition (should only be required when maxdrop > 0)
-	return enforceUnicity(graph, clustering, graphcommfun, maxdrop=maxdrop, w=w, nround=nround+1, **kw)
+	N = recgenetree.nb_leaves()
+	dlabs = {}
+	if set(['strict', 'mixed']) & set(methods):
+		if verbose: print "\n# strict_ogs:\n"
+		strict_ogs, unclassified, dlabs = getOrthologues(recgenetree, method='strict', refspetree=refspetree, dlabs=dlabs, **kw)
+		n1 = summaryOGs(strict_ogs, dlabs, N, verbose)
+	else:
+		strict_ogs = unclassified = None; n1 = 'NA'
+	if 'unicopy' in methods:
+		if verbose: print "\n# unicopy_ogs:\n"
+		unicopy_ogs, notrelevant, dlabs = getOrthologues(recgenetree, method='unicopy', refspetree=refspetree, dlabs=dlabs, **kw)
+		n2 = summaryOGs(unicopy_ogs, dlabs, N, verbose)
+	else:
+		unicopy_ogs = None; n2 = 'NA'
+	if 'mixed' in methods:
+		if verbose: print "\n# mixed_ogs:\n"
+		mixed_ogs, unclassified, dlabs = getOrthologues(recgenetree, method='mixed', strict_ogs=strict_ogs, unclassified=unclassified, refspetree=refspetree, dlabs=dlabs, **kw) #
+		n3 = summaryOGs(mixed_ogs, dlabs, N, verbose)
+	else:
+		mixed_ogs = None; n3 = 'NA'
+	
+	o12 = o13 = o23 = 'NA'
+	if summary: 
+		o12 = str(sum([int(o in strict_ogs) for o in unicopy_ogs])) if (strict_ogs and unicopy_ogs) else 'NA'
+		o13 = str(sum([int(o in strict_ogs) for o in mixed_ogs])) if (strict_ogs and mixed_ogs) else 'NA'
+		o23 = str(sum([int(o in unicopy_ogs) for o in mixed_ogs])) if (mixed_ogs and unicopy_ogs) else 'NA'
+	return ({'strict':strict_ogs, 'unicopy':unicopy_ogs, 'mixed':mixed_ogs}, dlabs, (n1, n2, n3, o12, o13, o23))
+
+def _orthoFromRecGeneTreeChunk(args):
+	"""infer the OGs of a chunk of the sampled reconciled gene trees of a family (in a worker process); 
+	trees are read from the reconciliation file rather than passed from the parent process, 
+	seeking directly to the gene tree lines (at 'offset', as parsed once by the parent process) and stopping after the last tree of the chunk
+	"""
+	nfrec, offset, chunk, methods, summary, refspetree, kw = args
+	# trees are yielded in the order of the file
+	lrecgt = iterALERecGeneTrees(nfrec, offset, nsample=set(chunk))
+	return [(g,)+orthoFromRecGeneTree(recgenetree, methods, refspetree=refspetree, summary=summary, **kw) \
+	        for g, recgenetree in zip(sorted(chunk), lrecgt)]
 
 def orthoFromSampleRecs(nfrec, outortdir, nsample=[], methods=['mixed'], \
                         foutdiffog=None, outputOGperSampledRecGT=True, colourTreePerSampledRecGT=False, \
-                        graphCombine=None, majRuleCombine=None, **kw):
-	""""""
+                        graphCombine=None, majRuleCombine=None, nbthreads=1, **kw):
+	"""infer the orthologous groups of a gene family from each sampled reconciled gene tree, and combine them over the sample
+	
+	with nbthreads > 1, the sampled trees are dealt in chunks to a pool of 'nbthreads' worker processes 
+	(not when colouring each sampled tree, which requires to keep them all in the parent process).
+	"""
 	verbose = kw.get('verbose')
 	fam = os.path.basename(nfrec).split('-', 1)[0]
 	if verbose: print "\n# # # %s"%fam
-	# collect the desired sample from the reconciliation file
-	dparserec = parseALERecFile(nfrec, skipLines=True, skipEventFreq=True, nsample=nsample, returnDict=True)
+	# collect the desired sample from the reconciliation file;
+	# unless all sampled trees are needed for output, they are streamed one at a time rather than all loaded in memory
+	dparserec = parseALERecFile(nfrec, skipLines=True, skipEventFreq=True, nsample=nsample, returnDict=True, \
+	                            streamRecGeneTrees=(not colourTreePerSampledRecGT))
 	lrecgt = dparserec['lrecgt']
 	if kw.get('userefspetree'):
 		refspetree = dparserec['spetree']
 	else:
 		refspetree = None
 	colourCombinedTree = kw.get('colourCombinedTree')
+	recgt0 = None
+	R = dparserec['nrecgt']
+	gs = nsample if nsample else range(R)
+	summary = bool(foutdiffog or verbose)
+	
+	def iterSampleOGs():
+		"""yield (sample index, tree or None, OGs per method, leaf labels, summary fields) for each sampled reconciled gene tree, in order"""
+		if nbthreads > 1 and not colourTreePerSampledRecGT and len(gs) > 1:
+			# the first tree is treated in this process, as it is kept for output
+			recgenetree = next(iter(lrecgt))
+			yield (sorted(gs)[0], recgenetree)+orthoFromRecGeneTree(recgenetree, methods, refspetree=refspetree, summary=summary, **kw)
+			lg = sorted(gs)[1:]
+			chunksize = max(len(lg) // (nbthreads*4), 1)
+			iterargs = ((nfrec, dparserec['recgtoffset'], lg[k:k+chunksize], methods, summary, refspetree, kw) for k in range(0, len(lg), chunksize))
+			pool = mp.Pool(processes=nbthreads)
+			for lres in pool.imap(_orthoFromRecGeneTreeChunk, iterargs):
+				for tres in lres:
+					yield (tres[0], None)+tres[1:]
+			pool.close()
+			pool.join()
+		else:
+			for i, recgenetree in enumerate(lrecgt):
+				if nsample: g = nsample[i]
+				else: g = i
+				if verbose: print recgenetree
+				if verbose: print "\n# # reconciliation sample %d"%g
+				yield (g, recgenetree)+orthoFromRecGeneTree(recgenetree, methods, refspetree=refspetree, summary=summary, **kw)
 	
 	ddogs = {}
 	dnexustrans = {}
 	drevnexustrans = {}
 	ltaxnexus = []
 	llabs = []
-	for i, recgenetree in enumerate(lrecgt):
-		if nsample: g = nsample[i]
-		else: g = i
-		if verbose: print recgenetree
-		if verbose: print "\n# # reconciliation sample %d"%g
-		N = recgenetree.nb_leaves()
-		dlabs = {}
-		if set(['strict', 'mixed']) & set(methods):
-			if verbose: print "\n# strict_ogs:\n"
-			strict_ogs, unclassified, dlabs = getOrthologues(recgenetree, method='strict', refspetree=refspetree, dlabs=dlabs, **kw)
-			n1 = summaryOGs(strict_ogs, dlabs, N, verbose)
-		else:
-			strict_ogs = unclassified = None; n1 = 'NA'
-		if 'unicopy' in methods:
-			if verbose: print "\n# unicopy_ogs:\n"
-			unicopy_ogs, notrelevant, dlabs = getOrthologues(recgenetree, method='unicopy', refspetree=refspetree, dlabs=dlabs, **kw)
-			n2 = summaryOGs(unicopy_ogs, dlabs, N, verbose)
-		else:
-			unicopy_ogs = None; n2 = 'NA'
-		if 'mixed' in methods:
-			if verbose: print "\n# mixed_ogs:\n"
-			mixed_ogs, unclassified, dlabs = getOrthologues(recgenetree, method='mixed', strict_ogs=strict_ogs, unclassified=unclassified, refspetree=refspetree, dlabs=dlabs, **kw) #
-			n3 = summaryOGs(mixed_ogs, dlabs, N, verbose)
-		else:
-			mixed_ogs = None; n3 = 'NA'
-		
-		if foutdiffog or verbose: 
-			o12 = str(sum([int(o in strict_ogs) for o in unicopy_ogs])) if (strict_ogs and unicopy_ogs) else 'NA'
-			o13 = str(sum([int(o in strict_ogs) for o in mixed_ogs])) if (strict_ogs and mixed_ogs) else 'NA'
-			o23 = str(sum([int(o in unicopy_ogs) for o in mixed_ogs])) if (mixed_ogs and unicopy_ogs) else 'NA'
+	for i, (g, recgenetree, dogs, dlabs, tsummary) in enumerate(iterSampleOGs()):
+		n1, n2, n3, o12, o13, o23 = tsummary
 		if verbose:
 			print "\n# summary:\n"
 			print "overlap strict_ogs with unicopy_ogs:", o12
@@ -194,22 +312,21 @@ def orthoFromSampleRecs(nfrec, outortdir, nsample=[], methods=['mixed'], \
 		if foutdiffog:
 			foutdiffog.write('\t'.join([fam, str(g), n1, n2, n3, o12, o13, o23])+'\n')
 		
-		if colourTreePerSampledRecGT or colourCombinedTree:
+		if (colourTreePerSampledRecGT or colourCombinedTree) and (recgenetree is not None):
 			if i==0:
 				recgenetree, dnexustrans, drevnexustrans, ltaxnexus = indexCleanTreeLabels(recgenetree, dlabs)
 			else:
 				recgenetree, dnexustrans, drevnexustrans, ltaxnexus = indexCleanTreeLabels(recgenetree, dlabs, \
 				         dnexustrans=dnexustrans, drevnexustrans=drevnexustrans, ltaxnexus=ltaxnexus, update=False)
 		
-		ddogs[g] = {'strict':strict_ogs, 'unicopy':unicopy_ogs, 'mixed':mixed_ogs}
+		ddogs[g] = dogs
 		if verbose: print "\n# # # # # # # #"
 		if i==0:
 			# collect the leaf labels; just do once
 			llabs = dlabs.values() 
 			llabs.sort()
+			if colourCombinedTree: recgt0 = recgenetree
 	
-	R = len(lrecgt)
-	gs = nsample if nsample else range(R)
 	for method in methods:
 		ltrees = []
 		nfoutrad = os.path.join(outortdir, method, "%s_%s"%(fam, method))
@@ -224,44 +341,17 @@ def orthoFromSampleRecs(nfrec, outortdir, nsample=[], methods=['mixed'], \
 					foutort.write('\n'.join([' '.join(x) for x in ogs])+'\n#\n')
 		
 		if graphCombine or majRuleCombine:
-			## for later output
-			recgt0 = lrecgt[0] if colourCombinedTree else None 
+			## for later output, 'recgt0' is the first tree of the sample (if colourCombinedTree)
 			# could also use the ALE consensus tree, which has branch supports but has no lengths
-			## first make a dict of edge frequencies
-			dedgefreq = {}
-			for g in gs:
-				ogs = ddogs[g][method]
-				for og in ogs:
-					if len(og)==1:
-						orfan = og[0] ; combo = (orfan, orfan)
-						dedgefreq[combo] = dedgefreq.get(combo, 0) + 1
-					else:
-						# get all pairs of genes in the OG
-						combogs = combinations(sorted(og), 2)
-						# add the counts
-						for combo in combogs:
-							dedgefreq[combo] = dedgefreq.get(combo, 0) + 1
-			## build a graph of connectivity of the genes in OGs, integrating over the sample
-			gOG = igraph.Graph()
-			gOG.add_vertices(len(llabs))
-			gOG.vs['name'] = llabs
-			# first make a full weighted graph
-			# add the edges to the graph
-			edges, freqs = zip(*dedgefreq.iteritems())
-			gOG.add_edges(edges)
-			gOG.es['weight'] = freqs
+			## first make a matrix of co-membership frequencies of genes in OGs, integrating over the sample
+			comemb = coMembershipMatrix([ddogs[g][method] for g in gs], llabs)
 			if majRuleCombine:
 				## make a majority rule unweighted graph
-				mjgOG = gOG.copy()
-				# select edges with frequency below the threshold
-				mjdropedges = []
 				minfreq = majRuleCombine*R
-				for e in mjgOG.es:
-					# use strict majority (assuming the parameter majRuleCombine=0.5, the default) to avoid obtaining family-wide single components
-					if e['weight'] <= minfreq: mjdropedges.append(e.index)
-				# remove the low-freq edges to the graph
-				mjgOG.delete_edges(mjdropedges)
-				if verbose: print "Majority Rule Consensus network: droped %d edges with weight <= %d from the full network (%d edges)"%(len(mjdropedges), minfreq, len(gOG.es))
+				# only keep edges with frequency above the threshold
+				# use strict majority (assuming the parameter majRuleCombine=0.5, the default) to avoid obtaining family-wide single components
+				mjgOG = graphFromCoMembership(comemb, llabs, minfreq=minfreq)
+				if verbose: print "Majority Rule Consensus network: droped %d edges with weight <= %d from the full network (%d edges)"%(comemb.nnz - len(mjgOG.es), minfreq, comemb.nnz)
 				# find connected components (i.e. perform clustering)
 				compsOGs = mjgOG.components()
 				# resolve conflicts in orthology classification
@@ -271,6 +361,8 @@ def orthoFromSampleRecs(nfrec, outortdir, nsample=[], methods=['mixed'], \
                                              colourCombinedTree=colourCombinedTree, recgt=recgt0, drevnexustrans=drevnexustrans, \
                                              ltax=ltaxnexus, dtranslate=dnexustrans, ltreenames=["tree_0"], figtree=True)
 			if graphCombine:
+				## build a full weighted graph of connectivity of the genes in OGs
+				gOG = graphFromCoMembership(comemb, llabs)
 				# find communities (i.e. perform clustering) in full weighted graph
 				commsOGs = getVertexClustering(gOG, graphCombine)
 				# resolve conflicts in orthology classification
@@ -311,6 +403,8 @@ def usage(mini=False):
 	s += "  --unreconciled.ext\texpected file extension for the consensus/ML gene trees (default: '.con.tre');\n"
 	s += "\t\t\t\t\t\tsimple unicity-based classification will be applied.\n"
 	s += "  --threads\t\t\tnumber of parralel processes to run.\n"
+	s += "  --split.families.above\tsize (in MB) of the reconciliation file of families whose sampled trees are treated in parallel,\n"
+	s += "\t\t\t\tone family at a time, before the other families (default: total size of reconciliation files / number of threads).\n"
 	s += "  --verbose {0,1,2}\tverbose mode, from none to plenty.\n"
 	s += "  -v\t\t\tequivalent to --verbose=1.\n"
 	return s
@@ -322,7 +416,7 @@ if __name__=='__main__':
 														'colour.sampled.trees', 'report.ogs.per.sampled.tree', 'summary.per.sampled.tree', \
 														'majrule.combine=', 'graph.combine=', 'colour.combined.tree', \
 														'use.unreconciled.gene.trees=', 'unreconciled.format=', 'unreconciled.ext=', \
-														'skip.reconciled', 'threads=', 'verbose=', 'help'])
+														'skip.reconciled', 'threads=', 'split.families.above=', 'verbose=', 'help'])
 	dopt = dict(opts)
 	if ('-h' in dopt) or ('--help' in dopt):
 		print usage()
@@ -360,6 +454,7 @@ if __name__=='__main__':
 		raise ValueError, "values for --graph.combine must be a real within the interval ]0; 1]"
 	nbthreads = int(dopt.get('--threads', dopt.get('-T', -1)))
 	if nbthreads < 1: nbthreads = mp.cpu_count()
+	splitFamSize = float(dopt['--split.families.above'])*1024**2 if ('--split.families.above' in dopt) else None
 	
 	## main execution
 	lnfrec = glob.glob('%s/*ale.ml_rec'%(alerecdir))
@@ -383,8 +478,8 @@ if __name__=='__main__':
 		print "Warning: verbose mode is DISABLED when running in parallel"
 		verbose = 0
 			
-	def orthoFromSampleRecsSetArgs(nfrec):
-		orthoFromSampleRecs(nfrec, outortdir, nsample=nsample, ALEmodel=ALEmodel, \
+	def orthoFromSampleRecsSetArgs(nfrec, nbthreads=1):
+		orthoFromSampleRecs(nfrec, outortdir, nsample=nsample, ALEmodel=ALEmodel, nbthreads=nbthreads, \
 							methods=methods, userefspetree=userefspetree, trheshExtraSpe=trheshExtraSpe, reRootMaxBalance=reRootMaxBalance, \
 							graphCombine=graphCombine, majRuleCombine=majRuleCombine, colourCombinedTree=colourCombinedTree, \
 							foutdiffog=foutdiffog, outputOGperSampledRecGT=outputOGperSampledRecGT, colourTreePerSampledRecGT=colourTreePerSampledRecGT, \
@@ -399,9 +494,18 @@ if __name__=='__main__':
 				if verbose: print " # # # # # # # \n"
 			if foutdiffog: foutdiffog.close()
 		else:
-			# or run in parallel
+			# or run in parallel, starting with the largest families (by size of the reconciliation file, 
+			# i.e. ~ number of leaves x number of sampled trees) so they do not end up running alone
+			lnfrec.sort(key=os.path.getsize, reverse=True)
+			# families that would take more than a fair share of the work of one process are treated one at a time, 
+			# with their sampled trees dealt to parallel processes
+			if splitFamSize is None: splitFamSize = sum(os.path.getsize(nfrec) for nfrec in lnfrec) / nbthreads
+			lnfrecsplit = [nfrec for nfrec in lnfrec if os.path.getsize(nfrec) > splitFamSize]
+			for nfrec in lnfrecsplit:
+				print nfrec
+				orthoFromSampleRecsSetArgs(nfrec, nbthreads=nbthreads)
 			pool = mp.Pool(processes=nbthreads)
-			res = pool.map(orthoFromSampleRecsSetArgs, lnfrec)
+			res = list(pool.imap_unordered(orthoFromSampleRecsSetArgs, lnfrec[len(lnfrecsplit):], chunksize=1))
 
 	if unreconciledGTdir:
 		# list the consensus/ML gene trees available
@@ -35,9 +35,14 @@ dbname = '${dbfile}'
 dbcon = sqlite3.connect(dbname)
 dbcur = dbcon.cursor()
 dirgtevt = '${parsedrecs}/gene_tree_lineages'
-for nffamgtevt in os.listdir(dirgtevt):
-  with open(os.path.join(dirgtevt, nffamgtevt)) as ffamgtevt:
-    dbcur.executemany('insert into gene_lineage_events (replacement_label_or_cds_code, event_id, freq, reconciliation_id) values (?,?,?,?);', (line.rstrip('\n').split('\t')+[${parsedreccolid}] for line in ffamgtevt))
+# event lineages may already have been loaded when parsing reconciliations (parse_collapsedALE_scenarios.py --events_to_sqlite)
+dbcur.execute('select 1 from gene_lineage_events where reconciliation_id=? limit 1;', (${parsedreccolid},))
+if dbcur.fetchone():
+  print "gene lineage events of reconciliation collection ${parsedreccolid} already loaded; skip loading files from '%s'"%dirgtevt
+else:
+  for nffamgtevt in os.listdir(dirgtevt):
+    with open(os.path.join(dirgtevt, nffamgtevt)) as ffamgtevt:
+      dbcur.executemany('insert into gene_lineage_events (replacement_label_or_cds_code, event_id, freq, reconciliation_id) values (?,?,?,?);', (line.rstrip('\n').split('\t')+[${parsedreccolid}] for line in ffamgtevt))
 
 dbcon.commit()
 
@@ -59,12 +64,12 @@ BEGIN;
 INSERT INTO reconciliation_collections (reconciliation_id, reconciliation_name, software, version, algorithm, reconciliation_date, notes)
  VALUES (${parsedreccolid}, '${parsedreccol}', 'ALE', '${ALEversion}', '${ALEalgo}', '${parsedreccoldate}', '${ALEsourcenote}') ;
 
-CREATE INDEX gene_lineage_events_recid ON gene_lineage_events (reconciliation_id);
-CREATE INDEX gene_lineage_events_rlocds ON gene_lineage_events (replacement_label_or_cds_code);
-CREATE INDEX gene_lineage_events_evtid ON gene_lineage_events (event_id);
-CREATE INDEX gene_lineage_events_freq ON gene_lineage_events (freq);
-CREATE INDEX gene_lineage_events_rlocds_evtid ON gene_lineage_events (replacement_label_or_cds_code, event_id);
-CREATE UNIQUE INDEX gene_lineage_events_recid_rlocds_evtid ON gene_lineage_events (reconciliation_id, replacement_label_or_cds_code, event_id);
+CREATE INDEX IF NOT EXISTS gene_lineage_events_recid ON gene_lineage_events (reconciliation_id);
+CREATE INDEX IF NOT EXISTS gene_lineage_events_rlocds ON gene_lineage_events (replacement_label_or_cds_code);
+CREATE INDEX IF NOT EXISTS gene_lineage_events_evtid ON gene_lineage_events (event_id);
+CREATE INDEX IF NOT EXISTS gene_lineage_events_freq ON gene_lineage_events (freq);
+CREATE INDEX IF NOT EXISTS gene_lineage_events_rlocds_evtid ON gene_lineage_events (replacement_label_or_cds_code, event_id);
+CREATE UNIQUE INDEX IF NOT EXISTS gene_lineage_events_recid_rlocds_evtid ON gene_lineage_events (reconciliation_id, replacement_label_or_cds_code, event_id);
 
 INSERT INTO replacement_label_or_cds_code2gene_families (replacement_label_or_cds_code, gene_family_id) 
 SELECT replacement_label_or_cds_code, gene_family_id FROM (
@@ -72,10 +77,11 @@ SELECT replacement_label_or_cds_code, gene_family_id FROM (
 UNION
  SELECT replacement_label as replacement_label_or_cds_code, gene_family_id FROM replaced_gene_tree_clades
 ) q1 
-INNER JOIN (SELECT DISTINCT replacement_label_or_cds_code FROM gene_lineage_events) q2 USING (replacement_label_or_cds_code);
+INNER JOIN (SELECT DISTINCT replacement_label_or_cds_code FROM gene_lineage_events) q2 USING (replacement_label_or_cds_code)
+WHERE replacement_label_or_cds_code NOT IN (SELECT replacement_label_or_cds_code FROM replacement_label_or_cds_code2gene_families);
 
-CREATE UNIQUE INDEX rlocds2genefam_rlocds ON replacement_label_or_cds_code2gene_families (replacement_label_or_cds_code);
-CREATE INDEX rlocds2genefam_genefam ON replacement_label_or_cds_code2gene_families (gene_family_id);
+CREATE UNIQUE INDEX IF NOT EXISTS rlocds2genefam_rlocds ON replacement_label_or_cds_code2gene_families (replacement_label_or_cds_code);
+CREATE INDEX IF NOT EXISTS rlocds2genefam_genefam ON replacement_label_or_cds_code2gene_families (gene_family_id);
 
 INSERT INTO gene_tree_label2cds_code (replacement_label_or_cds_code, cds_code) 
 SELECT replacement_label_or_cds_code, cds_code FROM (
@@ -7,13 +7,213 @@ import copy
 
 eventTypes = 'DTLSO'
 outtaxlab = '#OUTSIDE#'
+# Newick syntax delimiters; everything in between is a node label, possibly followed by ':' and a branch length
+nwkdelimpat = re.compile('[(),;]')
+nwktokpat = re.compile('[(),;]|[^(),;]+')
 
 def getOriSpeciesFromEventLab(eventlab, sgsep='_'):
 	# split at DT location separator '@', then possibly at T don/rec seprator '->', and finally shorten the species label if node is a leaf
 	elab = eventlab.split('@')[1] if '@' in eventlab else eventlab
 	return elab.split('->')[0].split(sgsep)[0]
 
-def parseALERecFile(nfrec, reftreelen=None, restrictclade=None, skipEventFreq=False, skipLines=False, nsample=[], returnDict=False):
+def iterRecGeneTreeLabels(recgtline):
+	"""yields the node labels (stripped from branch lengths) of a reconciled gene tree in ALE pseudo-Newick format"""
+	for tok in nwkdelimpat.split(recgtline):
+		lab = tok.split(':', 1)[0].strip()
+		if lab: yield lab
+
+def countUndatedRecGeneTreeEvents(recgtline, devtcount=None, spet=None, sgsep='_', weight=1):
+	"""count events on the node labels of one reconciled gene tree (undated ALE model); see countUndatedRecGeneTreeSampleEvents()
+	
+	counts are added to those of the dict 'devtcount' (updated in place and returned), each event occurrence counting for 'weight',
+	for instance the number of times the same reconciled gene tree was found in the sample.
+	"""
+	if devtcount is None: devtcount = {}
+	for nodelab in iterRecGeneTreeLabels(recgtline):
+		lineage = nodelab.split('.')
+		for i in range(1, len(lineage)):
+			eventlab = lineage[i]
+			if eventlab.startswith('D@'):
+				evtup = ('D', eventlab[2:])
+			elif eventlab.startswith('T@'):
+				evtup = ('T',)+tuple(eventlab[2:].split('->'))
+			else:
+				evtup = ('S', getOriSpeciesFromEventLab(eventlab, sgsep=sgsep))
+				preveventlab = lineage[i-1]
+				if spet and preveventlab!='':
+					# speciation-loss event, the loss being located in the sister lineage of that below/preceding on the lineage
+					closslabs = spet[eventlab].children_labels()
+					closslabs.remove(getOriSpeciesFromEventLab(preveventlab, sgsep=sgsep))
+					evtupl = ('L', closslabs[0])
+					devtcount[evtupl] = devtcount.get(evtupl, 0) + weight
+			devtcount[evtup] = devtcount.get(evtup, 0) + weight
+	return devtcount
+
+def countUndatedRecGeneTreeSampleEvents(recgtlines, spet=None, nsample=None, sgsep='_'):
+	"""count events in a whole sample of reconciled gene trees (undated ALE model), scanning every tree once
+	
+	'recgtlines' is an iterable of pseudo-newick strings, one per reconciled gene tree (e.g. the 'recgtlines' output of parseALERecFile()).
+	Node labels are tokenized like in parseUndatedRecGeneTree(), so the returned dict is keyed with the same event tuples:
+	('D', loc), ('T', don, rec), ('S', spe) and, only if the species tree 'spet' is provided, ('L', los).
+	Each event is counted as many times as it is found on a node label, i.e. the count reflects the sum of occurrences
+	in the sample, even when the same event occurs on several lineages of the same tree.
+	If 'nsample' is provided, the counts are converted to frequencies (count / nsample).
+	"""
+	devtcount = {}
+	for recgtline in recgtlines:
+		countUndatedRecGeneTreeEvents(recgtline, devtcount, spet=spet, sgsep=sgsep)
+	if nsample:
+		return {evtup:float(n)/nsample for evtup, n in devtcount.iteritems()}
+	else:
+		return devtcount
+
+def parseRecGeneTreeLabels(nwk):
+	"""parse a reconciled gene tree in ALE pseudo-Newick format into flat arrays of parent node indexes and node labels
+	
+	Nodes are indexed in pre-order: the root is node 0 (with parent index -1) and any node has a lower index than its children,
+	the nodes of a subtree being indexed contiguously. Branch lengths (and anything else than labels) are ignored.
+	Returns a tuple (parents, labels, children), where 'children' holds the list of child node indexes of every node,
+	leaves being the nodes with an empty list.
+	"""
+	parents = []
+	labels = []
+	children = []
+	cur = -1		# index of the currently open internal node
+	closed = -1		# index of the internal node that was just closed, still expecting its label
+	for tok in nwktokpat.findall(nwk.strip()):
+		if tok=='(':
+			k = len(parents)
+			parents.append(cur) ; labels.append('') ; children.append([])
+			if cur>=0: children[cur].append(k)
+			cur = k
+			closed = -1
+		elif tok==')':
+			closed = cur
+			cur = parents[cur]
+		elif tok==',':
+			closed = -1
+		elif tok==';':
+			break
+		else:
+			lab = tok.split(':', 1)[0].strip()
+			if closed>=0:
+				labels[closed] = lab
+				closed = -1
+			else:
+				# a leaf
+				k = len(parents)
+				parents.append(cur) ; labels.append(lab) ; children.append([])
+				if cur>=0: children[cur].append(k)
+	return (parents, labels, children)
+
+class RecGeneTreeNode(object):
+	"""node of a reconciled gene tree parsed with parseRecGeneTreeLabels(), with the subset of the tree2.Node interface used by event parsers
+	
+	This adapter only carries node labels and the tree topology, i.e. no branch length or support, 
+	and is much faster to build than a tree2.AnnotatedNode object. Node ids are the pre-order node indexes.
+	"""
+	__slots__ = ('parents', 'labels', 'childs', 'i')
+	def __init__(self, parents, labels, children, i=0):
+		self.parents = parents
+		self.labels = labels
+		self.childs = children
+		self.i = i
+	
+	def __repr__(self):
+		return "<RecGeneTreeNode %d: '%s'>"%(self.i, self.labels[self.i])
+	
+	def _node(self, i):
+		return RecGeneTreeNode(self.parents, self.labels, self.childs, i)
+	
+	def label(self):
+		return self.labels[self.i]
+	
+	def nodeid(self):
+		return self.i
+	
+	def is_leaf(self):
+		return not self.childs[self.i]
+	
+	def is_root(self):
+		return self.parents[self.i] < 0
+	
+	def go_father(self):
+		p = self.parents[self.i]
+		return self._node(p) if p>=0 else None
+	
+	father = property(go_father)
+	
+	def get_children(self):
+		return [self._node(c) for c in self.childs[self.i]]
+	
+	children = property(get_children)
+	
+	def iter_leaf_indexes(self):
+		# explicit stack to avoid recursion; yields leaves in the same (left-to-right) order as a pre-order traversal
+		stack = [self.i]
+		while stack:
+			k = stack.pop()
+			if self.childs[k]: stack += reversed(self.childs[k])
+			else: yield k
+	
+	def iter_leaf_labels(self):
+		for k in self.iter_leaf_indexes():
+			yield self.labels[k]
+	
+	def get_leaf_labels(self):
+		return list(self.iter_leaf_labels())
+	
+	def get_leaves(self):
+		return [self._node(k) for k in self.iter_leaf_indexes()]
+	
+	def nb_leaves(self):
+		return sum(1 for k in self.iter_leaf_indexes())
+
+def recGeneTreeFromLine(line, labelsOnly=False):
+	"""build a tree object from a line of reconciled gene tree in ALE pseudo-Newick format
+	
+	if labelsOnly is True, a light-weight RecGeneTreeNode object is returned instead of a tree2.AnnotatedNode one.
+	"""
+	if labelsOnly:
+		return RecGeneTreeNode(*parseRecGeneTreeLabels(line))
+	rectree = tree2.AnnotatedNode(nwk=line.strip('\n'), namesAsNum=True)
+	rectree.complete_node_ids()
+	return rectree
+
+def iterALERecGeneTreeLines(nfrec, offset, nsample=[]):
+	"""yields one by one the lines of reconciled gene trees of an ALE reconciliation file, starting from 'offset' in the file
+	
+	'offset' is the position of the first reconciled gene tree in the file, as recorded by parseALERecFile() under key 'recgtoffset'.
+	If 'nsample' is provided, only the lines with these indexes are yielded, and reading stops after the last of them.
+	"""
+	ssample = set(nsample)
+	kmax = max(ssample) if ssample else None
+	with open(nfrec, 'r') as frec:
+		frec.seek(offset)
+		line = frec.readline()
+		k = 0
+		while line and not line.startswith('#'):
+			if ssample and k > kmax: break
+			if (not ssample) or (k in ssample): yield line
+			line = frec.readline()
+			k += 1
+
+def iterALERecGeneTrees(nfrec, offset, nsample=[], labelsOnly=False):
+	"""yields one by one the reconciled gene trees of an ALE reconciliation file; see iterALERecGeneTreeLines() and recGeneTreeFromLine()"""
+	for line in iterALERecGeneTreeLines(nfrec, offset, nsample=nsample):
+		yield recGeneTreeFromLine(line, labelsOnly=labelsOnly)
+
+def parseALERecFile(nfrec, reftreelen=None, restrictclade=None, skipEventFreq=False, skipLines=False, nsample=[], returnDict=False, \
+                    streamRecGeneTrees=False, labelsOnly=False):
+	"""parse a reconciliation file from ALE, returning the reconciled species tree, the reconciled gene trees and the node-wise event frequencies
+	
+	if labelsOnly is True, reconciled gene trees are light-weight RecGeneTreeNode objects, only carrying the topology and node labels,
+	which is enough for event parsing with parseRecGeneTree().
+	if streamRecGeneTrees is True, the reconciled gene trees and their raw lines are not loaded in memory; 
+	instead, 'lrecgt' and 'recgtlines' are generators that read the file again and yield one tree (or line) at a time, 
+	so that peak memory is bounded by one tree. Each generator can only be consumed once. 
+	The number of (selected) reconciled gene trees in the file is available in the returned dict under key 'nrecgt'.
+	"""
 	line = ''
 	lrecgt = []
 	restrictlabs = []
@@ -37,16 +237,23 @@ def parseALERecFile(nfrec, reftreelen=None, restrictclade=None, skipEventFreq=Fa
 		subspetree = spetree
 	while not line.endswith('reconciled G-s:\n'):
 		line = frec.readline()
-	for i in range(2): line = frec.readline() # skips 2 lines
+	line = frec.readline() # skips 1 line
+	recgtoffset = frec.tell()
+	line = frec.readline()
 	# extract reconciled gene tree(s)
 	recgtlines = []
 	k = 0
+	nrecgt = 0
+	ssample = set(nsample)
+	kmax = max(ssample) if ssample else None
 	while not line.startswith('#'):
-		if (not nsample) or (k in nsample):
-			if not skipLines: recgtlines.append(line)
-			rectree = tree2.AnnotatedNode(nwk=line.strip('\n'), namesAsNum=True)
-			rectree.complete_node_ids()
-			lrecgt.append(rectree)
+		# no need to read further lines when only the sampled trees are needed
+		if ssample and skipEventFreq and k > kmax: break
+		if (not ssample) or (k in ssample):
+			nrecgt += 1
+			if not streamRecGeneTrees:
+				if not skipLines: recgtlines.append(line)
+				lrecgt.append(recGeneTreeFromLine(line, labelsOnly=labelsOnly))
 		line = frec.readline()
 		k += 1
 	dnodeevt = {}
@@ -58,11 +265,76 @@ def parseALERecFile(nfrec, reftreelen=None, restrictclade=None, skipEventFreq=Fa
 			lsp = line.strip('\n').split('\t')
 			dnodeevt[lsp[1]] = [float(s) for s in lsp[2:]]
 	frec.close()
+	if streamRecGeneTrees:
+		lrecgt = iterALERecGeneTrees(nfrec, recgtoffset, nsample=nsample, labelsOnly=labelsOnly)
+		if not skipLines: recgtlines = iterALERecGeneTreeLines(nfrec, recgtoffset, nsample=nsample)
 	if returnDict:
-		return {'spetree':spetree, 'subspetree':subspetree, 'lrecgt':lrecgt, 'recgtlines':recgtlines, 'restrictlabs':restrictlabs, 'dnodeevt':dnodeevt}
+		return {'spetree':spetree, 'subspetree':subspetree, 'lrecgt':lrecgt, 'recgtlines':recgtlines, 'restrictlabs':restrictlabs, 'dnodeevt':dnodeevt, \
+		        'nrecgt':nrecgt, 'recgtoffset':recgtoffset}
 	else:
 		return [spetree, subspetree, lrecgt, recgtlines, restrictlabs, dnodeevt]
 
+def _preorderRecGeneTree(recgt):
+	"""flatten a (reconciled gene) tree into its list of nodes in pre-order, with the list of the index of their parent (-1 for the root)
+	
+	uses an explicit stack rather than recursion, so that very deep trees can be traversed.
+	"""
+	if isinstance(recgt, RecGeneTreeNode) and recgt.i==0:
+		# nodes are already indexed in pre-order
+		return [recgt._node(k) for k in xrange(len(recgt.labels))], recgt.parents
+	lnodes = []
+	lparents = []
+	stack = [(recgt, -1)]
+	while stack:
+		node, p = stack.pop()
+		k = len(lnodes)
+		lnodes.append(node)
+		lparents.append(p)
+		stack += [(child, k) for child in reversed(node.get_children())]
+	return lnodes, lparents
+
+def _flagTaggedSubtrees(lnodes, lparents, tag):
+	"""flag nodes whose leaves all share the same label extension (what follows the first '_'), this extension containing 'tag'
+	
+	flags are computed bottom-up in one pass over the nodes listed in pre-order, as returned by _preorderRecGeneTree().
+	"""
+	n = len(lnodes)
+	unset = object()
+	exts = [unset]*n	# the extension shared by all leaves below the node
+	mixed = [False]*n	# whether leaves below the node have different extensions
+	flags = [False]*n
+	for k in xrange(n-1, -1, -1):
+		# children are always visited before their parent
+		if lnodes[k].is_leaf():
+			exts[k] = lnodes[k].label().split('_', 1)[1]
+		if not mixed[k]:
+			flags[k] = (tag in exts[k])
+		p = lparents[k]
+		if p<0: continue
+		if mixed[k]: mixed[p] = True
+		elif exts[p] is unset: exts[p] = exts[k]
+		elif exts[p]!=exts[k]: mixed[p] = True
+	return flags
+
+def _walkRecGeneTree(recgt, parseNode, excludeTaggedSubtrees=None):
+	"""apply the function 'parseNode' to the nodes of a reconciled gene tree in pre-order, i.e. parents always before their children
+	
+	if excludeTaggedSubtrees is specified, the nodes below a node whose leaves all bear this tag (see _flagTaggedSubtrees()) are skipped,
+	the tagged node itself being parsed. 
+	"""
+	lnodes, lparents = _preorderRecGeneTree(recgt)
+	if excludeTaggedSubtrees: flags = _flagTaggedSubtrees(lnodes, lparents, excludeTaggedSubtrees)
+	skip = [False]*len(lnodes)
+	for k, node in enumerate(lnodes):
+		p = lparents[k]
+		if p>=0 and skip[p]:
+			skip[k] = True
+			continue
+		parseNode(node)
+		if excludeTaggedSubtrees and flags[k]:
+			# the subtree below this node is an artificial addition to the reconciled gene tree and should be skipped
+			skip[k] = True
+
 def parseDatedRecGeneTree(recgt, spet, dexactevt={}, recgtsample=None, nsample=1, sgsep='_', restrictlabs=[], \
                           fillDTLSdict=True, recordEvTypes='ODTL', excludeTaggedLeaves=None, excludeTaggedSubtrees=None, joinTdonrec=True, verbose=False):
 	def parseDatedRecGTNode(node, dlevt, dnodeallevt):
@@ -70,7 +342,7 @@ def parseDatedRecGeneTree(recgt, spet, dexactevt={}, recgtsample=None, nsample=1
 		nodeid = node.nodeid()
 		if verbose: print '#', nodeid, ':', nodelab
 		if not nodelab: raise ValueError, "unannotated node:\n%s"%str(node)
-		if node.is_leaf() and (excludeTaggedLeaves in nodelab):
+		if excludeTaggedLeaves and node.is_leaf() and (excludeTaggedLeaves in nodelab):
 			# the species assignment of this leaf is not certain (inferred)
 			# and thus events leading directly to this leaf are not to be trusted and should be skipped
 			return
@@ -128,19 +400,12 @@ def parseDatedRecGeneTree(recgt, spet, dexactevt={}, recgtsample=None, nsample=1
 				# use location of oldest event
 				evloc = lineage[-1][1]
 				dnodeallevt[nodeid].append(('O', evloc))
-		if excludeTaggedSubtrees:
-			alllabext = [lab.split('_', 1)[1] for lab in node.iter_leaf_labels()]
-			if (excludeTaggedSubtrees in alllabext[0]) and (len(set(alllabext)) == 1):
-				# the subtree below this node is an artificial addition to the reconciled gene tree and should be skipped
-				return
-		for child in node.get_children():
-			# use recursion to be able to exclude subtrees
-			parseDatedRecGTNode(child, dlevt, dnodeallevt)
 		return
 	
 	dnodeallevt = {}
 	dlevt = {e:[] for e in eventTypes}
-	parseDatedRecGTNode(recgt, dlevt, dnodeallevt) # recursive function call
+	# iterative traversal, skipping the subtrees made of tagged leaves
+	_walkRecGeneTree(recgt, lambda node: parseDatedRecGTNode(node, dlevt, dnodeallevt), excludeTaggedSubtrees=excludeTaggedSubtrees)
 	return dlevt, dnodeallevt
 	
 def parseUndatedRecGeneTree(recgt, spet, dexactevt={}, recgtsample=None, nsample=1, sgsep='_', restrictlabs=[], \
@@ -148,7 +413,7 @@ def parseUndatedRecGeneTree(recgt, spet, dexactevt={}, recgtsample=None, nsample
 	def parseUndatedRecGTNode(node, dlevt, dnodeallevt):
 		nodelab = node.label()
 		if not nodelab: raise ValueError, "unannotated node:\n%s"%str(node)
-		if node.is_leaf() and (excludeTaggedLeaves in nodelab):
+		if excludeTaggedLeaves and node.is_leaf() and (excludeTaggedLeaves in nodelab):
 			# the species assignment of this leaf is not certain (inferred)
 			# and thus events leading directly to this leaf are not to be trusted and should be skipped
 			return
@@ -164,7 +429,6 @@ def parseUndatedRecGeneTree(recgt, spet, dexactevt={}, recgtsample=None, nsample
 					# duplication event
 					dup = eventlab.split('D@')[1]
 					evtup = ('D', dup)
-					fevt = dexactevt.setdefault(evtup, float(recgtsample.count(eventlab))/nsample)
 					if restrictlabs and not (dup in restrictlabs): continue
 					if fillDTLSdict: dlevt['D'].append(dup)
 					dnodeallevt.setdefault(nodeid, []).append(evtup)
@@ -174,7 +438,6 @@ def parseUndatedRecGeneTree(recgt, spet, dexactevt={}, recgtsample=None, nsample
 					translab = eventlab.split('T@')[1]
 					don, rec = translab.split('->')
 					evtup = ('T', don, rec)
-					fevt = dexactevt.setdefault(evtup, float(recgtsample.count(eventlab))/nsample)
 					if restrictlabs and not ((don in restrictlabs) and (rec in restrictlabs)): continue
 					if fillDTLSdict: dlevt['T'].append((don, rec))
 					dnodeallevt.setdefault(nodeid, []).append(evtup)
@@ -183,10 +446,6 @@ def parseUndatedRecGeneTree(recgt, spet, dexactevt={}, recgtsample=None, nsample
 				if ('S' in recordEvTypes):
 					spe = getOriSpeciesFromEventLab(eventlab, sgsep=sgsep)
 					evtup = ('S', spe)
-					#~ evtpat = "(\)\.|[\(,])%s"%eventlab	# pattern captures the event at an internal node or a leaf 
-					evtpat = "([\.\(,]%s)"%eventlab	# pattern captures the event at an internal node or a leaf 
-					#~ print "count occurence in sample of pattern:", evtpat
-					fevt = dexactevt.setdefault(evtup, float(len(re.search(evtpat, recgtsample).groups()))/nsample)
 					if fillDTLSdict: dlevt['S'].append(spe)
 					dnodeallevt.setdefault(nodeid, []).append(evtup)
 				if preveventlab!='':
@@ -199,26 +458,21 @@ def parseUndatedRecGeneTree(recgt, spet, dexactevt={}, recgtsample=None, nsample
 						if len(closslabs)>1: raise IndexError, "non binary species tree at node %s (children: %s)"%(lineage[-1], repr(ploss.get_children_labels()))
 						los = closslabs[0]
 						evtup = ('L', los)
-						fevt = dexactevt.setdefault(evtup, float(re.search("([^\)]\.%s)"%eventlab, recgtsample).groups)/nsample)
 						if restrictlabs and not (los in restrictlabs): continue
 						if fillDTLSdict: dlevt['L'].append(los)
 						dnodeallevt.setdefault(nodeid, []).append(evtup)
 				#~ else:
 					#~ # a simple speciation event ; already delt with
 					#~ pass
-		if excludeTaggedSubtrees:
-			alllabext = [lab.split('_', 1)[1] for lab in node.iter_leaf_labels()]
-			if (len(set(alllabext)) == 1) and (excludeTaggedSubtrees in alllabext[0]):
-				# the subtree below this node is an artificial addition to the reconciled gene tree and should be skipped
-				return
-		for child in node.get_children():
-			# use recursion to be able to exclude subtrees
-			parseUndatedRecGTNode(child, dlevt, dnodeallevt)
 		return
 	
+	if (recgtsample is not None) and not dexactevt:
+		# event frequencies were not pre-computed: count them once for the whole sample
+		dexactevt.update(countUndatedRecGeneTreeSampleEvents(recgtsample.splitlines(), spet, nsample=nsample, sgsep=sgsep))
 	dnodeallevt = {}
 	dlevt = {e:[] for e in eventTypes}
-	parseUndatedRecGTNode(recgt, dlevt, dnodeallevt) # recursive function call
+	# iterative traversal, skipping the subtrees made of tagged leaves
+	_walkRecGeneTree(recgt, lambda node: parseUndatedRecGTNode(node, dlevt, dnodeallevt), excludeTaggedSubtrees=excludeTaggedSubtrees)
 	return dlevt, dnodeallevt
 
 def parseRecGeneTree(recgt, spet, ALEmodel='undated', **kw):
@@ -238,11 +492,12 @@ def parseRecGeneTree(recgt, spet, ALEmodel='undated', **kw):
 	'rec' and optionally 'don' (for Ts only) are species tree node labels where the event where inferred,
 	and 'freq' the event frequency of this event in the whole sample.
 	
-	Frequency of events is searched in the WHOLE reconciled gene tree sample 
-	provided as the list of pseudo-newick strings, using exact string matching (only for DT).
+	Frequency of events in the WHOLE reconciled gene tree sample (undated model only) is recorded in the 'dexactevt' dict, 
+	which is best pre-computed once per sample with countUndatedRecGeneTreeSampleEvents(); if it is passed empty along 
+	with the sample as a concatenated string of pseudo-newick trees 'recgtsample', it will be filled on the first call.
 	In case of the same pattern of event occurring repeatedly in the same tree, e.g. same T@DON->REC in two paralogous lineages 
 	(can likely happen with tandem duplicates...), the count will reflect the sum of all such events. 
-	Records of event frequencies in both 'dlevt' and 'dnodeallevt' are thus NOT differentiated by lineage.
+	Records of event frequencies in 'dexactevt' are thus NOT differentiated by lineage.
 	"""
 	if ALEmodel=='undated':
 		return parseUndatedRecGeneTree(recgt, spet, **kw)
@@ -9,6 +9,8 @@ import tree2
 from ptg_utils import *
 import parseALErec as pAr
 import re
+import hashlib
+from collections import Counter
 
 ## Parameters
 # file parsing parameter
@@ -26,35 +28,8 @@ gefagr = ['cds_code','replaced_cds_code','gene_family_id']
 
 ############ Functions
 
-def eventLineages(recgt, dnodeallevt, ALEmodel='undated', recordEvTypes='DTS', onlyLeaves=[], deDupMatching=replacementcladepat):
-	"""oreder events by gene lineage in the reconciled gene tree
-	
-	from a reconciled gene tree and the dict containing all the events in this tree in the format {node_id:(X, [don, ]rec), ...}, 
-	return a list of event tuples for each gene lineage in the reconciled gene tree, i.e. the chain of events located above every tip of the tree"""
-	def get_eventlineage(node, dnodeallevt, allevtlineages):
-		if not node: return []
-		nodeid = node.nodeid()
-		eventpath = allevtlineages.get(nodeid)
-		if not (eventpath is None):
-			#~ print '#', nodeid
-			#~ print 'found previous record'
-			return eventpath
-		else:
-			# filter events
-			eventpath = [evtup for evtup in dnodeallevt.get(nodeid, []) if (evtup[0] in recordEvTypes)]
-			eventpath += get_eventlineage(node.father, dnodeallevt, allevtlineages)
-			#~ print '#', nodeid
-			#~ print 'allevtlineages:', allevtlineages
-			#~ print 'eventpath:', eventpath
-			if not node.is_leaf():
-				#~ print 'recording'
-				# record lineage of events from this node to the root ; dynamic programming !
-				allevtlineages[nodeid] = eventpath
-				#~ print 'allevtlineages:', allevtlineages
-			return eventpath
-	
-	evtlineages = {}	# only lineages from the leaves to be returned
-	allevtlineages = {} # cache dict for events at nodes shared by several leaves
+def lineageLeavesAndLabels(recgt, ALEmodel='undated', onlyLeaves=[], deDupMatching=replacementcladepat):
+	"""list the leaves (and their gene label) of the reconciled gene tree for which a lineage of events is to be reported"""
 	if ALEmodel=='undated':
 		leavesandlabels = [(leaf, leaf.label().split('.')[0]) for leaf in recgt.get_leaves()]
 	elif ALEmodel=='dated':
@@ -78,10 +53,121 @@ def eventLineages(recgt, dnodeallevt, ALEmodel='undated', recordEvTypes='DTS', o
 			else:
 				lela.append((leaf, leaflab))
 		leavesandlab = lela
-	for leaf, leaflab in leavesandlab:
+	return leavesandlab
+
+def eventLineages(recgt, dnodeallevt, ALEmodel='undated', recordEvTypes='DTS', onlyLeaves=[], deDupMatching=replacementcladepat):
+	"""oreder events by gene lineage in the reconciled gene tree
+	
+	from a reconciled gene tree and the dict containing all the events in this tree in the format {node_id:(X, [don, ]rec), ...}, 
+	return a list of event tuples for each gene lineage in the reconciled gene tree, i.e. the chain of events located above every tip of the tree"""
+	def get_eventlineage(node, dnodeallevt, allevtlineages):
+		# climb up to the closest ancestor with a recorded lineage of events (or above the root), without recursion
+		path = []
+		eventpath = None
+		while node:
+			eventpath = allevtlineages.get(node.nodeid())
+			if not (eventpath is None): break
+			path.append(node)
+			node = node.father
+		if eventpath is None: eventpath = []
+		# then build lineages back down
+		for node in reversed(path):
+			# filter events
+			eventpath = [evtup for evtup in dnodeallevt.get(node.nodeid(), []) if (evtup[0] in recordEvTypes)] + eventpath
+			if not node.is_leaf():
+				# record lineage of events from this node to the root ; dynamic programming !
+				allevtlineages[node.nodeid()] = eventpath
+		return eventpath
+	
+	evtlineages = {}	# only lineages from the leaves to be returned
+	allevtlineages = {} # cache dict for events at nodes shared by several leaves
+	for leaf, leaflab in lineageLeavesAndLabels(recgt, ALEmodel=ALEmodel, onlyLeaves=onlyLeaves, deDupMatching=deDupMatching):
 		evtlineages[leaflab] = get_eventlineage(leaf, dnodeallevt, allevtlineages)
 	return evtlineages
 
+class EventLineageTrie(object):
+	"""lineages of events stored as paths in a trie (prefix tree) rooted in the past
+	
+	Each trie node holds one event (typically an integer species tree event id) and the index of the trie node
+	of the preceding (older) event on the lineage. Lineages that share their history towards the gene tree root
+	share the same trie nodes, within a reconciled gene tree and across all the trees of a sample.
+	A lineage is referred to by the index of its most recent trie node; index -1 refers to the empty lineage.
+	"""
+	def __init__(self):
+		self.parents = []
+		self.events = []
+		self.dchild = {}
+	
+	def __len__(self):
+		return len(self.events)
+	
+	def addEvent(self, t, event):
+		"""return the index of the lineage extending lineage 't' with the (more recent) 'event', creating it if needed"""
+		k = (t, event)
+		c = self.dchild.get(k)
+		if c is None:
+			c = len(self.events)
+			self.dchild[k] = c
+			self.parents.append(t)
+			self.events.append(event)
+		return c
+	
+	def iterLineage(self, t):
+		"""yield the events of lineage 't', most recent first (i.e. in the same order as lists returned by eventLineages())"""
+		while t>=0:
+			yield self.events[t]
+			t = self.parents[t]
+	
+	def getLineage(self, t, unique=False):
+		if unique: return set(self.iterLineage(t))
+		else: return list(self.iterLineage(t))
+	
+	def addEventLineages(self, recgt, dnodeallevt, ALEmodel='undated', recordEvTypes='DTS', onlyLeaves=[], deDupMatching=replacementcladepat, \
+	                     translateEvent=None):
+		"""add the lineages of events of a reconciled gene tree to the trie; return their index, as a dict {leaflab:t}
+		
+		arguments are the same as for eventLineages(); if provided, 'translateEvent' is applied to every event tuple
+		before storing it in the trie, events for which it returns None being skipped.
+		"""
+		dnodetrie = {}	# cache dict for lineages at nodes shared by several leaves
+		dleaftrie = {}
+		for leaf, leaflab in lineageLeavesAndLabels(recgt, ALEmodel=ALEmodel, onlyLeaves=onlyLeaves, deDupMatching=deDupMatching):
+			# climb up to the closest ancestor with a recorded lineage of events (or above the root)
+			node = leaf
+			path = []
+			t = -1
+			while node:
+				nt = dnodetrie.get(node.nodeid())
+				if not (nt is None):
+					t = nt
+					break
+				path.append(node)
+				node = node.father
+			# then extend lineage back down, from the oldest to the most recent event
+			for node in reversed(path):
+				for evtup in reversed(dnodeallevt.get(node.nodeid(), [])):
+					if not (evtup[0] in recordEvTypes): continue
+					event = translateEvent(evtup) if translateEvent else evtup
+					if not (event is None): t = self.addEvent(t, event)
+				dnodetrie[node.nodeid()] = t
+			dleaftrie[leaflab] = t
+		return dleaftrie
+	
+	def countLineageEvents(self, dlineagehits, unique=False):
+		"""count events by gene lineage, without building the full lists of events
+		
+		'dlineagehits' is a dict {leaflab:{t:weight}} recording the number of times (weight) lineage 't' was observed above gene 'leaflab';
+		if unique is True, events occurring several times on a lineage are only counted once. 
+		Return a dict {leaflab:Counter({event:count})}.
+		"""
+		devtlineagecount = {}
+		for leaflab, dhits in dlineagehits.iteritems():
+			cevtlineage = devtlineagecount[leaflab] = Counter()
+			for t, w in dhits.iteritems():
+				for event in (set(self.iterLineage(t)) if unique else self.iterLineage(t)):
+					cevtlineage[event] += w
+		return devtlineagecount
+
 def translateRecStree(colspetree, refspetree):	
 	"""matching branches of input collapsed species tree with those of full (i.e. uncollapsed) reference species tree; edit labels of collapsed tree and return dictionary of changed labels"""
 	dcol2fullspenames = {}
@@ -152,13 +238,25 @@ def translateEventLineage(deventlineages, dcol2fullspenames, drefspeeventTup2Ids
 		# lighter version encoding events just by an integer referring to species tree events reference table
 		return {nodelab:[drefspeeventTup2Ids[evtup] for evtup in levtup] for nodelab, levtup in trline.iteritems()}
 
+def translateEvent(evtloc, dcol2fullspenames, drefspeeventTup2Ids=None, verbose=False):
+	"""translate a single event tuple like translateEventLineage() does; return None for events to be ignored"""
+	if dcol2fullspenames:
+		trloc = tuple(dcol2fullspenames[x] for x in evtloc[1:])
+		if len(trloc)>1 and len(set(trloc))==1:
+			# trivial transfer event due to donor and the recipient in the collapsed species tree being nested in the full tree
+			if verbose: print "ignore:", evtloc, ' ->', trloc
+			return None
+		evtloc = evtloc[:1]+trloc
+	if drefspeeventTup2Ids: return drefspeeventTup2Ids[evtloc]
+	else: return evtloc
+
 def parseRec(nfrec, refspetree=None, ALEmodel='undated', drefspeeventTup2Ids=None, onlyLineages=[], recordEvTypes='DTS', minFreqReport=0, returnDict=True, \
              lineageTableOutDir=None, noTranslateSpeTree=False, allEventByLineageByGenetree=False, verbose=False):
 	"""parse reconciled gene tree sample, returning sampled events by gene lineage
 	
 	if allEventByLineageByGenetree is True, return more detailed data, stored in a dict with the following elements: 
 	{
-	 'allrectevtlineages': <dict of all single observed events by lineage by gene tree in the sample>, 
+	 'allrectevtlineages': <dict of the distinct lineages of events observed above each gene, with the number of gene trees in the sample where they occur>, 
 	 'devtlineagecount': <dict of all events and total observed frequency by lineage>, 
 	 'dexactevt': <dict of frequencies of events, irrespective of the lineage in which they ocurred>'
 	}
@@ -166,10 +264,12 @@ def parseRec(nfrec, refspetree=None, ALEmodel='undated', drefspeeventTup2Ids=Non
 	"""
 	if not (returnDict or lineageTableOutDir): raise ValueError, "no output option chosen"
 	print nfrec
-	# parse reconciliation file and extract collapsed species tree, mapping of events (with freq.) on the species tree, and reconciled gene trees
-	colspetree, subspetree, lrecgt, recgtlines, restrictlabs, dnodeevt = pAr.parseALERecFile(nfrec)
-	nsample = len(lrecgt)
-	recgtsample = ''.join(recgtlines)
+	# parse reconciliation file and extract collapsed species tree, mapping of events (with freq.) on the species tree, and reconciled gene trees;
+	# reconciled gene trees (and their raw lines) are streamed from the file one at a time rather than all loaded in memory,
+	# and are parsed into light-weight objects only carrying the tree topology and node labels
+	dparserec = pAr.parseALERecFile(nfrec, returnDict=True, streamRecGeneTrees=True, labelsOnly=True)
+	colspetree = dparserec['spetree']
+	nsample = dparserec['nrecgt']
 	if not noTranslateSpeTree:
 		tcolspetree, dcol2fullspenames = translateRecStree(colspetree, refspetree)
 	else:
@@ -184,55 +284,71 @@ def parseRec(nfrec, refspetree=None, ALEmodel='undated', drefspeeventTup2Ids=Non
 	if ALEmodel=='dated':
 		# add reference for '#OUTSIDE#' taxon
 		dcol2fullspenames[outtaxlab] = outtaxlab
-	# parse reconciled gene trees
-	# and extract (exact) event-wise event frequency
+	# identical reconciled gene trees (i.e. identical scenarios) are frequent in ALE samples:
+	# a first pass over the sample records the multiplicity of each distinct reconciled gene tree line (hashed to save memory)
+	drecgtmult = {}
+	for recgtline in dparserec['recgtlines']:
+		h = hashlib.md5(recgtline.rstrip('\n')).digest()
+		drecgtmult[h] = drecgtmult.get(h, 0) + 1
+	ndistinct = len(drecgtmult)
+	print "%d distinct reconciled gene trees out of %d in the sample (dedup ratio: %.3g)"%(ndistinct, nsample, float(ndistinct)/nsample if nsample else 1.0)
+	# extract (exact) event-wise event frequency along the second pass, counting each distinct tree once, weighted by its multiplicity
 	dexactevt = {}
-	devtlineagecount = {}
-	allrectevtlineages = {}
-	for i, recgt in enumerate(lrecgt):
+	cspetree = colspetree if ('L' in recordEvTypes) else None
+	# parse reconciled gene trees: each distinct scenario is parsed and walked only once
+	# lineages of events are stored in a trie shared by all the trees of the sample, 
+	# where events are translated to the reference species tree (and coded as integer ids) once per distinct event
+	evtrie = EventLineageTrie()
+	dtransevt = {}
+	def translateEventCached(evtup):
+		if evtup in dtransevt: return dtransevt[evtup]
+		tevt = dtransevt[evtup] = translateEvent(evtup, dcol2fullspenames, drefspeeventTup2Ids, verbose=verbose)
+		return tevt
+	# translated events are only counted once per lineage
+	uniqueevt = bool(dcol2fullspenames)
+	dlineagehits = {}
+	for recgtline in pAr.iterALERecGeneTreeLines(nfrec, dparserec['recgtoffset']):
+		h = hashlib.md5(recgtline.rstrip('\n')).digest()
+		mult = drecgtmult.pop(h, 0)
+		if not mult: continue	# already seen
+		if ALEmodel=='undated':
+			pAr.countUndatedRecGeneTreeEvents(recgtline, dexactevt, spet=cspetree, weight=mult)
+		recgt = pAr.recGeneTreeFromLine(recgtline, labelsOnly=True)
 		# gather scenario-scpecific events (i.e. dependent on reconciled gene tree topology, which varies among the sample)
-		dlevt, dnodeallevt = pAr.parseRecGeneTree(recgt, colspetree, ALEmodel=ALEmodel, dexactevt=dexactevt, recgtsample=recgtsample, \
+		dlevt, dnodeallevt = pAr.parseRecGeneTree(recgt, colspetree, ALEmodel=ALEmodel, dexactevt=dexactevt, \
 		                                          nsample=nsample, fillDTLSdict=False, recordEvTypes=recordEvTypes, \
 		                                          excludeTaggedLeaves=collapsedcladetag, excludeTaggedSubtrees=replacementcladetag, verbose=verbose)
 		# here events involving a replcement clade (RC) or leaf (CC) are excluded
-		# * 'dexactevt' is used as cache to store frequencies of event s as inferred from regex searches of the event pattern
+		# * 'dexactevt' stores frequencies of events as counted over the whole sample;
 		# these frequencies are not specific to gene lineages, but aggregate the counts over the whole gene family
 		# * 'dlevt' is of no use and here returned empty because of fillDTLSdict=False
 		# would it not be empty, it could be translated to the full reference tree with:
 		# tdlevt = {etype:translateEventList(ldtl, dcol2fullspenames, drefspeevents) for etype, ldtl in dlevt.iteritems()}
-		evtlineages = eventLineages(recgt, dnodeallevt, ALEmodel=ALEmodel, onlyLeaves=onlyLineages, recordEvTypes=recordEvTypes)
-		print 'evtlineages:', evtlineages
-		tevtlineages = translateEventLineage(evtlineages, dcol2fullspenames, drefspeeventTup2Ids)
-		print 'tevtlineages:', tevtlineages
-		
-		if allEventByLineageByGenetree:
-			# one way to proceed is to build the object 'allrectevtlineages'
-			# a dict that contains all events in a lineage, 
-			# for all the lineages in reconciled gene tree, 
-			# for all the reconcile gene trees in the ALE sample.
-			# IT CAN BE A VERY HEAVY OBJECT.
-			for geneleaflab, evtlineage in tevtlineages.iteritems():
-				allrectevtlineages.setdefault(geneleaflab, []).append(evtlineage)
-		else:
-			# another way is to aggregate data immediately
-			# might be slower due to many updates of the 'devtlineagecount' dict,
-			# but more efficient in memory use
-			for geneleaflab, evtlineage in tevtlineages.iteritems():
-				for evtup in evtlineage:
-					nevtup = devtlineagecount.setdefault(geneleaflab, {}).setdefault(evtup, 0)
-					devtlineagecount[geneleaflab][evtup] = nevtup + 1
-	
+		dleaftrie = evtrie.addEventLineages(recgt, dnodeallevt, ALEmodel=ALEmodel, onlyLeaves=onlyLineages, recordEvTypes=recordEvTypes, \
+		                                    translateEvent=translateEventCached)
+		if verbose:
+			print 'tevtlineages:', {geneleaflab:evtrie.getLineage(t, unique=uniqueevt) for geneleaflab, t in dleaftrie.iteritems()}
+		# record the number of times each lineage is observed above each gene
+		for geneleaflab, t in dleaftrie.iteritems():
+			dhits = dlineagehits.setdefault(geneleaflab, {})
+			dhits[t] = dhits.get(t, 0) + mult
+	if verbose: print "%d nodes in the trie of event lineages"%len(evtrie)
+	if ALEmodel=='undated' and nsample:
+		dexactevt = {evtup:float(n)/nsample for evtup, n in dexactevt.iteritems()}
+	
+	# aggregate data in per-lineage histograms, so that memory use is proportional to the number of distinct events
+	devtlineagecount = evtrie.countLineageEvents(dlineagehits, unique=uniqueevt)
+	allrectevtlineages = {}
 	if allEventByLineageByGenetree:
-		devtlineagecount = {}
-		for geneleaflab, allreclineages in allrectevtlineages.iteritems():
-			allrecevt = reduce(lambda x, y: x+y, allreclineages)
-			# combine event counts across the sample
-			fevent = {evtup:allrecevt.count(evtup) for evtup in set(allrecevt)}
-			if minFreqReport>0:
-				# skips the low-frequency events
-				if float(fevent)/nsample < minFreqReport: continue
-			devtlineagecount[geneleaflab] = fevent
-	elif minFreqReport>0:
+		# more detailed data: histogram of the distinct event lineages leading to each gene,
+		# with the number of reconciled gene trees in the sample where they were observed
+		for geneleaflab, dhits in dlineagehits.iteritems():
+			clineages = allrectevtlineages[geneleaflab] = Counter()
+			for t, w in dhits.iteritems():
+				lineagekey = frozenset(evtrie.iterLineage(t)) if uniqueevt else tuple(evtrie.iterLineage(t))
+				clineages[lineagekey] += w
+	
+	if minFreqReport>0:
 		# cleanup by deleting low-frequency events a posteriori
 		for geneleaflab, eventlineage in devtlineagecount.iteritems():
 			for evtup, fevent in eventlineage.items():
@@ -260,8 +376,7 @@ def parseRec(nfrec, refspetree=None, ALEmodel='undated', drefspeeventTup2Ids=Non
 		if allEventByLineageByGenetree:
 			retd['allrectevtlineages'] = allrectevtlineages
 			retd['dexactevt'] = dexactevt
-	else:
-		return retd
+	return retd
 
 # 
 def parseRecTupArgs(args):
@@ -271,6 +386,19 @@ def parseRecTupArgs(args):
 	                onlyLineages=onlyLineages, recordEvTypes=recordEvTypes, minFreqReport=minFreqReport, returnDict=returnDict, \
 	                lineageTableOutDir=lineageTableOutDir, verbose=verbose)
 
+# read-only arguments of parseRec() common to all reconciliation files, 
+# set once per (worker) process rather than passed along with every task
+parseRecContext = {}
+
+def initParseRecContext(context):
+	"""set the arguments common to all parseRec() calls in this process; used as initializer of worker pools"""
+	parseRecContext.clear()
+	parseRecContext.update(context)
+
+def parseRecInContext(nfrec):
+	"""wrapper function with all arguments but the input reconciliation file taken from the process-wide context"""
+	return parseRec(nfrec, **parseRecContext)
+
 def loadRecGeneTreeLabelAliasesAndListRecFiles(nflnfrec, nfgenefamlist=None, dircons=None, dirrepl=None, nbthreads=1, verbose=False):
 	"""parse data relating to the genes and gene families to process.
 	
@@ -305,81 +433,251 @@ def loadRefPopTree(nfrefspetree, nfpop=None):
 	dspe2pop = getdspe2pop(lnamepops)
 	return (refspetree, dspe2pop)
 	
-def generateEventRefDB(refspetree, ALEmodel='undated', refTreeTableOutDir=None, TfromOutside=True):
-	"""generates a dict of event tuples (of the form (X, [don, ]rec)). 
+class SpeTreeEventIndex(object):
+	"""index of the events that can be located on a reference species tree, mapping event tuples (of the form (X, [don, ]rec)) to integer ids
+	
+	Event ids are computed arithmetically from the rank of species tree nodes in the tree iteration order,
+	instead of being stored in a dict that would hold all the O(n^2) possible transfer events.
+	They follow the same layout as the event table historically generated by generateEventRefDB(), i.e. for a tree of n nodes:
+	- for the node of rank p, ids p*(n+2) to p*(n+2)+n+1 refer to events D, T from each other node (in tree order;
+	  with event tuple ('T', node, other node)), L and S;
+	- ids n*(n+2)+p refer to O events, followed by id n*(n+2)+n for O outside the tree;
+	- (if TfromOutside) ids n*(n+2)+n+1+p refer to transfers from outside the tree, with event tuple ('T', outtaxlab, node).
+	
+	This object behaves like a read-only dict {evtup:eventid}; its inverse() method returns a read-only dict-like object {eventid:evtup}.
+	"""
+	def __init__(self, refspetree, TfromOutside=True):
+		self.labels = []
+		self.nodeids = []
+		for node in refspetree:
+			self.labels.append(node.label())
+			self.nodeids.append(node.nodeid())
+		self.dlab2rank = dict((lab, p) for p, lab in enumerate(self.labels))
+		self.n = n = len(self.labels)
+		self.outnid = max([0]+self.nodeids) + 1
+		self.TfromOutside = TfromOutside
+		self.blocksize = n + 2
+		self.ostart = n * self.blocksize
+		self.tostart = self.ostart + n + 1
+		self.nevents = self.tostart + (n if TfromOutside else 0)
+	
+	def encode(self, evtup):
+		"""return the id of an event tuple; raise KeyError if the event is not defined on the reference tree"""
+		try:
+			et = evtup[0]
+			if et=='O':
+				if len(evtup)==2:
+					if evtup[1]==outtaxlab: return self.ostart + self.n
+					return self.ostart + self.dlab2rank[evtup[1]]
+			elif et=='T':
+				if len(evtup)==3:
+					if evtup[1]==outtaxlab:
+						if self.TfromOutside: return self.tostart + self.dlab2rank[evtup[2]]
+					else:
+						p = self.dlab2rank[evtup[1]]
+						q = self.dlab2rank[evtup[2]]
+						if q!=p: return p*self.blocksize + 1 + (q if q<p else q-1)
+			elif len(evtup)==2:
+				p = self.dlab2rank[evtup[1]]
+				if et=='D': return p*self.blocksize
+				elif et=='L': return p*self.blocksize + self.n
+				elif et=='S': return p*self.blocksize + self.n + 1
+		except (KeyError, IndexError, TypeError):
+			pass
+		raise KeyError, evtup
+	
+	def decode(self, eventid):
+		"""return the event tuple corresponding to an event id; raise KeyError if the id is out of range"""
+		if not isinstance(eventid, (int, long)) or eventid<0 or eventid>=self.nevents: raise KeyError, eventid
+		n = self.n
+		if eventid < self.ostart:
+			p, r = divmod(eventid, self.blocksize)
+			nlab = self.labels[p]
+			if r==0: return ('D', nlab)
+			elif r==n: return ('L', nlab)
+			elif r==n+1: return ('S', nlab)
+			else:
+				q = r - 1
+				if q>=p: q += 1
+				return ('T', nlab, self.labels[q])
+		elif eventid < self.ostart + n:
+			return ('O', self.labels[eventid - self.ostart])
+		elif eventid == self.ostart + n:
+			return ('O', outtaxlab)
+		else:
+			return ('T', outtaxlab, self.labels[eventid - self.tostart])
+	
+	def __getitem__(self, evtup):
+		return self.encode(evtup)
+	
+	def get(self, evtup, default=None):
+		try:
+			return self.encode(evtup)
+		except KeyError:
+			return default
+	
+	def __contains__(self, evtup):
+		return not (self.get(evtup) is None)
+	
+	def __len__(self):
+		return self.nevents
+	
+	def __iter__(self):
+		for eventid in xrange(self.nevents):
+			yield self.decode(eventid)
+	
+	def iteritems(self):
+		for eventid in xrange(self.nevents):
+			yield (self.decode(eventid), eventid)
+	
+	def inverse(self):
+		return SpeTreeEventIdIndex(self)
+	
+	def iterEventRows(self):
+		"""yield the rows of the species_tree_events table, in id order: (event_id, event_type, don_branch_id, rec_branch_id)"""
+		eventid = 0
+		for p, nid in enumerate(self.nodeids):
+			for et in 'DTLS':
+				if et!='T':
+					yield (eventid, et, '', nid)
+					eventid += 1
+				else:
+					for q, donnid in enumerate(self.nodeids):
+						if q!=p:
+							yield (eventid, et, donnid, nid)
+							eventid += 1
+		for nid in self.nodeids + [self.outnid]:
+			yield (eventid, 'O', '', nid)
+			eventid += 1
+		if self.TfromOutside:
+			for nid in self.nodeids:
+				yield (eventid, 'T', self.outnid, nid)
+				eventid += 1
+	
+	def writeEventTable(self, nfout):
+		with open(nfout, 'w') as foutspeevents:
+			for outevtup in self.iterEventRows():
+				foutspeevents.write('\t'.join([str(e) for e in outevtup])+'\n')
+
+class SpeTreeEventIdIndex(object):
+	"""inverse of a SpeTreeEventIndex object, behaving like a read-only dict {eventid:evtup}"""
+	def __init__(self, speteventindex):
+		self.index = speteventindex
+	
+	def __getitem__(self, eventid):
+		return self.index.decode(eventid)
+	
+	def get(self, eventid, default=None):
+		try:
+			return self.index.decode(eventid)
+		except KeyError:
+			return default
+	
+	def __contains__(self, eventid):
+		return not (self.get(eventid) is None)
+	
+	def __len__(self):
+		return len(self.index)
+	
+	def __iter__(self):
+		return iter(xrange(len(self.index)))
+	
+	def iteritems(self):
+		for evtup, eventid in self.index.iteritems():
+			yield (eventid, evtup)
+
+def generateEventRefDB(refspetree, ALEmodel='undated', refTreeTableOutDir=None, TfromOutside=True, writeEventTable=False):
+	"""generates an index of event tuples (of the form (X, [don, ]rec)) and its inverse, see SpeTreeEventIndex. 
 	
 	Optionally writes out the reference species tree branches and event info to table files:
 	- species_tree table dump has fields:       (branch_id, parent_branch_id, branch_name, is_tip)
 	- species_tree_event table dump has fields: (event_id, event_type, don_branch_id, rec_branch_id)
+	the latter (with O(n^2) rows) is only written if writeEventTable is True, e.g. for loading into the database.
 	"""
-	def recordGLEvent(eventid, evtup, outevtup, drefspeeventTup2Ids, drefspeeventId2Tups, foutspeevents=None):
-		drefspeeventTup2Ids[evtup] = eventid
-		drefspeeventId2Tups[eventid] = evtup
-		if foutspeevents: foutspeevents.write('\t'.join([str(e) for e in outevtup])+'\n')
-		return eventid+1
-	
-	drefspeeventTup2Ids = {}
-	drefspeeventId2Tups = {}
-	maxnid = 0
-	eventid = 0
+	refspeeventindex = SpeTreeEventIndex(refspetree, TfromOutside=TfromOutside)
 	if refTreeTableOutDir:
-		foutspetree = open(os.path.join(refTreeTableOutDir, "phylogeny_species_tree.tab"), 'w')
-		foutspeevents = open(os.path.join(refTreeTableOutDir, "phylogeny_species_tree_events.tab"), 'w')
-	else:
-		foutspeevents = None
-	for node in refspetree:
-		nid = node.nodeid()
-		if nid>maxnid: maxnid = nid
-		nlab = node.label()
-		fnid = node.father_nodeid()
-		#~ if ALEmodel=='undated':
-		# for all models, do not record dates of events
-		if refTreeTableOutDir: foutspetree.write('\t'.join((str(nid), str(fnid if fnid else ''), nlab, str(int(node.is_leaf()))))+'\n')
-		#~ for et in pAr.eventTypes:
-		for et in 'DTLS':
-			evtup = (et, nlab)
-			if et!='T':
-				eventid = recordGLEvent(eventid, evtup, (eventid, et, '', nid), drefspeeventTup2Ids, drefspeeventId2Tups, foutspeevents)
-			else:
-				for donnode in refspetree:
-					if not node is donnode:
-						evtupt = evtup + (donnode.label(),)
-						eventid = recordGLEvent(eventid, evtupt, (eventid, et, donnode.nodeid(), nid), drefspeeventTup2Ids, drefspeeventId2Tups, foutspeevents)
-	
-	# for backwards compatibility wwhen O event we not considered
-	et = 'O'
-	for node in refspetree:
-		nid = node.nodeid()
-		if nid>maxnid: maxnid = nid
-		nlab = node.label()
-		fnid = node.father_nodeid()
-		evtup = (et, nlab)
-		eventid = recordGLEvent(eventid, evtup, (eventid, et, '', nid), drefspeeventTup2Ids, drefspeeventId2Tups, foutspeevents)
-	# add origination outside the tree
-	outnid = maxnid + 1
-	if refTreeTableOutDir: foutspetree.write('\t'.join((str(outnid), '', outtaxlab, '0'))+'\n')
-	evtup = (et, outtaxlab)
-	eventid = recordGLEvent(eventid, evtup, (eventid, et, '', outnid), drefspeeventTup2Ids, drefspeeventId2Tups, foutspeevents)
-	
-	if TfromOutside:
-		et = 'T'
-		# make this loop occur last so not to change the value of ids whether done or not
-		for node in refspetree:
-			nid = node.nodeid()
-			nlab = node.label()
-			evtupt = (et, outtaxlab, nlab)
-			eventid = recordGLEvent(eventid, evtupt, (eventid, et, outnid, nid), drefspeeventTup2Ids, drefspeeventId2Tups, foutspeevents)
-		
-	if refTreeTableOutDir:
-		foutspetree.close()
-		foutspeevents.close()
-	return (drefspeeventTup2Ids, drefspeeventId2Tups)
+		with open(os.path.join(refTreeTableOutDir, "phylogeny_species_tree.tab"), 'w') as foutspetree:
+			for node in refspetree:
+				fnid = node.father_nodeid()
+				foutspetree.write('\t'.join((str(node.nodeid()), str(fnid if fnid else ''), node.label(), str(int(node.is_leaf()))))+'\n')
+			# add origination outside the tree
+			foutspetree.write('\t'.join((str(refspeeventindex.outnid), '', outtaxlab, '0'))+'\n')
+		if writeEventTable:
+			refspeeventindex.writeEventTable(os.path.join(refTreeTableOutDir, "phylogeny_species_tree_events.tab"))
+	return (refspeeventindex, refspeeventindex.inverse())
+
+class GeneLineageEventDBWriter(object):
+	"""bulk loader of parsed event lineages into the gene_lineage_events table of a SQLite database
+	
+	Rows are inserted in large batches by a single writer (i.e. from the main process), each batch in one transaction.
+	Gene lineage labels are registered with an integer id (rlocds_id) in table replacement_label_or_cds_code2gene_families 
+	as they come, family after family. Indexes on table gene_lineage_events are dropped before the load 
+	and only built when closing the writer.
+	NB: event rows still refer to gene lineages by their label (replacement_label_or_cds_code), not by the integer rlocds_id,
+	as this is the key of table gene_lineage_events shared with the PostgreSQL schema, the R scripts and all co-evolution queries
+	(which get the rlocds_id by joining to replacement_label_or_cds_code2gene_families).
+	"""
+	glevtindexes = [('gene_lineage_events_recid', '', '(reconciliation_id)'), 
+	                ('gene_lineage_events_rlocds', '', '(replacement_label_or_cds_code)'), 
+	                ('gene_lineage_events_evtid', '', '(event_id)'), 
+	                ('gene_lineage_events_freq', '', '(freq)'), 
+	                ('gene_lineage_events_rlocds_evtid', '', '(replacement_label_or_cds_code, event_id)'), 
+	                ('gene_lineage_events_recid_rlocds_evtid', 'UNIQUE', '(reconciliation_id, replacement_label_or_cds_code, event_id)')]
+	
+	def __init__(self, nfdb, reconciliation_id=0, batchsize=100000, cachesizekb=1000000, verbose=False):
+		self.nfdb = nfdb
+		self.dbcon, self.dbcur, dbtype, valtoken = get_dbconnection(nfdb, 'sqlite')
+		self.recid = reconciliation_id
+		self.batchsize = batchsize
+		self.verbose = verbose
+		self.batch = []
+		self.nrows = 0
+		# this is the whole project database: keep the default rollback journal and synchronous mode so that an interrupted load
+		# cannot corrupt it; speed comes from one transaction per large batch, a large page cache and indexes built at the end
+		for pragma in ("temp_store = MEMORY", "cache_size = -%d"%cachesizekb):
+			self.dbcur.execute("PRAGMA %s;"%pragma)
+		for idxname, idxtype, idxcols in self.glevtindexes:
+			self.dbcur.execute("DROP INDEX IF EXISTS %s;"%idxname)
+		self.srlocds = set(lab for (lab,) in self.dbcur.execute("SELECT replacement_label_or_cds_code FROM replacement_label_or_cds_code2gene_families;"))
+		self.dbcon.commit()
+	
+	def writeFamilyEvents(self, fam, devtlineagecount):
+		"""queue the event lineages of a gene family for insertion; 'devtlineagecount' is of the form {geneleaflab:{eventid:freq}}"""
+		for geneleaflab in sorted(devtlineagecount):
+			eventlineage = devtlineagecount[geneleaflab]
+			if not eventlineage: continue
+			if not (geneleaflab in self.srlocds):
+				self.dbcur.execute("INSERT INTO replacement_label_or_cds_code2gene_families (replacement_label_or_cds_code, gene_family_id) VALUES (?,?);", (geneleaflab, fam))
+				self.srlocds.add(geneleaflab)
+			for eventid, freq in eventlineage.iteritems():
+				self.batch.append((geneleaflab, eventid, freq, self.recid))
+		if len(self.batch) >= self.batchsize: self.flush()
+	
+	def flush(self):
+		self.dbcur.executemany("INSERT INTO gene_lineage_events (replacement_label_or_cds_code, event_id, freq, reconciliation_id) VALUES (?,?,?,?);", self.batch)
+		self.dbcon.commit()
+		self.nrows += len(self.batch)
+		if self.verbose: print "inserted %d rows into table gene_lineage_events"%self.nrows
+		self.batch = []
+	
+	def close(self):
+		self.flush()
+		print "loaded %d rows into table gene_lineage_events of database '%s'; now building indexes"%(self.nrows, self.nfdb)
+		for idxname, idxtype, idxcols in self.glevtindexes:
+			self.dbcur.execute("CREATE %s INDEX IF NOT EXISTS %s ON gene_lineage_events %s;"%(idxtype, idxname, idxcols))
+		self.dbcon.commit()
+		self.dbcon.close()
 
 def parse_events(lnfrec, genefamlist=None, refspetree=None, ALEmodel='undated', \
                  drefspeeventTup2Ids={}, recordEvTypes='ODTS', minFreqReport=0, \
                  nfpickleEventsOut=None, nfshelveEventsOut=None, dirTableOut=None, \
-                 nbthreads=1, verbose=False):
-	"""from list of reconciliation files, families and genes to consider, return dictionary of reported events, by family and gene lineage"""
+                 nbthreads=1, verbose=False, nfsqliteEventsOut=None, reconciliation_id=0):
+	"""from list of reconciliation files, families and genes to consider, return dictionary of reported events, by family and gene lineage
+	
+	if nfsqliteEventsOut is provided, event lineages are loaded directly into the gene_lineage_events table of this SQLite database
+	(see GeneLineageEventDBWriter) instead of being written to text files under 'dirTableOut'; 
+	they are then only kept in the returned dict if also saved as pickle or shelve.
+	"""
 	lfams = [os.path.basename(nfrec).split('-')[0] for nfrec in lnfrec]
 	if genefamlist: ingenes = [genefam.get('replaced_cds_code', genefam['cds_code']) for genefam in genefamlist if (genefam['gene_family_id'] in lfams)]
 	else: ingenes=[]
@@ -388,9 +686,15 @@ def parse_events(lnfrec, genefamlist=None, refspetree=None, ALEmodel='undated',
 	#~ def parseRecSetArgs(nfrec):
 		#~ return parseRec(nfrec, refspetree, drefspeeventTup2Ids, onlyLineages=ingenes, recordEvTypes=recordEvTypes, minFreqReport=minFreqReport, \
 						#~ lineageTableOutDir=(os.path.join(dirTableOut, 'gene_tree_lineages') if dirTableOut else None))
-	diroutab = (os.path.join(dirTableOut, 'gene_tree_lineages') if dirTableOut else None)
-	returndict = bool(nfpickleEventsOut)
-	iterargs = ((nfrec, refspetree, ALEmodel, drefspeeventTup2Ids, ingenes, recordEvTypes, minFreqReport, returndict, diroutab, verbose) for nfrec in lnfrec)
+	diroutab = (os.path.join(dirTableOut, 'gene_tree_lineages') if (dirTableOut and not nfsqliteEventsOut) else None)
+	returndict = bool(nfpickleEventsOut or nfshelveEventsOut or nfsqliteEventsOut)
+	keepevents = bool(nfpickleEventsOut or nfshelveEventsOut or not nfsqliteEventsOut)
+	if nfsqliteEventsOut and not drefspeeventTup2Ids:
+		raise ValueError, "loading events into the database requires events to be coded with species tree event ids"
+	# arguments common to all families, including the heavy reference tree and event index, are only sent once to each worker;
+	# (as workers are forked, they are actually inherited from the parent process without pickling)
+	context = dict(refspetree=refspetree, ALEmodel=ALEmodel, drefspeeventTup2Ids=drefspeeventTup2Ids, onlyLineages=ingenes, \
+	               recordEvTypes=recordEvTypes, minFreqReport=minFreqReport, returnDict=returndict, lineageTableOutDir=diroutab, verbose=verbose)
 	
 	# prepare output
 	if nfshelveEventsOut:
@@ -398,20 +702,28 @@ def parse_events(lnfrec, genefamlist=None, refspetree=None, ALEmodel='undated',
 		dfamevents = shelve.open(nfshelveEventsOut)
 	else:
 		dfamevents = {}
+	if nfsqliteEventsOut:
+		print "will load event lineages into the database: '%s'"%nfsqliteEventsOut
+		dbwriter = GeneLineageEventDBWriter(nfsqliteEventsOut, reconciliation_id=reconciliation_id, verbose=verbose)
+	else:
+		dbwriter = None
 	
 	if nbthreads==1:
-		ildevents = (parseRecTupArgs(args) for args in iterargs)
+		initParseRecContext(context)
+		ildevents = (parseRecInContext(nfrec) for nfrec in lnfrec)
 	else:
-		pool = mp.Pool(processes=nbthreads)
-		#~ ldevents = pool.map(parseRecTupArgs, largs)
-		# an iterator is returned by imap(); one needs to actually iterate over it to have the pool of parrallel workers to compute
-		ildevents = pool.imap_unordered(parseRecTupArgs, iterargs)
+		pool = mp.Pool(processes=nbthreads, initializer=initParseRecContext, initargs=(context,))
+		# an iterator is returned by imap(); one needs to actually iterate over it to have the pool of parrallel workers to compute;
+		# per-task messages are only the reconciliation file paths
+		ildevents = pool.imap_unordered(parseRecInContext, lnfrec)
 	
 	for deventfam in ildevents:
 		fam = os.path.basename(deventfam['nfrec']).split('-')[0]
 		devent = deventfam.get('devtlineagecount')
-		dfamevents[fam] = devent
+		if dbwriter: dbwriter.writeFamilyEvents(fam, devent)
+		if keepevents: dfamevents[fam] = devent
 	
+	if dbwriter: dbwriter.close()
 	if nfshelveEventsOut:
 		print "saved 'dfamevents' to file '%s'"%nfpickleEventsOut
 		dfamevents.close()
@@ -428,7 +740,8 @@ def main():
 	                                                'genefams=', 'dir_constraints=', 'dir_replaced=', \
 	                                                'populations=', 'reftree=', \
 	                                                'evtype=', 'minfreq=', \
-	                                                'dir_table_out=', 'events_to_pickle=', 'events_to_shelve=', \
+	                                                'dir_table_out=', 'events_to_pickle=', 'events_to_shelve=', 'write_spetree_events', \
+	                                                'events_to_sqlite=', 'reconciliation_id=', \
 	                                                'threads=', 'help', 'verbose']) #, 'reuse=', 'max.recursion.limit=', 'logfile='
 	dopt = dict(opts)
 	
@@ -443,8 +756,11 @@ def main():
 	dirTableOut = dopt.get('--dir_table_out')
 	nfpickleEventsOut = dopt.get('--events_to_pickle')
 	nfshelveEventsOut = dopt.get('--events_to_shelve')
-	if not (nfpickleEventsOut or nfshelveEventsOut or dirTableOut):
-		raise ValueError, "an output option for parsed reconciliation must be chosen between '--dir_table_out', '--events_to_pickle' or '--events_to_shelve'"
+	writeSpeTreeEvents = ('--write_spetree_events' in dopt)
+	nfsqliteEventsOut = dopt.get('--events_to_sqlite')
+	reconciliation_id = int(dopt.get('--reconciliation_id', 0))
+	if not (nfpickleEventsOut or nfshelveEventsOut or dirTableOut or nfsqliteEventsOut):
+		raise ValueError, "an output option for parsed reconciliation must be chosen between '--dir_table_out', '--events_to_pickle', '--events_to_shelve' or '--events_to_sqlite'"
 	
 	# other params
 	# ALE reconciliation format
@@ -481,10 +797,12 @@ def main():
 	
 	
 	refspetree, dspe2pop = loadRefPopTree(nfrefspetree, nfpop)
-	drefspeeventTup2Ids, drefspeeventId2Tups = generateEventRefDB(refspetree, ALEmodel, refTreeTableOutDir=(os.path.join(dirTableOut, 'ref_species_tree') if dirTableOut else None))
+	drefspeeventTup2Ids, drefspeeventId2Tups = generateEventRefDB(refspetree, ALEmodel, refTreeTableOutDir=(os.path.join(dirTableOut, 'ref_species_tree') if dirTableOut else None), \
+	                                                              writeEventTable=writeSpeTreeEvents)
 	
 	dfamevents = parse_events(lnfrec, genefamlist, refspetree, ALEmodel, drefspeeventTup2Ids, recordEvTypes, minFreqReport, \
-								  nfpickleEventsOut, nfshelveEventsOut, dirTableOut, nbthreads, verbose)
+								  nfpickleEventsOut, nfshelveEventsOut, dirTableOut, nbthreads, verbose, \
+								  nfsqliteEventsOut=nfsqliteEventsOut, reconciliation_id=reconciliation_id)
 
 
 def usage():
@@ -495,6 +813,11 @@ def usage():
 	s += "\t\t--dir_replaced\tfolder containing files listing replaced leaf labels (e.g. when giving a species identity to collapsed gene tree clades)\n"
 	s += "\t\t--genefams\ttabulated file with header containing at least those two fields: 'cds_code', 'gene_family_id'\n"
 	s += "\t\t--ALE_algo\tmodel used in ALE reconciliations: 'dated' or 'undat[ed]' (default)\n"
+	s += "\t\t--write_spetree_events\twrite the table of all possible events on the reference species tree (required for loading into the database)\n"
+	s += "\t\t\t\tto the 'ref_species_tree/' folder under the path given with '--dir_table_out'.\n"
+	s += "\t\t--events_to_sqlite\tpath to SQLite database where to load event lineages directly (table gene_lineage_events),\n"
+	s += "\t\t\t\tinstead of writing them to the 'gene_tree_lineages/' folder under the path given with '--dir_table_out'.\n"
+	s += "\t\t--reconciliation_id\tid of the reconciliation collection, for loading into the database (default: 0).\n"
 	s += "Options only required when parsing reconciliations from collapsed gene trees:\n"
 	s += "\t\t--populations\tpath to file defining populations\n"
 	s += "\t\t--reftree\tpath to reference species file (the full tree, not the gene-family-specific collapsed tree used for the reconciliations)\n"
@@ -24,7 +24,7 @@ def main():
 	                                                'genefams=', 'dir_constraints=', 'dir_replaced=', \
 	                                                'populations=', 'reftree=', \
 	                                                'evtype=', 'minfreq=', \
-	                                                'dir_table_out=', 'events_to_pickle=', 'events_to_shelve=', \
+	                                                'dir_table_out=', 'events_to_pickle=', 'events_to_shelve=', 'write_spetree_events', \
 	                                                'threads=', 'help', 'verbose']) #, 'reuse=', 'max.recursion.limit=', 'logfile='
 	dopt = dict(opts)
 	
@@ -39,6 +39,7 @@ def main():
 	dirTableOut = dopt.get('--dir_table_out')
 	nfpickleEventsOut = dopt.get('--events_to_pickle')
 	nfshelveEventsOut = dopt.get('--events_to_shelve')
+	writeSpeTreeEvents = ('--write_spetree_events' in dopt)
 	if not (nfpickleEventsOut or nfshelveEventsOut or dirTableOut):
 		raise ValueError, "an output option for parsed reconciliation must be chosen between '--dir_table_out', '--events_to_pickle' or '--events_to_shelve'"
 	
@@ -76,7 +77,8 @@ def main():
 	
 	
 	refspetree, dspe2pop = loadRefPopTree(nfrefspetree, nfpop)
-	drefspeeventTup2Ids, drefspeeventId2Tups = generateEventRefDB(refspetree, ALEmodel, refTreeTableOutDir=(os.path.join(dirTableOut, 'ref_species_tree') if dirTableOut else None))
+	drefspeeventTup2Ids, drefspeeventId2Tups = generateEventRefDB(refspetree, ALEmodel, refTreeTableOutDir=(os.path.join(dirTableOut, 'ref_species_tree') if dirTableOut else None), \
+	                                                              writeEventTable=writeSpeTreeEvents)
 	
 	dfamevents = parse_events(lnfrec, genefamlist, refspetree, ALEmodel, drefspeeventTup2Ids, recordEvTypes, minFreqReport, \
 								  nfpickleEventsOut, nfshelveEventsOut, dirTableOut, nbthreads, verbose)
@@ -88,6 +90,7 @@ def usage():
 	s += "Facultative options:\n"
 	s += "\t\t--dir_constraints\tfolder containing files listing leaf labels of collapsed gene tree clades\n"
 	s += "\t\t--dir_replaced\tfolder containing files listing replaced leaf labels (e.g. when giving a species identity to collapsed gene tree clades)\n"
+	s += "\t\t--write_spetree_events\twrite the table of all possible events on the reference species tree (required for loading into the database)\n"
 	s += "\t\t--genefams\ttabulated file with header containing at least those two fields: 'cds_code', 'gene_family_id'\n"
 	s += "\t\t\t\trows indicate the genes to be treated in the search, and to which gene family they belong\n"
 	s += "\t\t\t\t(and hence in which reconciliation file to find them).\n"
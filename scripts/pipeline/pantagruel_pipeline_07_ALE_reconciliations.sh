@@ -151,11 +151,17 @@ if [ "$chaintype" == 'fullgenetree' ] ; then
 else
   pops=" --populations ${speciestree/.full/}_populations"
 fi
+if [ "${resumetask}" == 'true' ] ; then
+  echo "Resume mode: first clean the database from previous inserts and indexes"
+  ${ptgscripts}/pantagruel_sqlitedb_phylogeny_clean_reconciliations.sh "${database}" "${sqldb}" "${parsedreccolid}"
+fi
 ## normalise the species tree branch labels across gene families
-## and look for correlated transfer events across gene families
+## and look for correlated transfer events across gene families;
+## gene lineage events are loaded directly into the database
 python2.7 ${ptgscripts}/parse_collapsedALE_scenarios.py --rec_sample_list ${reclist} \
  ${pops} --reftree ${speciestree}.lsd.nwk --ALE_algo ${rectype} \
- --dir_table_out ${parsedrecs} --evtype ${evtypeparse} --minfreq ${minevfreqparse} \
+ --dir_table_out ${parsedrecs} --write_spetree_events --evtype ${evtypeparse} --minfreq ${minevfreqparse} \
+ --events_to_sqlite ${sqldb} --reconciliation_id ${parsedreccolid} \
  --threads ${ptgthreads}  &> ${ptglogs}/parse_collapsedALE_scenarios.log
 
 checkexec "Could not complete parsing ALE scenarios" "Successfully parsed ALE scenarios"
@@ -165,10 +171,6 @@ echo -e "${parsedreccolid}\t${parsedreccoldate}\t${parsedreccol}" > ${alerec}/pa
 echo -e "\n# Parsed reconciliation collection details:"
 cat ${alerec}/parsedreccol
 
-if [ "${resumetask}" == 'true' ] ; then
-  echo "Resume mode: first clean the database from previous inserts and indexes"
-  ${ptgscripts}/pantagruel_sqlitedb_phylogeny_clean_reconciliations.sh "${database}" "${sqldb}" "${parsedreccolid}"
-fi
 echo "Store reconciliation parameters and load parsed reconciliation data into database"
 ${ptgscripts}/pantagruel_sqlitedb_phylogeny_populate_reconciliations.sh "${database}" "${sqldb}" "${parsedrecs}" "${ALEversion}" "${ALEalgo}" "${ALEsourcenote}" "${parsedreccol}" "${parsedreccolid}" "${parsedreccoldate}"
 
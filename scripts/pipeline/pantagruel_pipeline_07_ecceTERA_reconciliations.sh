@@ -148,7 +148,7 @@ exit 2
 ## and look for correlated transfer events across gene families
 python2.7 ${ptgscripts}/parse_collapsedTERA_scenarios.py --rec_sample_list ${reclist} \
  ${pops} --reftree ${speciestree}.lsd.nwk \
- --dir_table_out ${parsedrecs} --evtype ${evtypeparse} --minfreq ${minevfreqparse} \
+ --dir_table_out ${parsedrecs} --write_spetree_events --evtype ${evtypeparse} --minfreq ${minevfreqparse} \
  --threads ${ptgthreads}  &> ${ptglogs}/parse_collapsedTERA_scenarios.log
 
 checkexec "Could not complete parsing ecceTERA scenarios" "Successfully parsed ecceTERA scenarios"
@@ -90,9 +90,15 @@ spacewarning="""BEWARE: GENERATES AN AWFUL LOT OF DATA, PREPARE DISK SPACE ACCOR
 # on a 880 Enterobacteriaceae dataset, results in ~300 GB output (made to be split into ~1GB files)"""
 echo ${step2}
 echo ${spacewarning}
+if [ "${resumetask}" == 'true' ] ; then
+  # skip the gene lineages already processed, as recorded in the progress journals of the output folder
+  resumeopt='--resume'
+else
+  resumeopt=''
+fi
 python2.7 $ptgscripts/compare_collapsedALE_scenarios.py --events_from_sqlite_db ${sqldb} --nrec_per_sample ${recsamplesize} \
  --event_type ${evtypematch} --min_freq ${minevfreqmatch} --min_joint_freq ${minjointevfreqmatch} --threads 8 \
- --dir_table_out ${compoutdir} &> ${ptglogs}/compare_collapsedALE_scenarios.${parsedreccol}.log
+ --dir_table_out ${compoutdir} ${resumeopt} &>> ${ptglogs}/compare_collapsedALE_scenarios.${parsedreccol}.log
 checkexec "failed ${step2}" "completed ${step2}\n"
 
 export assocoutdir=${compoutdir}/gene_lineage_assocations/between_fams_scores
@@ -11,6 +11,11 @@ from StringIO import StringIO
 from random import randint
 import gzip
 import pipes, tempfile
+try:
+	import numpy as np
+except ImportError:
+	# array fast paths of statistics functions will not be available
+	np = None
 
 supported_formats = {'newick': NewickIO, 'nexus': NexusIO}
 
@@ -46,12 +51,22 @@ def addStrtoTuple(a, b):
 	else:
 		raise TypeError, "unexpected type for 'a': %s"%repr(a)
 
+def _isnumarray(seq):
+	"""whether seq is a NumPy array of numbers, that cannot hold null values (None)"""
+	return (np is not None) and isinstance(seq, np.ndarray) and (seq.dtype.kind in 'biuf')
+
 def mean(seq, ignoreNull=True):
+	if _isnumarray(seq):
+		if not seq.size: return None
+		return float(seq.mean())
 	l = [float(k) for k in seq if ((k is not None) or (not ignoreNull))]
 	if not l: return None
 	return sum(l)/len(l)
 
 def median(seq, ignoreNull=True):
+	if _isnumarray(seq):
+		if not seq.size: return None
+		return float(np.median(seq))
 	l = [k for k in seq if ((k is not None) or (not ignoreNull))]
 	l.sort()
 	L = len(l)
@@ -65,6 +80,9 @@ def quantile(seq, P, ignoreNull=True):
 	
 	assumes a continuity of the distribution as following a function linear by segment to approximate quantiles
 	"""
+	if _isnumarray(seq):
+		if not seq.size: return None
+		return group_quantiles(np.zeros(seq.size, dtype=np.int64), seq.ravel(), P, ngroups=1)[0]
 	Q = []
 	for p in P:
 		l = [k for k in seq if ((k is not None) or (not ignoreNull))]
@@ -81,6 +99,54 @@ def quantile(seq, P, ignoreNull=True):
 		Q.append(q)
 	return tuple(Q)
 
+def group_best_hits(groups, keys, values):
+	"""for each distinct (group, key) combination of parallel arrays, return the group and the maximum of the values
+	
+	e.g. the best score of each lineage (key) with any lineage of the other orthologous group in each OG pair (group);
+	results are sorted by group, then by key.
+	"""
+	order = np.lexsort((keys, groups))
+	sg, sk = groups[order], keys[order]
+	first = np.ones(len(sg), dtype=bool)
+	first[1:] = (sg[1:]!=sg[:-1]) | (sk[1:]!=sk[:-1])
+	if not len(sg): return sg, np.zeros(0, dtype=np.float64)
+	# (group, key) segments are contiguous after sorting
+	best = np.maximum.reduceat(np.asarray(values, dtype=np.float64)[order], np.flatnonzero(first))
+	return sg[first], best
+
+def group_quantiles(groups, values, P, ngroups=None):
+	"""return for each group of values (groups are integer codes from 0 to ngroups-1) the tuple of quantiles at breaks P, as in quantile()
+	
+	groups without values get None.
+	"""
+	if ngroups is None: ngroups = (groups.max()+1) if len(groups) else 0
+	order = np.lexsort((values, groups))
+	svalues = values[order].astype(np.float64)
+	counts = np.bincount(groups, minlength=ngroups)
+	starts = np.concatenate(([0], np.cumsum(counts)[:-1]))
+	nonempty = np.flatnonzero(counts > 0)
+	lQ = []
+	for p in P:
+		# linear interpolation between the values of flanking ranks
+		rankq = (counts[nonempty] - 1)*float(p)
+		irankq = rankq.astype(np.int64)
+		drankq = rankq - irankq
+		lo = svalues[starts[nonempty]+irankq]
+		hi = svalues[starts[nonempty]+np.minimum(irankq+1, counts[nonempty]-1)]
+		lQ.append(np.where(drankq==0, lo, lo*(1-drankq) + hi*drankq))
+	Q = [None]*ngroups
+	for k, tq in zip(nonempty.tolist(), zip(*[q.tolist() for q in lQ])):
+		Q[k] = tq
+	return Q
+
+def group_means(groups, values, ngroups=None):
+	"""return the array of the mean of values in each group (groups are integer codes from 0 to ngroups-1); NaN for groups without values"""
+	if ngroups is None: ngroups = (groups.max()+1) if len(groups) else 0
+	counts = np.bincount(groups, minlength=ngroups)
+	sums = np.bincount(groups, weights=values, minlength=ngroups)
+	with np.errstate(invalid='ignore', divide='ignore'):
+		return sums / counts
+
 def var(seq, correct=1):
 	m = mean(seq)
 	if m is None: return None